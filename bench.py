@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import time, re, sys, json, contextlib
+import http.server, urllib.request, threading, tempfile, subprocess, ssl, os
+import io, resource, multiprocessing
+import learnit, learnit2, learnit_http, learnit_replay, learnit_mock
+import learnit_cmd, learnit_cmd2, learnit_store
+
+def synthetic_course(n_students, n_assignments, n_log, group_size=3, n_teachers=10, seed=0):
+   ''' Raw tables (asss, gros, pers, studs, log) as returned by the
+       learnit2.Learnit table methods and get_log, for a made up course. '''
+   return learnit_mock.MockCourse(n_students, n_assignments, n_log, group_size, n_teachers, seed=seed).raw_tables()
+
+def grading_page(n_students, group_size=3, seed=0):
+   ''' A grading table page like the one list_submissions parses '''
+   return learnit_mock.MockCourse(n_students, 1, 1000, group_size, seed=seed).grading_page(0)
+
+def legacy_parse_submissions(data):
+   ''' list_submissions before it walked the table with precompiled patterns '''
+   subs = {}
+   for row, dat in re.findall(r'<tr[^<>]+?id="mod_assign_grading_r(\d+)"(.*?)</tr>', data, re.DOTALL):
+      match = re.search(r'>Group (.+?)<', dat)
+      group = match.group(1) if match else 'Default group'
+      match = re.search(r'selected">(.*?)</option>', dat)
+      grade = learnit.name_to_grade[match.group(1).lower()] if match else learnit.NO_GRADE
+      match = re.search(r'_c6">(.*?)</td>', dat)
+      substat = learnit.name_to_substat[match.group(1).lower()]
+      match = re.search(r'_c3">(.*?)</td>', dat)
+      email = match.group(1) if match else 'Unknown'
+      match = re.search(r'_c2"><a.*?>(.*?)</a></td>', dat)
+      name = match.group(1) if match else 'Unknown'
+      match = re.search(r'id="selectuser_(\d+)"', dat)
+      studid = match.group(1) if match else 'Unknown'
+      if group not in subs:
+         subs[group] = learnit.Row(row, grade, substat, [email], [name], [studid])
+      else:
+         subs[group].emails.append(email)
+         subs[group].names.append(name)
+         subs[group].studids.append(studid)
+   return subs
+
+def timeit(fun, *args, repeat=3):
+   best = float('inf')
+   for _ in range(repeat):
+      start = time.perf_counter()
+      fun(*args)
+      best = min(best, time.perf_counter() - start)
+   return best
+
+def bench_join(scales=(1, 2, 4, 8, 16)):
+   ''' Time learnit2.join_tables on courses of growing size. With linear
+       joins the time per input row should stay roughly constant. '''
+   print('Joining tables (students, assignments, log rows):')
+   for scale in scales:
+      raw = synthetic_course(150 * scale, 10 * scale, 10000 * scale)
+      rows = sum(map(len, raw)) + len(raw[1]) * len(raw[0])
+      secs = timeit(learnit2.join_tables, *raw)
+      print('   {:>6} {:>4} {:>7}: {:8.3f}s {:8.2f}us/row'.format(
+         150 * scale, 10 * scale, 10000 * scale, secs, secs / rows * 1e6))
+
+class PageHandler(http.server.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+   disable_nagle_algorithm = True
+   page = b'<html>' + b'x' * 20000 + b'</html>'
+   def do_GET(self):
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(self.page)))
+      self.end_headers()
+      self.wfile.write(self.page)
+   def log_message(self, *args):
+      pass
+
+def local_server(tls):
+   ''' A local http(s) server on a free port, or None if no certificate can be made '''
+   server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+   context = None
+   if tls:
+      tmp = tempfile.mkdtemp()
+      cert, key = os.path.join(tmp, 'cert.pem'), os.path.join(tmp, 'key.pem')
+      try:
+         subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+            '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', cert],
+            check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      except (OSError, subprocess.CalledProcessError):
+         server.server_close()
+         return None, None
+      server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+      server_context.load_cert_chain(cert, key)
+      server.socket = server_context.wrap_socket(server.socket, server_side=True)
+      context = ssl.create_default_context(cafile=cert)
+   threading.Thread(target=server.serve_forever, daemon=True).start()
+   return server, context
+
+def bench_keepalive(requests=200):
+   ''' Time sequential page fetches with a fresh connection per request, as
+       urllib does, against the pooled keep-alive handlers. '''
+   print('Fetching a page {} times (ms per request):'.format(requests))
+   for tls in (False, True):
+      server, context = local_server(tls)
+      if server is None:
+         print('   https: skipped, openssl is needed to make a certificate')
+         continue
+      scheme = 'https' if tls else 'http'
+      url = '{}://127.0.0.1:{}/'.format(scheme, server.server_port)
+      pool = learnit_http.ConnectionPool()
+      openers = [
+         ('fresh', urllib.request.build_opener(urllib.request.HTTPSHandler(context=context))),
+         ('pooled', urllib.request.build_opener(learnit_http.KeepAliveHTTPHandler(pool),
+            learnit_http.KeepAliveHTTPSHandler(pool, context=context)))]
+      results = []
+      for name, opener in openers:
+         fetch = lambda: [opener.open(url).read() for _ in range(requests)]
+         results.append(timeit(fetch) / requests * 1000)
+      print('   {:>5}: fresh {:6.3f}  pooled {:6.3f}  saved {:6.3f}'.format(
+         scheme, results[0], results[1], results[0] - results[1]))
+      pool.close()
+      server.shutdown()
+      server.server_close()
+
+def bench_grading(sizes=(150, 600, 2400)):
+   ''' Time parsing the grading table, against the old per row regexes '''
+   print('Parsing grading tables (rows, ms):')
+   for size in sizes:
+      page = grading_page(size)
+      assert learnit.parse_submissions(page) == legacy_parse_submissions(page)
+      legacy = timeit(legacy_parse_submissions, page) * 1000
+      now = timeit(learnit.parse_submissions, page) * 1000
+      print('   {:>6} {:>8}KB: legacy {:8.2f}  now {:8.2f}  ({:.0%})'.format(
+         size, len(page) // 1024, legacy, now, now / legacy))
+
+def peak_rss():
+   ''' The most memory this process has used so far, in bytes '''
+   return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class StageTimer:
+   ''' Times named stages of client work, how long of each was spent in the
+       LoggingOpener.open calls of the given clients, and how much each
+       raised the peak memory use of the process '''
+   def __init__(self, *clients):
+      self.lock = threading.Lock()
+      self.stages = [] # [(name, seconds, fetch seconds, requests, peak growth)]
+      self.fetch, self.requests = 0, 0
+      self.current = None
+      for client in clients:
+         client.opener.open = self.__timed(client.opener.open)
+
+   def __timed(self, open_):
+      def timed_open(*args, **kwargs):
+         start = time.perf_counter()
+         try:
+            return open_(*args, **kwargs)
+         finally:
+            with self.lock:
+               self.fetch += time.perf_counter() - start
+               self.requests += 1
+      return timed_open
+
+   @contextlib.contextmanager
+   def stage(self, name):
+      self.current = name
+      self.fetch, self.requests = 0, 0
+      peak = peak_rss()
+      start = time.perf_counter()
+      yield
+      self.stages.append((name, time.perf_counter() - start, self.fetch, self.requests, peak_rss() - peak))
+
+def client_stages(v1, v2, username, password, cid, timer):
+   ''' The client operations the replay benchmark times, in the order they
+       were recorded. Every choice is deterministic, so a replay asks for
+       the same pages as the recording did. '''
+   with timer.stage('login'):
+      _, er = v1.login(username, password)
+   assert er == learnit.SUCCESS, 'login failed'
+   with timer.stage('list_assignments'):
+      aid = min(v1.list_assignments(cid))
+   with timer.stage('list_submissions'):
+      rows = v1.list_submissions(aid)
+   row = min(row.row for row in rows.values())
+   with timer.stage('show_submission'):
+      v1.show_submission(aid, row)
+   with timer.stage('get_log'):
+      list(v1.get_log(cid, aid))
+   with timer.stage('login (learnit2)'):
+      _, er = v2.login(username, password)
+   assert er == learnit2.SUCCESS, 'login failed'
+   with timer.stage('get_tables'):
+      v2.get_tables(cid)
+
+def record_fixtures(path, cid='3003023', passwd_file='.password'):
+   ''' Run client_stages against learnit, recording the traffic into path '''
+   with open(passwd_file) as f:
+      passwd = json.loads(f.read())
+   fixtures = learnit_replay.Fixtures(path)
+   fixtures.entries.clear()
+   v1 = learnit.Learnit(learnit_replay.recording_handlers(fixtures), cache=False)
+   v2 = learnit2.Learnit(learnit_replay.recording_handlers(fixtures), cache=False)
+   try:
+      client_stages(v1, v2, passwd['username'], passwd['password'], cid, StageTimer(v1, v2))
+   finally:
+      fixtures.save()
+   with open(os.path.join(path, 'stages.json'), 'w') as f:
+      json.dump({'cid': cid}, f)
+   print('Recorded {} responses into {}'.format(len(fixtures.entries), path))
+
+def bench_replay(path, latency=0, repeat=3):
+   ''' Time client_stages replayed from the fixtures recorded into path, end
+       to end and per stage. Fetching is the time spent in opener.open, the
+       rest is parsing and joining. Fetches run in parallel in get_tables, so
+       their sum can be more than the stage took. '''
+   with open(os.path.join(path, 'stages.json')) as f:
+      cid = json.load(f)['cid']
+   fixtures = learnit_replay.Fixtures(path)
+   server = learnit_replay.StandInServer(fixtures.respond, latency).start()
+   runs = []
+   for _ in range(repeat):
+      fixtures.rewind()
+      v1 = learnit.Learnit(learnit_replay.replay_handlers(server), cache=False)
+      v2 = learnit2.Learnit(learnit_replay.replay_handlers(server), cache=False)
+      timer = StageTimer(v1, v2)
+      client_stages(v1, v2, 'username', 'password', cid, timer)
+      runs.append(timer.stages)
+   server.stop()
+   if server.misses:
+      print('   {} requests were not recorded, like {} {}'.format(len(server.misses), *server.misses[0]))
+   print('Replaying {} with {}ms latency (best of {}, ms):'.format(path, latency * 1000, repeat))
+   for stages in zip(*runs):
+      name, _, _, requests, _ = stages[0]
+      total, fetch = min((total, fetch) for _, total, fetch, _, _ in stages)
+      print('   {:<17} {:9.2f}  fetching {:9.2f} in {:>4} requests  other {:9.2f}'.format(
+         name, total * 1000, fetch * 1000, requests, max(0, total - fetch) * 1000))
+   print('   {:<17} {:9.2f}'.format('total', min(sum(s[1] for s in run) for run in runs) * 1000))
+
+def serve_course(conn, *args):
+   ''' Serve a learnit_mock.MockCourse(*args) until told to stop over conn '''
+   course = learnit_mock.MockCourse(*args)
+   server = learnit_replay.StandInServer(course.respond).start()
+   conn.send((server.server_address, course.cid))
+   conn.recv()
+   server.stop()
+
+def scale_stages(v1, v2, cid, store_path, timer):
+   ''' The client calls and commands the scale benchmark times '''
+   quiet = lambda: contextlib.redirect_stdout(io.StringIO())
+   with timer.stage('login'):
+      data, _ = v1.login('username', 'password')
+      v2.login('username', 'password')
+   aid = min(v1.list_assignments(cid))
+   with timer.stage('list_submissions'):
+      subs = v1.list_submissions(aid)
+   with timer.stage('show_submission'):
+      v1.show_submission(aid, min(row.row for row in subs.values()))
+   with timer.stage('get_log'):
+      list(v1.get_log(cid, aid))
+   with timer.stage('get_course_log'):
+      v1.get_course_log(cid)
+   dialog = learnit_cmd.AssignmentDialog(v1, cid, aid)
+   dialog.subs = subs
+   with timer.stage('cmd list'), quiet():
+      dialog.list_cmd()
+   dialog = learnit_cmd.MainDialog(v1, data)
+   with timer.stage('cmd result'), quiet():
+      dialog.result_cmd(cid)
+   with timer.stage('cmd table'), quiet():
+      dialog.table_cmd(cid)
+   with timer.stage('get_tables'):
+      tables = v2.get_tables(cid)
+   print('   loaded {} students, {} groups, {} submissions'.format(
+      len(tables.students), len(tables.groups), len(tables.submissions)))
+   dialog = learnit_cmd2.MainDialog(v2, cid)
+   dialog.store = learnit_store.CourseStore(store_path)
+   with timer.stage('cmd2 update all'), quiet():
+      dialog.update_cmd(' all')
+   with timer.stage('cmd2 update'), quiet():
+      dialog.update_cmd(None)
+   with timer.stage('cmd2 result'), quiet():
+      dialog.result_cmd()
+   with timer.stage('cmd2 status'), quiet():
+      dialog.status_cmd(tables.groups[0].name)
+   dialog.store.close()
+
+def bench_scale(scales=((150, 10, 10**4), (1000, 30, 10**5), (10000, 100, 10**6))):
+   ''' Load test the clients and the commands against learnit_mock courses
+       of (students, assignments, log rows), served from another process so
+       the memory figures are the client's alone. For every stage it shows
+       the time taken, the time spent fetching pages, and how much the stage
+       raised the peak memory use. '''
+   for n_students, n_assignments, n_log in scales:
+      print('Course with {} students, {} assignments, {} log rows:'.format(n_students, n_assignments, n_log))
+      conn, child_conn = multiprocessing.Pipe()
+      server = multiprocessing.Process(target=serve_course, args=(child_conn, n_students, n_assignments, n_log))
+      server.start()
+      address, cid = conn.recv()
+      v1 = learnit.Learnit([learnit_replay.LocalRouteHandler(address)], cache=False)
+      v2 = learnit2.Learnit([learnit_replay.LocalRouteHandler(address)], cache=False)
+      timer = StageTimer(v1, v2)
+      with tempfile.TemporaryDirectory() as tmp:
+         try:
+            scale_stages(v1, v2, cid, os.path.join(tmp, 'course.sqlite'), timer)
+         except Exception as err:
+            print('   {} failed: {!r}'.format(timer.current, err))
+      conn.send('stop')
+      server.join()
+      for name, total, fetch, requests, peak in timer.stages:
+         print('   {:<17} {:9.2f}s  fetching {:9.2f}s in {:>5} requests  peak +{:7.1f}MB'.format(
+            name, total, fetch, requests, peak / 2**20))
+      print('   peak memory {:.1f}MB'.format(peak_rss() / 2**20))
+
+if __name__ == '__main__':
+   if sys.argv[1:2] == ['record']:
+      record_fixtures(*sys.argv[2:])
+   elif sys.argv[1:2] == ['replay']:
+      bench_replay(sys.argv[2], *map(float, sys.argv[3:4]))
+   elif sys.argv[1:2] == ['scale']:
+      if sys.argv[2:]:
+         bench_scale([tuple(map(int, sys.argv[2:5]))])
+      else:
+         bench_scale()
+   else:
+      bench_join()
+      bench_grading()
+      bench_keepalive()
@@ -1,12 +1,13 @@
-import urllib.request
+import urllib.request, urllib.error, http.cookiejar
 from urllib.parse import urlparse, parse_qs, urlencode
 from html.parser import HTMLParser
-from collections import namedtuple
-import re, zipfile, os, io, json, html, csv
-import dateutil.parser
-import logging
+from collections import namedtuple, defaultdict
+import re, zipfile, os, io, json, html, csv, shutil, http.client
+from learnit_http import LoggingOpener, ResponseCache, RateLimiter, \
+   ConnectionPool, KeepAliveHTTPHandler, KeepAliveHTTPSHandler, save_cookies, load_cookies, \
+   timed, parse_times, Scheduler, INTERACTIVE, BACKGROUND
 
-SUCCESS, INVALID_PASSWORD, UNKNOWN_ERROR, WAYF_REDIRECT = range(4)
+SUCCESS, INVALID_PASSWORD, UNKNOWN_ERROR, WAYF_REDIRECT, SESSION_EXPIRED = range(5)
 NO_GRADE, APPROVED, NOT_APPROVED = range(3)
 HAS_SUBMIT, NO_SUBMIT, UKNOWN_SUBMIT = range(3)
 
@@ -15,9 +16,20 @@ Submission = namedtuple('Submission',
    'files', 'grade', 'feedback', 'comments', 'context_id',
    'grade_to_code'])
 Attachment = namedtuple('Attachment', ['filename', 'data'])
+SpooledAttachment = namedtuple('SpooledAttachment', ['filename', 'path'])
 Row = namedtuple('Row', ['row', 'grade','substat', 'emails', 'names', 'studids'])
 GradeAction = namedtuple('GradeAction', ['time', 'grader', 'studid'])
+GradeRecord = namedtuple('GradeRecord', ['line', 'assignment', 'group', 'grade', 'feedback'])
+GradeResult = namedtuple('GradeResult', ['record', 'status', 'attempts', 'message'])
 
+clean_name = lambda s: re.sub('[^\w\d\.]', '_', re.sub('\?.*|.*/', '', s))
+
+def clean_path(name):
+   ''' A file or zip member name -> a relative path that keeps its folders,
+       with every part cleaned like clean_name and empty, '.' and '..' parts
+       left out. Empty if nothing is left. '''
+   parts = (re.sub('[^\w\d\.]', '_', part) for part in re.sub('\?.*', '', name).split('/'))
+   return '/'.join(part for part in parts if part not in ('', '.', '..'))
 regsafe = lambda s: re.sub(r'([\-\[\]\/\{\}\(\)\*\+\?\.\\\^\$\|])', r'\\\1', s)
 course_view = "https://learnit.itu.dk/course/view.php?id="
 assign_view = "https://learnit.itu.dk/mod/assign/view.php?id={}&action={}&group={}"
@@ -30,6 +42,133 @@ name_to_substat = {'nothing has been submitted for this assignment': NO_SUBMIT,
 grade_to_name = {NO_GRADE: 'No grade', APPROVED: 'Approved', NOT_APPROVED: 'Not approved'}
 substat_to_name = {HAS_SUBMIT: 'Submitted', NO_SUBMIT: 'Not submitted', UKNOWN_SUBMIT: 'Unknown'}
 
+grading_row_regex = re.compile(r'<tr[^<>]+?id="mod_assign_grading_r(\d+)"')
+grading_group_regex = re.compile(r'>Group (.+?)<')
+grading_grade_regex = re.compile(r'selected">(.*?)</option>')
+grading_substat_regex = re.compile(r'_c6">(.*?)</td>')
+grading_email_regex = re.compile(r'_c3">(.*?)</td>')
+grading_name_regex = re.compile(r'_c2"><a.*?>(.*?)</a></td>')
+grading_studid_regex = re.compile(r'id="selectuser_(\d+)"')
+log_grade_regex = re.compile(r'assign grade submission \((.+)\)$')
+log_assign_regex = re.compile(r'view\.php\?id=(\d+)')
+log_studid_regex = re.compile(r'Grade student: \(id=(\d+), fullname=.+\)\.')
+
+@timed('parse grading table')
+def parse_submissions(data):
+   ''' Grading page -> dictionary of group_id -> Row object.
+       Walks the table once, row by row, searching for each field only
+       within the bounds of its row instead of copying the row out. '''
+   subs = {}
+   pos = 0
+   while True:
+      match = grading_row_regex.search(data, pos)
+      if not match:
+         break
+      row, start = match.group(1), match.end()
+      end = data.find('</tr>', start)
+      if end == -1:
+         break
+      pos = end
+      match = grading_group_regex.search(data, start, end)
+      group = match.group(1) if match else 'Default group'
+      match = grading_grade_regex.search(data, start, end)
+      grade = name_to_grade[match.group(1).lower()] if match else NO_GRADE
+      match = grading_substat_regex.search(data, start, end)
+      substat = name_to_substat[match.group(1).lower()]
+      match = grading_email_regex.search(data, start, end)
+      email = match.group(1) if match else 'Unknown'
+      match = grading_name_regex.search(data, start, end)
+      name = match.group(1) if match else 'Unknown'
+      match = grading_studid_regex.search(data, start, end)
+      studid = match.group(1) if match else 'Unknown'
+      if group not in subs:
+         subs[group] = Row(row, grade, substat, [email], [name], [studid])
+      else:
+         subs[group].emails.append(email)
+         subs[group].names.append(name)
+         subs[group].studids.append(studid)
+   return subs
+
+def read_grades(path):
+   ''' Read GradeRecords from a csv file with a header of assignment, group,
+       grade and optionally feedback, or from a .jsonl file of objects with
+       those keys, one per line. A byte order mark, as spreadsheets write, is
+       skipped. '''
+   with open(path, newline='', encoding='utf-8-sig') as f:
+      if path.endswith('.jsonl'):
+         lines = ((i, json.loads(line)) for i, line in enumerate(f, 1) if line.strip())
+      else:
+         lines = enumerate(csv.DictReader(f), 2)
+      return [GradeRecord(i, str(rec['assignment']).strip(), str(rec['group']).strip(),
+            str(rec['grade']), rec.get('feedback') or '')
+         for i, rec in lines]
+
+def error_message(err):
+   ''' An unexpected error as a line of a grade report '''
+   return '{}: {}'.format(type(err).__name__, err)
+
+def write_grade_report(path, results):
+   ''' Write GradeResults as a csv file, in the order of the input lines '''
+   with open(path, 'w', newline='', encoding='utf-8') as f:
+      writer = csv.writer(f)
+      writer.writerow(['line', 'assignment', 'group', 'grade', 'status', 'attempts', 'message'])
+      for result in sorted(results, key=lambda result: result.record.line):
+         record = result.record
+         writer.writerow([record.line, record.assignment, record.group, record.grade,
+            result.status, result.attempts, result.message])
+
+@timed('parse log csv')
+def parse_log(data):
+   ''' Log csv -> (assignment id, GradeAction) of every grading in it,
+       newest first as in the log '''
+   rows = csv.reader(io.StringIO(data), dialect='excel-tab')
+   next(rows, None)
+   assert next(rows, None) == ['Course', 'Time', 'IP address', 'User full name', 'Action', 'Information']
+   graded = []
+   for _, time, _, grader, action, info in rows:
+      match = log_grade_regex.match(action)
+      if match:
+         graded.append((time, grader, match.group(1), info))
+   times = parse_times([time for time, _, _, _ in graded])
+   actions = []
+   for time, (_, grader, source, info) in zip(times, graded):
+      aid = log_assign_regex.search(source)
+      studid = log_studid_regex.match(info).group(1)
+      actions.append((aid and aid.group(1), GradeAction(time, grader, studid)))
+   return actions
+
+class CourseLog:
+   ''' The grade actions of a course log, partitioned by assignment, newest
+       first, and indexed by (assignment, student id) '''
+   def __init__(self, actions):
+      self.assignments = defaultdict(list)
+      self.students = defaultdict(list) # (aid, studid) -> [index into assignments[aid]]
+      for aid, action in actions:
+         self.students[aid, action.studid].append(len(self.assignments[aid]))
+         self.assignments[aid].append(action)
+
+   def grade_actions(self, aid, studids=None):
+      ''' -> [GradeAction] of the assignment, or only of the students with
+          studids, newest first '''
+      if studids is None:
+         return self.assignments.get(aid, [])
+      indexes = {i for studid in studids for i in self.students.get((aid, studid), ())}
+      return [self.assignments[aid][i] for i in sorted(indexes)]
+
+   def latest(self, aid, studids):
+      ''' -> The latest GradeAction on any of the students in the
+          assignment, or None '''
+      indexes = [self.students[aid, studid][0] for studid in studids if (aid, studid) in self.students]
+      return self.assignments[aid][min(indexes)] if indexes else None
+
+   def replaced(self, aid, actions):
+      ''' -> a CourseLog with the grade actions of the assignment replaced by
+          actions, newest first, sharing the other assignments with this one '''
+      log = CourseLog((aid, action) for action in actions)
+      log.assignments.update((a, actions) for a, actions in self.assignments.items() if a != aid)
+      log.students.update((key, indexes) for key, indexes in self.students.items() if key[0] != aid)
+      return log
+
 class TableParser(HTMLParser):
    def __init__(self):
       HTMLParser.__init__(self)
@@ -65,38 +204,148 @@ class FormParser(HTMLParser):
       HTMLParser.feed(self, data)
       return self
 
-class LoggingOpener:
-   def __init__(self, opener):
-      self.opener = opener
-      self.logger = logging.getLogger('weblogger')
-      self.logger.setLevel(logging.DEBUG)
-      self.logger.addHandler(logging.FileHandler('log'))
-   def open(self, url, data=None, binary=False):
-      self.logger.debug('Requesting ' + url)
-      if data:
-         self.logger.debug('Data ' + data.decode('utf-8'))
-      resp = self.opener.open(url, data)
-      self.logger.debug('Reponse headers: ' + repr(resp.getheaders()))
-      payload = resp.read()
-      if not binary:
-         payload = payload.decode('utf-8')
-         self.logger.debug('Response payload: ' + payload)
-      else:
-         self.logger.debug('Binary response')
-      return payload, resp
+@timed('parse grading form')
+def parse_submission(data):
+   ''' Grading form page -> (Submission, comment_ajax parameters or None).
+       The comments are left to fetch when there are any. '''
+   form = FormParser().feed(data)
+   if 'Nothing has been submitted for this assignment' in data:
+      return Submission(form, NO_SUBMIT, 'Not graded', 'Unknown', [], NO_GRADE, '', [], None, None), None
+   match = re.search(r'M\.core_comment\.init\(Y, ({.*?})', data)
+   com_json = json.loads(match.group(1))
+   # Comments
+   context_id = com_json['contextid']
+   match = re.search(r'>Comments \((\d+)\)<', data)
+   if not match or match.group(1) == '0':
+      com_json = None
+   # Status
+   match = re.search('>Submission status</td>.+?>(.*?)</td>', data, re.DOTALL)
+   sub_status = name_to_substat[match.group(1).lower()]
+   match = re.search('>Grading status</td>.+?>(.*?)</td>', data, re.DOTALL)
+   grad_status = match.group(1) if match else 'Unknown'
+   match = re.search('>Last modified</td>.+?>(.*?)</td>', data, re.DOTALL)
+   last_mod = match.group(1) if match else 'Unknown'
+   # Files
+   file_url = regsafe(sub_file.format(context_id))
+   files = re.findall(r'href="{}(.*?)"'.format(file_url), data)
+   # Grade and feedback
+   gradeurl = 'https://learnit.itu.dk/grade/report/grader/index.php'
+   match = re.search(r'<a href="{}.*?>(.*?)</a>'.format(regsafe(gradeurl)), data)
+   grade = name_to_grade[match.group(1).lower()]
+   match = re.search(r'<textarea id="id_assignfeedbackcomments_editor.*?>(.*?)</textarea>', data, re.DOTALL)
+   feedback = html.unescape(match.group(1) if match else '').replace('<br>','\n')
+   # Figure out grade_to_code table
+   grade_to_code = {}
+   select = re.search('<select name="grade".*?</select>', data, re.DOTALL).group(0)
+   for code, text in re.findall('<option value="([\-\d]+)".*?>(.+?)</option>', select):
+      grade_to_code[name_to_grade[text.lower()]] = code
+   return Submission(form, sub_status, grad_status, last_mod, files, grade, feedback, [], context_id, grade_to_code), com_json
+
+@timed('parse course view')
+def parse_assignments(data):
+   ''' Course page -> dictionary of assignment id -> title '''
+   regex = r'<li class="activity assign modtype_assign " id="module-(\d+)">' +\
+         r'.*?<span class="instancename">(.*?)</?span'
+   return {name:title for name,title in re.findall(regex, data)}
+
+def comments_data(sesskey, com_json):
+   ''' The post data of a comment_ajax request for the comments of a submission '''
+   return urlencode({
+      'sesskey': sesskey,
+      'action': 'get',
+      'client_id': com_json['client_id'],
+      'itemid': com_json['itemid'],
+      'area': 'submission_comments',
+      'courseid': com_json['courseid'],
+      'contextid': com_json['contextid'],
+      'component': 'assignsubmission_comments',
+      'page': '0'
+   }).encode('utf-8')
+
+def grade_data(assign_id, row, form, grade, feedback, grade_to_code):
+   ''' The post data that saves a grade and feedback with a grading form '''
+   return urlencode({
+      'mform_isexpanded_id_header_comments': '1',
+      'mform_isexpanded_id_header_editpdf': '1',
+      'id': assign_id,
+      'rownum': row,
+      'useridlistid': form.data['useridlistid'],
+      'attemptnumber': form.data['attemptnumber'],
+      'ajax': '0',
+      'action': 'submitgrade',
+      'sesskey': form.data['sesskey'],
+      '_qf__mod_assign_grade_form_'+row: '1',
+      'grade': grade_to_code[grade],
+      'assignfeedbackcomments_editor[text]': feedback.replace('\n','<br>'),
+      'assignfeedbackcomments_editor[format]': '1',
+      'applytoall': '1',
+      'savegrade': 'Save changes'
+   }).encode('utf-8')
+
+def log_csv_url(courseid, modid):
+   ''' The url of the log of an assignment, or of the whole course when
+       modid is empty, as csv and without views '''
+   return page_log + '?' + urlencode({
+      'chooselog': '1',
+      'showusers': '1',
+      'showcourses': '0',
+      'id': courseid,
+      'group': '',
+      'user': '',
+      'date': '0',
+      'modid': modid,
+      'modaction': '-view',
+      'logformat': 'downloadascsv'
+   })
 
 class Learnit:
-   def __init__(self):
+   def __init__(self, handlers=None, cache=None, workers=8, log=None):
+      ''' handlers replace the urllib handlers that open requests on pooled
+          keep-alive connections, to record or replay traffic. cache is the
+          ResponseCache to use instead of the default one, or False for none.
+          workers is the number of threads of the client's Scheduler. log is
+          the RequestLog to log requests to, none are logged without it. '''
+      self.scheduler = Scheduler(workers)
+      self.pool = ConnectionPool()
+      self.cookies = http.cookiejar.LWPCookieJar()
+      if handlers is None:
+         handlers = [KeepAliveHTTPHandler(self.pool), KeepAliveHTTPSHandler(self.pool)]
       opener = urllib.request.build_opener(
          urllib.request.HTTPRedirectHandler(),
-         urllib.request.HTTPHandler(debuglevel=1),
-         urllib.request.HTTPSHandler(debuglevel=1),
-         urllib.request.HTTPCookieProcessor()
+         *handlers,
+         urllib.request.HTTPCookieProcessor(self.cookies)
       )
       opener.addheaders = [
          ('User-agent', ('learnit.py'))
       ]
-      self.opener = LoggingOpener(opener)
+      if cache is None:
+         cache = ResponseCache()
+      self.opener = LoggingOpener(opener, cache or None, log)
+
+   def close(self):
+      ''' Stop the worker threads, close the idle connections and the log '''
+      self.scheduler.shutdown()
+      self.pool.close()
+      if self.opener.log:
+         self.opener.log.close()
+
+   def resume_session(self, path):
+      ''' Reuse the session saved to path by save_session, if it is still
+          valid. Returns the same as login, or (None, SESSION_EXPIRED). '''
+      if not load_cookies(self.cookies, path):
+         return None, SESSION_EXPIRED
+      try:
+         data, response = self.opener.open('https://learnit.itu.dk/my/')
+      except urllib.error.URLError:
+         return None, SESSION_EXPIRED
+      if response.geturl() != 'https://learnit.itu.dk/my/':
+         self.cookies.clear()
+         return None, SESSION_EXPIRED
+      return data, SUCCESS
+
+   def save_session(self, path):
+      ''' Save the cookies of the logged in session, for resume_session '''
+      save_cookies(self.cookies, path)
 
    def login(self, email, password):
       ''' Log in to learnit and return the response for 'learnit.itu.dk/my' '''
@@ -149,81 +398,39 @@ class Learnit:
 
    def list_assignments(self, course_id):
       data, _ = self.opener.open('{}{}'.format(course_view, course_id))
-      regex = r'<li class="activity assign modtype_assign " id="module-(\d+)">' +\
-            r'.*?<span class="instancename">(.*?)</?span'
-      return {name:title for name,title in re.findall(regex, data)}
+      return parse_assignments(data)
 
    def list_submissions(self, assign_id):
       ''' Returns a dictionary of group_id -> Row object '''
-      cache_name = '.'+assign_id+'.cached'
-      if os.path.exists(cache_name):
-         with open(cache_name) as f:
-            data = f.read()
-      else:
-         data, _ = self.opener.open(assign_view.format(assign_id, 'grading', '0'))
-         with open(cache_name, 'w') as f:
-            f.write(data)
+      data, _ = self.opener.open(assign_view.format(assign_id, 'grading', '0'))
       if not 'Group submission status' in data:
          print('Warning: Groups appear to be disabled for assignment ' + assign_id + '. ' +
                'This may cause learnit- to fail.')
-      subs = {}
-      for row, dat in re.findall(r'<tr[^<>]+?id="mod_assign_grading_r(\d+)"(.*?)</tr>', data, re.DOTALL):
-         match = re.search(r'>Group (.+?)<', dat)
-         group = match.group(1) if match else 'Default group'
-         match = re.search(r'selected">(.*?)</option>', dat)
-         grade = name_to_grade[match.group(1).lower()] if match else NO_GRADE
-         match = re.search(r'_c6">(.*?)</td>', dat)
-         substat = name_to_substat[match.group(1).lower()]
-         match = re.search(r'_c3">(.*?)</td>', dat)
-         email = match.group(1) if match else 'Unknown'
-         match = re.search(r'_c2"><a.*?>(.*?)</a></td>', dat)
-         name = match.group(1) if match else 'Unknown'
-         match = re.search(r'id="selectuser_(\d+)"', dat)
-         studid = match.group(1) if match else 'Unknown'
-         if group not in subs:
-            subs[group] = Row(row, grade, substat, [email], [name], [studid])
-         else:
-            subs[group].emails.append(email)
-            subs[group].names.append(name)
-            subs[group].studids.append(studid)
-      return subs
+      return parse_submissions(data)
 
    def show_submission(self, assign_id, row):
       data, _ = self.opener.open(save_grade.format(assign_id, row))
-      form = FormParser().feed(data)
-      if 'Nothing has been submitted for this assignment' in data:
-         return Submission(form, NO_SUBMIT, 'Not graded', 'Unknown', [], NO_GRADE, '', [], None, None)
-      match = re.search(r'M\.core_comment\.init\(Y, ({.*?})', data)
-      com_json = json.loads(match.group(1))
-      # Comments
-      context_id = com_json['contextid']
-      match = re.search(r'>Comments \((\d+)\)<', data)
-      comments = self.__show_comments(form.data['sesskey'], com_json) if match and match.group(1) != '0' else []
-      # Status
-      match = re.search('>Submission status</td>.+?>(.*?)</td>', data, re.DOTALL)
-      sub_status = name_to_substat[match.group(1).lower()]
-      match = re.search('>Grading status</td>.+?>(.*?)</td>', data, re.DOTALL)
-      grad_status = match.group(1) if match else 'Unknown'
-      match = re.search('>Last modified</td>.+?>(.*?)</td>', data, re.DOTALL)
-      last_mod = match.group(1) if match else 'Unknown'
-      # Files
-      file_url = regsafe(sub_file.format(context_id))
-      files = re.findall(r'href="{}(.*?)"'.format(file_url), data)
-      # Grade and feedback
-      gradeurl = 'https://learnit.itu.dk/grade/report/grader/index.php'
-      match = re.search(r'<a href="{}.*?>(.*?)</a>'.format(regsafe(gradeurl)), data)
-      grade = name_to_grade[match.group(1).lower()]
-      match = re.search(r'<textarea id="id_assignfeedbackcomments_editor.*?>(.*?)</textarea>', data, re.DOTALL)
-      feedback = html.unescape(match.group(1) if match else '').replace('<br>','\n')
-      # Figure out grade_to_code table
-      grade_to_code = {}
-      select = re.search('<select name="grade".*?</select>', data, re.DOTALL).group(0)
-      for code, text in re.findall('<option value="([\-\d]+)".*?>(.+?)</option>', select):
-         grade_to_code[name_to_grade[text.lower()]] = code
-      return Submission(form, sub_status, grad_status, last_mod, files, grade, feedback, comments, context_id, grade_to_code)
+      sub, com_json = parse_submission(data)
+      if com_json is not None:
+         sub = sub._replace(comments=self.__show_comments(sub.form.data['sesskey'], com_json))
+      return sub
+
+   def show_submissions(self, assign_id, rows=None, workers=8, rate=None, priority=None):
+      ''' Fetch the submissions of the given row numbers, or of every row of
+          the assignment, with up to workers requests at a time queued at
+          priority, by default the caller's, on the client's scheduler, and
+          at most rate submissions
+          started per second.
+          Yields (row, Submission) in the order the fetches complete. '''
+      if rows is None:
+         rows = [row.row for row in self.list_submissions(assign_id).values()]
+      limiter = RateLimiter(rate)
+      def fetch(row):
+         limiter.wait()
+         return row, self.show_submission(assign_id, row)
+      yield from self.scheduler.imap_unordered(fetch, rows, priority, limit=workers)
 
    def download_attachments(self, context_id, filenames):
-      clean_name = lambda s: re.sub('[^\w\d\.]', '_', re.sub('\?.*|.*/', '', s))
       for filename in filenames:
          data, _ = self.opener.open(sub_file.format(context_id) + filename, binary=True)
          name = clean_name(filename)
@@ -237,61 +444,145 @@ class Learnit:
          else:
             yield Attachment(name, data)
 
+   def spool_attachments(self, context_id, filenames, spool_dir, workers=4, priority=None):
+      ''' Like download_attachments, but streams the files into spool_dir
+          instead of memory, with up to workers downloads at a time queued at
+          priority, by default the caller's, on the client's scheduler. Zip files are extracted next to
+          them, keeping their folders. A file is spooled to a path made from
+          its whole url, item id included, so files already in spool_dir are
+          only reused for the same file of the same submission.
+          Yields SpooledAttachment in the order the downloads complete. '''
+      def spool(filename):
+         name = clean_name(filename)
+         path = os.path.join(spool_dir, str(context_id), *clean_path(filename).split('/'))
+         if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.opener.download(sub_file.format(context_id) + filename, path)
+         if not name.endswith('.zip'):
+            return [SpooledAttachment(name, path)]
+         attachments = []
+         with zipfile.ZipFile(path) as zf:
+            for zname in zf.namelist():
+               member_name = clean_path(zname)
+               if zname.endswith('/') or not member_name:
+                  continue
+               member = SpooledAttachment(member_name, os.path.join(path + '_files', *member_name.split('/')))
+               if not os.path.exists(member.path):
+                  # Extracted to a temporary file first, so a file that is
+                  # there is always whole
+                  os.makedirs(os.path.dirname(member.path), exist_ok=True)
+                  with zf.open(zname) as src, open(member.path + '.part', 'wb') as dst:
+                     shutil.copyfileobj(src, dst)
+                  os.replace(member.path + '.part', member.path)
+               attachments.append(member)
+         return attachments
+      for attachments in self.scheduler.imap_unordered(spool, filenames, priority, limit=workers):
+         yield from attachments
+
    def __show_comments(self, sesskey, com_json):
-      com_data = urlencode({
-         'sesskey': sesskey,
-         'action': 'get',
-         'client_id': com_json['client_id'],
-         'itemid': com_json['itemid'],
-         'area': 'submission_comments',
-         'courseid': com_json['courseid'],
-         'contextid': com_json['contextid'],
-         'component': 'assignsubmission_comments',
-         'page': '0'
-      }).encode('utf-8')
-      data, _ = self.opener.open(page_comment_ajax, data=com_data)
+      data, _ = self.opener.open(page_comment_ajax, data=comments_data(sesskey, com_json))
       return json.loads(data)['list']
 
    def save_grade(self, assign_id, row, form, grade, feedback, grade_to_code):
-      submit_data = urlencode({
-         'mform_isexpanded_id_header_comments': '1',
-         'mform_isexpanded_id_header_editpdf': '1',
-         'id': assign_id,
-         'rownum': row,
-         'useridlistid': form.data['useridlistid'],
-         'attemptnumber': form.data['attemptnumber'],
-         'ajax': '0',
-         'action': 'submitgrade',
-         'sesskey': form.data['sesskey'],
-         '_qf__mod_assign_grade_form_'+row: '1',
-         'grade': grade_to_code[grade],
-         'assignfeedbackcomments_editor[text]': feedback.replace('\n','<br>'),
-         'assignfeedbackcomments_editor[format]': '1',
-         'applytoall': '1',
-         'savegrade': 'Save changes'
-      }).encode('utf-8')
-      data, _ = self.opener.open(form.action, data=submit_data)
+      er = self.__post_grade(assign_id, row, form, grade, feedback, grade_to_code)
+      self.forget_assignment(assign_id)
+      return er
+
+   def __post_grade(self, assign_id, row, form, grade, feedback, grade_to_code):
+      data, _ = self.opener.open(form.action,
+         data=grade_data(assign_id, row, form, grade, feedback, grade_to_code))
       if 'The grade changes were saved' in data:
          return SUCCESS
-      return UKNOWN_ERROR
-
-   def get_log(self, courseid, assignid):
-      get_data = urlencode({
-         'chooselog': '1',
-         'showusers': '1',
-         'showcourses': '0',
-         'id': courseid,
-         'group': '',
-         'user': '',
-         'date': '0',
-         'modid': assignid,
-         'modaction': '-view',
-         'logformat': 'downloadascsv'
-      })
-      data, _ = self.opener.open(page_log + '?' + get_data)
-      rows = list(csv.reader(io.StringIO(data), dialect='excel-tab'))
-      assert rows[1] == ['Course', 'Time', 'IP address', 'User full name', 'Action', 'Information']
-      for _, time, _, grader, action, info in rows[2:]:
-         if re.match(r'assign grade submission \(.+\)$', action):
-            studid = re.match(r'Grade student: \(id=(\d+), fullname=.+\)\.', info).group(1)
-            yield GradeAction(dateutil.parser.parse(time), grader, studid)
+      return UNKNOWN_ERROR
+
+   def save_grades(self, records, workers=4, retries=2, rate=None, priority=BACKGROUND):
+      ''' Save a GradeRecord for each of records, with up to workers of them
+          at a time queued at priority on the client's scheduler, and at most
+          rate saves started per second. Every group's
+          grading form is fetched fresh for its sesskey and grade codes, and
+          a group that already has the grade and feedback is left alone, so
+          running the same records twice saves nothing the second time. A
+          failed save is retried up to retries times, checking the form again
+          first. An empty feedback keeps the feedback there is. When a group
+          has more than one record, the last one counts. Any other error
+          fails only the record it happened on.
+          Yields a GradeResult per record, in the order they complete. '''
+      records = list(records)
+      last = {(r.assignment, r.group.upper()): r for r in records}
+      for record in records:
+         if last[record.assignment, record.group.upper()] is not record:
+            yield GradeResult(record, 'skipped', 0, 'Overridden by line {}'.format(
+               last[record.assignment, record.group.upper()].line))
+      aids = sorted(set(record.assignment for record in last.values()))
+      def submissions(aid):
+         try:
+            return self.list_submissions(aid)
+         except Exception as err:
+            return err
+      tables = dict(zip(aids, self.scheduler.map(submissions, aids, priority)))
+      limiter = RateLimiter(rate)
+      def save(record):
+         grade = name_to_grade.get(record.grade.strip().lower())
+         if grade is None:
+            return GradeResult(record, 'failed', 0, 'Unknown grade {!r}'.format(record.grade))
+         rows = tables[record.assignment]
+         if isinstance(rows, Exception):
+            return GradeResult(record, 'failed', 0, 'Could not list the submissions: {}'.format(error_message(rows)))
+         row = rows.get(record.group) or rows.get(record.group.upper())
+         if row is None:
+            return GradeResult(record, 'failed', 0, 'No group {!r}'.format(record.group))
+         message = ''
+         for attempt in range(retries + 1):
+            try:
+               sub = self.show_submission(record.assignment, row.row)
+               if sub.sub_status != HAS_SUBMIT:
+                  return GradeResult(record, 'failed', attempt, 'Nothing has been submitted')
+               feedback = record.feedback or sub.feedback
+               if sub.grade == grade and sub.feedback == feedback:
+                  return GradeResult(record, 'saved' if attempt else 'unchanged', attempt, '')
+               limiter.wait()
+               if self.__post_grade(record.assignment, row.row, sub.form, grade,
+                     feedback, sub.grade_to_code) == SUCCESS:
+                  return GradeResult(record, 'saved', attempt + 1, '')
+               message = 'The grade changes were not saved'
+            except (urllib.error.URLError, http.client.HTTPException, OSError) as err:
+               message = str(err)
+            except Exception as err:
+               return GradeResult(record, 'failed', attempt + 1, error_message(err))
+         return GradeResult(record, 'failed', retries + 1, message)
+      try:
+         yield from self.scheduler.imap_unordered(save, last.values(), priority, limit=workers)
+      finally:
+         for aid in aids:
+            self.forget_assignment(aid)
+
+   def forget_assignment(self, assign_id):
+      ''' Drop the cached grading pages of an assignment '''
+      if self.opener.cache:
+         self.opener.cache.invalidate(r'/mod/assign/view\.php\?id={}&'.format(assign_id))
+
+   def forget_course(self, courseid):
+      ''' Drop the cached course pages and log of a course '''
+      if self.opener.cache:
+         self.opener.cache.invalidate(r'[?&]id={}(&|$)'.format(courseid))
+
+   def get_log(self, courseid, assignid, refresh=False):
+      for _, action in parse_log(self.__get_log_csv(courseid, assignid, refresh)):
+         yield action
+
+   def get_course_log(self, courseid):
+      ''' -> CourseLog of the gradings in every assignment of the course,
+          from a single download of the log '''
+      return CourseLog(parse_log(self.__get_log_csv(courseid, '')))
+
+   def update_course_log(self, log, courseid, assignid):
+      ''' -> log with the gradings of one assignment fetched again, after a
+          grade has been saved in it. The cached log of the whole course is
+          dropped, as it is stale now. '''
+      if self.opener.cache:
+         self.opener.cache.invalidate(re.escape(log_csv_url(courseid, '')) + '$')
+      return log.replaced(assignid, list(self.get_log(courseid, assignid, refresh=True)))
+
+   def __get_log_csv(self, courseid, modid, refresh=False):
+      data, _ = self.opener.open(log_csv_url(courseid, modid), refresh=refresh)
+      return data
@@ -1,11 +1,12 @@
-import urllib.request
+import urllib.request, urllib.error, http.cookiejar
 from urllib.parse import urlparse, parse_qs, urlencode
 from html.parser import HTMLParser
-from collections import namedtuple
-import re, zipfile, os, io, json, html, csv
-from multiprocessing.pool import ThreadPool
-import dateutil.parser
-import logging
+from collections import namedtuple, defaultdict, Counter
+import re, zipfile, os, io, json, html, csv, itertools, threading
+from time import perf_counter
+from learnit_http import LoggingOpener, ResponseCache, \
+   ConnectionPool, KeepAliveHTTPHandler, KeepAliveHTTPSHandler, save_cookies, load_cookies, \
+   stats, timed, TimedIterator, parse_time, parse_times, Scheduler, INTERACTIVE
 import pickle
 
 # Types
@@ -84,11 +85,25 @@ Comment = namedtuple('Comment', [
    'person', # Person
 ])
 
-SUCCESS, INVALID_PASSWORD, UNKNOWN_ERROR, WAYF_REDIRECT = range(4)
+SUCCESS, INVALID_PASSWORD, UNKNOWN_ERROR, WAYF_REDIRECT, SESSION_EXPIRED = range(5)
 NO_GRADE, APPROVED, NOT_APPROVED, NO_SUBMISSION = range(4)
 ROLE_STUDENT, ROLE_TEACHER, ROLE_TA, ROLE_ALL = 5, 3, 9, 0
 grade_to_name = {NO_GRADE: 'Pending', APPROVED: 'Approved', NOT_APPROVED: 'Not approved', NO_SUBMISSION: 'No submission'}
+LOG_GRADE, LOG_SUBMIT = range(2)
 ITU = 'https://learnit.itu.dk'
+LOG_PAGE_SIZE = 500
+LOG_SYNC_PAGE_SIZE = 50
+PERSON_PAGE_SIZE = 1000
+person_table_url = ITU+'/user/index.php?mode=1&perpage={}&page={}&roleid={}&id={}'
+log_page_url = ITU+'/report/log/index.php?chooselog=1&modaction=-view&logformat=showashtml&perpage={}&page={}&id={}'
+
+participant_count_regex = re.compile(r'(\d+) participants|All participants: (\d+)')
+log_row_regex = re.compile(r'<tr class="r[01]".*?>(.*?)</tr>', re.DOTALL)
+log_time_regex = re.compile(r'cell c0".*?>(.*?)</td>')
+log_user_regex = re.compile(r'/user/view.php\?id=(\d+)')
+log_action_regex = re.compile(r'cell c3".*?>.*?<a.*?>(.*?)</a>')
+log_assign_regex = re.compile(r'/assign/view.php\?id=(\d+)')
+log_grade_regex = re.compile(r'Grade student: \(id=(\d+), fullname=.+\)\. (.*?)\.')
 
 class FormParser(HTMLParser):
    def __init__(self):
@@ -105,38 +120,355 @@ class FormParser(HTMLParser):
       HTMLParser.feed(self, data)
       return self
 
-class LoggingOpener:
-   def __init__(self, opener):
-      self.opener = opener
-      self.logger = logging.getLogger('weblogger')
-      self.logger.setLevel(logging.DEBUG)
-      self.logger.addHandler(logging.FileHandler('log'))
-   def open(self, url, data=None, binary=False):
-      self.logger.debug('Requesting ' + url)
-      if data:
-         self.logger.debug('Data ' + data.decode('utf-8'))
-      resp = self.opener.open(url, data)
-      self.logger.debug('Reponse headers: ' + repr(resp.getheaders()))
-      payload = resp.read()
-      if not binary:
-         payload = payload.decode('utf-8')
-         self.logger.debug('Response payload: ' + payload)
-      else:
-         self.logger.debug('Binary response')
-      return payload, resp
+class TableIndex:
+   ''' Dictionary indexes over the shallow tables, used to attach log actions
+       to teachers, students and submissions in constant time. '''
+   def __init__(self, students, teachers, submissions):
+      self.students = defaultdict(list) # pid -> [Student]
+      for student in students:
+         self.students[student.person.id].append(student)
+      self.teachers = defaultdict(list) # pid -> [Teacher]
+      for teacher in teachers:
+         self.teachers[teacher.person.id].append(teacher)
+      self.submissions = defaultdict(list) # (aid, group name) -> [(i, Submission)]
+      for i, submission in enumerate(submissions):
+         self.submissions[submission.assignment.id, submission.group.name].append((i, submission))
+
+   def grade_actions(self, time, pid0, aid, pid1, grade):
+      ''' (time, pid0, aid, pid1, grade) -> [GradeAction] '''
+      matches = sorted((i, j, submission)
+         for j, student in enumerate(self.students.get(pid1, ()))
+         for i, submission in self.submissions.get((aid, student.group.name), ()))
+      return [GradeAction(time, grade, teacher, submission)
+         for teacher in self.teachers.get(pid0, ())
+         for _, _, submission in matches]
+
+   def submit_actions(self, time, pid0, aid):
+      ''' (time, pid0, aid) -> [SubmitAction] '''
+      return [SubmitAction(time, student, submission)
+         for student in self.students.get(pid0, ())
+         for _, submission in self.submissions.get((aid, student.group.name), ())]
+
+@timed('join tables')
+def join_tables(asss, gros, pers, studs, log):
+   ''' Join the raw course tables and an iterable of log events into Tables,
+       in time linear in their size. The log is consumed one event at a time. '''
+   # Create shallow tables
+   default_group = Group('No group', [], [])
+   groups = [Group(name, [], [])
+      for name, pids in gros if pids] \
+      + [default_group]
+   persons = [Person(pid, name, email, icon, last_access)
+      for pid, icon, name, email, last_access in pers]
+   person_rows = defaultdict(list) # pid -> [index in persons]
+   for i, person in enumerate(persons):
+      person_rows[person.id].append(i)
+   members = defaultdict(list) # group name -> [[pid]]
+   for name, pids in gros:
+      members[name].append(pids)
+   students = [Student(persons[i], group, [])
+      for group in groups
+      for pids in members.get(group.name, ())
+      for i in sorted(i for pid in set(pids) for i in person_rows.get(pid, ()))]
+   grouped = set(student.person for student in students)
+   student_pids = Counter(pid for pid, _, _, _, _ in studs)
+   students += [Student(person, default_group, [])
+      for person in persons if person not in grouped
+      for _ in range(student_pids[person.id])]
+   enrolled = set(student.person for student in students)
+   teachers = [Teacher(person, [])
+      for person in persons if person not in enrolled]
+   assignments = [Assignment(aid, title, [])
+      for aid, title in asss]
+   # We need the students sorted by pid to find the submission row
+   students.sort()
+   first_rows = {} # group name -> row of its first student
+   for i, student in enumerate(students):
+      first_rows.setdefault(student.group.name, i)
+   submissions = [Submission(first_rows[group.name], group, assignment, [], [])
+      for group in groups
+      for assignment in assignments]
+   # Inflate 1-n lists
+   for student in students:
+      student.group.students.append(student)
+   for submission in submissions:
+      submission.assignment.submissions.append(submission)
+      submission.group.submissions.append(submission)
+   tables = Tables(groups, assignments, teachers, students, submissions)
+   merge_log(tables, log)
+   return tables
+
+def merge_log(tables, log, since=None, unresolved=None):
+   ''' Attach the actions from an iterable of log events, newest first, to
+       tables, keeping every action list newest first. Events older than since
+       are ignored. The log only has minute resolution, so events from the
+       same minute as since are attached unless tables already has them.
+       Events newer than since that match no teacher, student or submission
+       of tables are appended to the list unresolved, if given. Those of the
+       minute of since were seen by the sync before.
+       Returns the time of the newest event seen. '''
+   start = perf_counter()
+   log = TimedIterator(log) # Reading the log is timed where it is fetched and parsed
+   index = TableIndex(tables.students, tables.teachers, tables.submissions)
+   known = Counter()
+   if since is not None:
+      for submission in tables.submissions:
+         known.update((ga.time, ga.grade, id(ga.teacher), id(submission))
+            for ga in submission.grade_actions if ga.time == since)
+         known.update((sa.time, id(sa.student), id(submission))
+            for sa in submission.submit_actions if sa.time == since)
+   old_lengths = {} # id(list) -> (list, length before the merge)
+   def attach(actions, action):
+      if id(actions) not in old_lengths:
+         old_lengths[id(actions)] = (actions, len(actions))
+      actions.append(action)
+   newest = since
+   for kind, row in log:
+      time = row[0]
+      if since is not None and time < since:
+         continue
+      if newest is None or time > newest:
+         newest = time
+      actions = index.grade_actions(*row) if kind == LOG_GRADE else index.submit_actions(*row)
+      if not actions and unresolved is not None and (since is None or time > since):
+         unresolved.append((kind, row))
+      if kind == LOG_GRADE:
+         for grade_action in actions:
+            key = (time, grade_action.grade, id(grade_action.teacher), id(grade_action.submission))
+            if known[key]:
+               known[key] -= 1
+               continue
+            attach(grade_action.teacher.grade_actions, grade_action)
+            attach(grade_action.submission.grade_actions, grade_action)
+      if kind == LOG_SUBMIT:
+         for submit_action in actions:
+            key = (time, id(submit_action.student), id(submit_action.submission))
+            if known[key]:
+               known[key] -= 1
+               continue
+            attach(submit_action.student.submit_actions, submit_action)
+            attach(submit_action.submission.submit_actions, submit_action)
+   # The new actions are newer than the old ones, so move them to the front
+   for actions, length in old_lengths.values():
+      if length:
+         actions[:] = actions[length:] + actions[:length]
+   stats.timing('merge log', perf_counter() - start - log.seconds)
+   return newest
+
+class LazyTables:
+   ''' The sections of a course's tables, each fetched once on the client's
+       scheduler when it is first asked for, so a command only pays for what
+       it uses. The sections are the raw 'assignments', 'groups', 'persons'
+       and 'students' tables, and 'tables', the (Tables, newest log time) of
+       sync_tables, which fetches the log. '''
+   def __init__(self, scheduler, sections):
+      self.scheduler = scheduler
+      self.sections = sections # name -> function fetching the section
+      self.futures = {} # name -> Future of the section
+      self.lock = threading.RLock()
+
+   def load(self, priority=INTERACTIVE):
+      ''' Queue the sections that have not been asked for yet, in order '''
+      with self.lock:
+         for name, fun in self.sections.items():
+            if name not in self.futures:
+               self.futures[name] = self.scheduler.submit(fun, priority=priority)
+      return self
+
+   def done(self, name):
+      with self.lock:
+         return name in self.futures and self.futures[name].done()
+
+   def get(self, name):
+      ''' -> the section, moved ahead of background work if it is queued '''
+      with self.lock:
+         future = self.futures[name] = self.scheduler.urgent(self.futures.get(name), self.sections[name])
+      return future.result()
+
+def parse_profile(data):
+   ''' Dashboard page -> (Person logged in, [Course]) '''
+   regex = r'user/profile\.php\?id=(\d+)"><em><i class="fa fa-user"></i>(.*?)</em>'
+   pid, name = re.search(regex, data).groups()
+   person = Person(pid, name, None, None, None)
+   regex = r'<li>\s*<a title=".*?" href=".*?course/view\.php\?id=(\d+)">(.*?)</a>'
+   courses = [Course(id=cid, title=title) for cid,title in re.findall(regex, data)]
+   return person, courses
+
+@timed('parse course view')
+def parse_assignment_table(data):
+   ''' Course page -> [(aid, title)] '''
+   regex = r'<li class=".*?assign " id="module-(\d+)">.*?<span.*?>(.*?)<'
+   return re.findall(regex, data, re.DOTALL)
+
+@timed('parse group overview')
+def parse_group_table(data):
+   ''' Group overview page -> [(group_name, [pid])] '''
+   groups = []
+   regex = r'<tr.*?<td.*?>(.*?)</td>.*?<td.*?>(.*?)</td>'
+   for group_name, students in re.findall(regex, data, re.DOTALL):
+      regex = r'<a href=".*?id=(\d+)'
+      pids = re.findall(regex, students)
+      groups.append((group_name, pids))
+   return groups
+
+@timed('parse user index')
+def parse_person_table(data):
+   ''' User index page -> [(pid, icon, name, email, last_access)] '''
+   persons = []
+   regex = r'<table class="userinfobox">(.*?)</table>'
+   for row in re.findall(regex, data, re.DOTALL):
+      try:
+         pid = re.search(r'user/view\.php\?id=(\d+)', row).group(1)
+         icon = None
+         name = re.search(r'<div class="username">(.*?)</div>', row).group(1)
+         email = re.search(r'href="mailto:(.*?)"', row).group(1)
+         last_access = re.search(r'Last access: ([\w\d\s,:]+)', row).group(1)
+         if last_access == 'Never':
+            last_access = 0
+         else: last_access = parse_time(last_access)
+         persons.append((pid, icon, name, email, last_access))
+      except AttributeError as err:
+         print(row)
+         raise
+   return persons
+
+def parse_participant_count(data):
+   ''' User index page -> number of participants on all its pages, or None '''
+   match = participant_count_regex.search(data)
+   return int(match.group(1) or match.group(2)) if match else None
+
+def parse_log_page(data):
+   ''' Log report page -> [(time, event or None)] for each row '''
+   return [parsed for _, parsed in parse_log_rows(data)]
+
+@timed('parse log rows')
+def parse_log_rows(data):
+   ''' Log report page -> [(row html, (time, event or None))] for each row.
+       The times of the page are parsed together, as most of them repeat. '''
+   rows = log_row_regex.findall(data)
+   times = parse_times([log_time(row) for row in rows])
+   return [(row, parse_log_row(row, time)) for row, time in zip(rows, times)]
+
+class LogPageReader:
+   ''' Reads the events of the pages of the log report, given one after
+       another from page 0. The pages are offset into a newest first log, so
+       actions logged between two page fetches push rows already read onto
+       the next page. Those are the rows newer than the last minute of the
+       page before, or of that minute and equal to a row read in it, and are
+       skipped. done is set after the last page, or a row older than since. '''
+   def __init__(self, perpage, since=None):
+      self.perpage = perpage
+      self.since = since
+      self.done = False
+      self.last = None # Time of the last row read
+      self.seen = Counter() # Rows of that time read
+
+   def events(self, data):
+      ''' Log report page -> [event] of its new rows '''
+      rows = parse_log_rows(data)
+      events = []
+      repeated = Counter(self.seen)
+      for row, (time, event) in rows:
+         if self.last is not None and time > self.last:
+            continue
+         if time == self.last and repeated[row] > 0:
+            repeated[row] -= 1
+            continue
+         if self.since is not None and time < self.since:
+            self.done = True
+            return events
+         if time != self.last:
+            self.last = time
+            self.seen.clear()
+         self.seen[row] += 1
+         if event is not None:
+            events.append(event)
+      self.done = len(rows) < self.perpage
+      return events
+
+def log_time(row):
+   match = log_time_regex.search(row)
+   if match is None:
+      print(row)
+      raise AttributeError('No time')
+   return match.group(1)
+
+def parse_log_row(row, time):
+   try:
+      pid0 = log_user_regex.search(row).group(1)
+      action = log_action_regex.search(row).group(1)
+      if action == 'assign grade submission':
+         aid = log_assign_regex.search(row).group(1)
+         pid1, grade_str = log_grade_regex.search(row).groups()
+         grade = parse_grade(grade_str)
+         return time, (LOG_GRADE, (time, pid0, aid, pid1, grade))
+      if action == 'assign submit':
+         aid = log_assign_regex.search(row).group(1)
+         if not ('Submitted for grading' in row or 'Afleveret til' in row):
+            raise AttributeError('Bad status')
+         return time, (LOG_SUBMIT, (time, pid0, aid))
+      return time, None
+   except AttributeError as err:
+      print(row)
+      raise
+
+def parse_grade(grade_str):
+   if 'not approved' in grade_str.lower():
+      return NOT_APPROVED
+   if 'approved' in grade_str.lower():
+      return APPROVED
+   if 'no grade' in grade_str.lower() or '-' in grade_str.lower():
+      return NO_GRADE
+   raise AttributeError('Bad grade '+grade_str)
 
 class Learnit:
-   def __init__(self):
+   def __init__(self, handlers=None, cache=None, workers=8, log=None):
+      ''' handlers replace the urllib handlers that open requests on pooled
+          keep-alive connections, to record or replay traffic. cache is the
+          ResponseCache to use instead of the default one, or False for none.
+          workers is the number of threads of the client's Scheduler. log is
+          the RequestLog to log requests to, none are logged without it. '''
+      self.scheduler = Scheduler(workers)
+      self.pool = ConnectionPool()
+      self.cookies = http.cookiejar.LWPCookieJar()
+      if handlers is None:
+         handlers = [KeepAliveHTTPHandler(self.pool), KeepAliveHTTPSHandler(self.pool)]
       opener = urllib.request.build_opener(
          urllib.request.HTTPRedirectHandler(),
-         urllib.request.HTTPHandler(debuglevel=1),
-         urllib.request.HTTPSHandler(debuglevel=1),
-         urllib.request.HTTPCookieProcessor()
+         *handlers,
+         urllib.request.HTTPCookieProcessor(self.cookies)
       )
       opener.addheaders = [
          ('User-agent', ('learnit.py'))
       ]
-      self.opener = LoggingOpener(opener)
+      if cache is None:
+         cache = ResponseCache()
+      self.opener = LoggingOpener(opener, cache or None, log)
+
+   def close(self):
+      ''' Stop the worker threads, close the idle connections and the log '''
+      self.scheduler.shutdown()
+      self.pool.close()
+      if self.opener.log:
+         self.opener.log.close()
+
+   def resume_session(self, path):
+      ''' Reuse the session saved to path by save_session, if it is still
+          valid. Returns the same as login, or (None, SESSION_EXPIRED). '''
+      if not load_cookies(self.cookies, path):
+         return None, SESSION_EXPIRED
+      try:
+         data, response = self.opener.open('https://learnit.itu.dk/my/')
+      except urllib.error.URLError:
+         return None, SESSION_EXPIRED
+      if response.geturl() != 'https://learnit.itu.dk/my/':
+         self.cookies.clear()
+         return None, SESSION_EXPIRED
+      return parse_profile(data), SUCCESS
+
+   def save_session(self, path):
+      ''' Save the cookies of the logged in session, for resume_session '''
+      save_cookies(self.cookies, path)
 
    def login(self, email, password):
       ''' Log in to learnit and return the response for 'learnit.itu.dk/my' '''
@@ -176,146 +508,97 @@ class Learnit:
       data, response = self.opener.open(parser.action, data=saml_data)
       
       assert response.geturl() == 'https://learnit.itu.dk/my/'
-      return self.__get_profile(data), SUCCESS
-
-   def __get_profile(self, data):
-      regex = r'<em><i class="fa fa-user"></i>(.*?)</em>'
-      pid, name = re.search(regex, data).groups()
-      person = Person(pid, name, None, None, None)
-      regex = r'<li>\s*<a title=".*?" href=".*?course/view\.php\?id=(\d+)">(.*?)</a>'
-      courses = [Course(id=cid, title=title) for cid,title in re.findall(regex, data)]
-      return person, courses
+      return parse_profile(data), SUCCESS
 
    def get_tables(self, cid):
-      asss, gros, pers, studs, (gras, subs) = \
-            ThreadPool().map(lambda f: f(cid), [
-         self.__get_assignment_table,
-         self.__get_group_table,
-         lambda cid_: self.__get_person_table(cid_, ROLE_ALL),
-         lambda cid_: self.__get_person_table(cid_, ROLE_STUDENT),
-         self.__get_log_table])
-      # Create shallow tables
-      default_group = Group('No group', [], [])
-      groups = [Group(name, [], [])
-         for name, pids in gros if pids] \
-         + [default_group]
-      persons = [Person(pid, name, email, icon, last_access)
-         for pid, icon, name, email, last_access in pers]
-      students = [Student(person, group, [])
-         for group in groups
-         for name, pids in gros if group.name == name
-         for person in persons if person.id in pids]
-      students += [Student(person, default_group, [])
-         for person in persons if not any(
-            student.person == person for student in students)
-         for pid, _, _, _, _ in studs if pid == person.id]
-      teachers = [Teacher(person, [])
-         for person in persons if not any(
-            student.person == person for student in students)]
-      assignments = [Assignment(aid, title, [])
-         for aid, title in asss]
-      # We need the students sorted by pid to find the submission row
-      students.sort()
-      submissions = [Submission(row, group, assignment, [], [])
-         for group in groups
-         for assignment in assignments
-         for row in [min(i for i, student in enumerate(students) if student.group == group)]]
-      grade_actions = [GradeAction(time, grade, teacher, submission)
-         for time, pid0, aid, pid1, grade in gras
-         for teacher in teachers if teacher.person.id == pid0
-         for submission in submissions if submission.assignment.id == aid
-         for student in students if student.person.id == pid1 and student.group == submission.group]
-      submit_actions = [SubmitAction(time, student, submission)
-         for time, pid0, aid in subs
-         for student in students if student.person.id == pid0
-         for submission in submissions if submission.assignment.id == aid and student.group == submission.group]
-      # Inflate 1-n lists
-      for student in students:
-         student.group.students.append(student)
-      for submission in submissions:
-         submission.assignment.submissions.append(submission)
-         submission.group.submissions.append(submission)
-      for grade_action in grade_actions:
-         grade_action.teacher.grade_actions.append(grade_action)
-         grade_action.submission.grade_actions.append(grade_action)
-      for submit_action in submit_actions:
-         submit_action.student.submit_actions.append(submit_action)
-         submit_action.submission.submit_actions.append(submit_action)
-      return Tables(groups, assignments, teachers, students, submissions)
+      tables, _ = self.sync_tables(cid)
+      return tables
+
+   def sync_tables(self, cid, tables=None, since=None):
+      ''' Fetch the tables for a course and return (tables, newest log time).
+          Given tables and the newest log time they were synced to, only the
+          newer log entries are fetched and merged into them instead, unless
+          some of them refer to what tables does not have. '''
+      if tables is not None and since is not None:
+         log = self.get_log(cid, since=since, perpage=LOG_SYNC_PAGE_SIZE)
+         unresolved = []
+         newest = merge_log(tables, log, since, unresolved)
+         if not unresolved:
+            return tables, newest
+         # The new events refer to assignments, groups or persons that are
+         # new since tables were fetched, so everything is fetched again
+         self.forget_course(cid)
+      return self.lazy_tables(cid).load().get('tables')
+
+   def lazy_tables(self, cid):
+      ''' -> LazyTables of a course, with nothing fetched yet '''
+      lazy = LazyTables(self.scheduler, {
+         'assignments': lambda: self.__get_assignment_table(cid),
+         'groups': lambda: self.__get_group_table(cid),
+         'persons': lambda: self.__get_person_table(cid, ROLE_ALL),
+         'students': lambda: self.__get_person_table(cid, ROLE_STUDENT),
+         'tables': lambda: self.__join_tables(cid, lazy),
+      })
+      return lazy
+
+   def __join_tables(self, cid, lazy):
+      ''' -> (Tables, newest log time) from the sections of lazy and the log '''
+      asss, gros, pers, studs = [lazy.get(name) for name in ['assignments', 'groups', 'persons', 'students']]
+      # The log is by far the largest source, so it is streamed into the join
+      tables = join_tables(asss, gros, pers, studs, [])
+      return tables, merge_log(tables, self.get_log(cid))
+
+   def forget_course(self, cid):
+      ''' Drop the cached course pages, so the next get_tables fetches them again '''
+      if self.opener.cache:
+         self.opener.cache.invalidate(r'[?&]id={}(&|$)'.format(cid))
 
    def __get_assignment_table(self, cid):
       ''' cid -> [(aid, title)] '''
       data, _ = self.opener.open(ITU+'/course/view.php?id='+cid)
-      regex = r'<li class=".*?assign " id="module-(\d+)">.*?<span.*?>(.*?)<'
-      return re.findall(regex, data, re.DOTALL)
+      return parse_assignment_table(data)
 
    def __get_group_table(self, cid):
       ''' cid -> [(group_name, [pid])] '''
       data, _ = self.opener.open(ITU+'/group/overview.php?id='+cid)
-      groups = []
-      regex = r'<tr.*?<td.*?>(.*?)</td>.*?<td.*?>(.*?)</td>'
-      for group_name, students in re.findall(regex, data, re.DOTALL):
-         regex = r'<a href=".*?id=(\d+)'
-         pids = re.findall(regex, students)
-         groups.append((group_name, pids))
-      return groups
-
-   def __get_person_table(self, cid, role):
-      ''' cid -> [(pid, icon, name, email, last_access)] '''
-      data, _ = self.opener.open(ITU+'/user/index.php?mode=1&perpage=1000&roleid={}&id={}'.format(role,cid))
-      persons = []
-      regex = r'<table class="userinfobox">(.*?)</table>'
-      for row in re.findall(regex, data, re.DOTALL):
-         try:
-            pid = re.search(r'user/view\.php\?id=(\d+)', row).group(1)
-            icon = None
-            name = re.search(r'<div class="username">(.*?)</div>', row).group(1)
-            email = re.search(r'href="mailto:(.*?)"', row).group(1)
-            last_access = re.search(r'Last access: ([\w\d\s,:]+)', row).group(1)
-            if last_access == 'Never':
-               last_access = 0
-            else: last_access = dateutil.parser.parse(last_access)
-            persons.append((pid, icon, name, email, last_access))
-         except AttributeError as err:
-            print(row)
-            raise
+      return parse_group_table(data)
+
+   def __get_person_table(self, cid, role, perpage=PERSON_PAGE_SIZE):
+      ''' cid -> [(pid, icon, name, email, last_access)] from every page of the
+          user index. The first page tells how many pages there are, and the
+          others are fetched at the same time. '''
+      fetch = lambda page: parse_person_table(
+         self.opener.open(person_table_url.format(perpage, page, role, cid))[0])
+      data, _ = self.opener.open(person_table_url.format(perpage, 0, role, cid))
+      persons = parse_person_table(data)
+      count = parse_participant_count(data)
+      if count is None:
+         # Without a count, fetch pages until one is not full
+         page = 1
+         while len(persons) == page * perpage:
+            self.scheduler.check()
+            persons += fetch(page)
+            page += 1
+         return persons
+      for rows in self.scheduler.map(fetch, range(1, -(-count // perpage))):
+         persons += rows
       return persons
 
-   def __get_log_table(self, cid):
-      ''' cid -> ([(time, pid0, aid, pid1, grade)], [(time, pid0, aid)])'''
-      data, _ = self.opener.open(ITU+'/report/log/index.php?chooselog=1&modaction=-view&logformat=showashtml&perpage=1000000&id='+cid)
-      grade_actions = []
-      submit_actions = []
-      regex = r'<tr class="r[01]".*?>(.*?)</tr>'
-      for row in re.findall(regex, data, re.DOTALL):
-         try:
-            time = re.search(r'cell c0".*?>(.*?)</td>', row).group(1)
-            time = dateutil.parser.parse(time)
-            pid0 = re.search(r'/user/view.php\?id=(\d+)', row).group(1)
-            action = re.search(r'cell c3".*?>.*?<a.*?>(.*?)</a>', row).group(1)
-            if action == 'assign grade submission':
-               aid = re.search(r'/assign/view.php\?id=(\d+)', row).group(1)
-               pid1, grade_str = re.search(r'Grade student: \(id=(\d+), fullname=.+\)\. (.*?)\.', row).groups()
-               grade = self.__parse_grade(grade_str)
-               grade_actions.append((time, pid0, aid, pid1, grade))
-            if action == 'assign submit':
-               aid = re.search(r'/assign/view.php\?id=(\d+)', row).group(1)
-               submit_actions.append((time, pid0, aid))
-               if not ('Submitted for grading' in row or 'Afleveret til' in row):
-                  raise AttributeError('Bad status')
-         except AttributeError as err:
-            print(row)
-            raise
-      return grade_actions, submit_actions
-
-   def __parse_grade(self, grade_str):
-      if 'not approved' in grade_str.lower():
-         return NOT_APPROVED
-      if 'approved' in grade_str.lower():
-         return APPROVED
-      if 'no grade' in grade_str.lower() or '-' in grade_str.lower():
-         return NO_GRADE
-      raise AttributeError('Bad grade '+grade_str)
+   def get_log(self, cid, since=None, perpage=LOG_PAGE_SIZE):
+      ''' cid -> iterator of (LOG_GRADE, (time, pid0, aid, pid1, grade))
+          and (LOG_SUBMIT, (time, pid0, aid)), newest first.
+          The log report is fetched and parsed one page at a time, and no
+          further pages are fetched once an entry older than since is seen.
+          The pages are never taken from the cache, as pages cached at
+          different times do not line up. '''
+      reader = LogPageReader(perpage, since)
+      for page in itertools.count():
+         if page:
+            self.scheduler.check()
+         data, _ = self.opener.open(log_page_url.format(perpage, page, cid), refresh=True)
+         yield from reader.events(data)
+         if reader.done:
+            return
 
    def get_submission_full(self, submission):
       data, _ = self.opener.open(save_grade.format(submission.assignment.id, submission.row))
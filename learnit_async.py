@@ -0,0 +1,375 @@
+import asyncio, ssl, io, os, json, zipfile, time, itertools
+import urllib.request, urllib.error, http.client, http.cookiejar
+from urllib.parse import urlsplit, urljoin, urlparse, parse_qs, urlencode
+from collections import defaultdict
+import learnit, learnit2
+from learnit_http import save_cookies, load_cookies, stats
+
+LOG_WINDOW = 4 # Log pages fetched at a time, as the number of pages is not known up front
+
+class AsyncResponse:
+   ''' A response read to the end, with the interface the cookie jar and the
+       login flow use '''
+   def __init__(self, url, status, reason, headers, payload):
+      self.url = url
+      self.code = self.status = status
+      self.msg = self.reason = reason
+      self.headers = headers
+      self.payload = payload
+   def info(self):
+      return self.headers
+   def geturl(self):
+      return self.url
+   def getcode(self):
+      return self.code
+   def getheaders(self):
+      return self.headers.items()
+   def getheader(self, name, default=None):
+      return self.headers.get(name, default)
+   def read(self):
+      return self.payload
+
+class AsyncOpener:
+   ''' Opens requests on asyncio streams, with at most limit of them at a
+       time, all on one thread. Connections are kept alive and reused by
+       (scheme, host), cookies are kept in cookies and redirects are
+       followed, as with the urllib openers of the other clients. Responses
+       are not cached.
+       With route set to an (address, port), every request goes over plain
+       http to it instead, with the host and scheme asked for in the Host and
+       X-Forwarded-Proto headers, like learnit_replay.LocalRouteHandler. '''
+   max_redirects = 10
+
+   def __init__(self, cookies, limit=32, route=None, timeout=60, max_idle=16, log=None, stats=stats):
+      self.cookies = cookies
+      self.limit = asyncio.Semaphore(limit)
+      self.route = route
+      self.timeout = timeout
+      self.max_idle = max_idle
+      self.log = log
+      self.stats = stats
+      self.context = ssl.create_default_context()
+      self.idle = defaultdict(list) # (scheme, host) -> [(StreamReader, StreamWriter)]
+      self.addheaders = [('User-agent', 'learnit.py')]
+
+   async def open(self, url, data=None, binary=False):
+      ''' Fetch url and return (payload, response) '''
+      start = time.perf_counter()
+      try:
+         async with self.limit:
+            resp = await self.__fetch(url, data)
+      except Exception as err:
+         self.__log_error(url, data, err, start)
+         raise
+      seconds = time.perf_counter() - start
+      if self.stats:
+         self.stats.request(url, 'network', resp.status, seconds, len(resp.payload))
+      if self.log:
+         self.log.request(url, data, 'network', resp.status, seconds,
+            len(resp.payload), resp.payload if self.log.sampled() else None)
+      return resp.payload if binary else resp.payload.decode('utf-8'), resp
+
+   async def download(self, url, path):
+      ''' Fetch url into the file at path, which only appears once it is
+          complete, and return the response '''
+      payload, resp = await self.open(url, binary=True)
+      with open(path + '.part', 'wb') as f:
+         f.write(payload)
+      os.replace(path + '.part', path)
+      return resp
+
+   def close(self):
+      ''' Close the idle connections '''
+      for conns in self.idle.values():
+         for _, writer in conns:
+            writer.close()
+      self.idle.clear()
+
+   def __log_error(self, url, data, err, start):
+      seconds = time.perf_counter() - start
+      if self.stats:
+         self.stats.request(url, 'network', getattr(err, 'code', repr(err)), seconds, 0)
+      if self.log:
+         self.log.request(url, data, 'network', getattr(err, 'code', repr(err)), seconds, 0)
+
+   async def __fetch(self, url, data):
+      for _ in range(self.max_redirects + 1):
+         req = urllib.request.Request(url, data, dict(self.addheaders))
+         self.cookies.add_cookie_header(req)
+         resp = await self.__request(req)
+         self.cookies.extract_cookies(resp, req)
+         location = resp.getheader('Location')
+         if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            if resp.status in (301, 302, 303):
+               data = None
+            continue
+         if resp.status >= 400:
+            raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(resp.payload))
+         return resp
+      raise urllib.error.HTTPError(url, resp.status, 'Too many redirects', resp.headers, None)
+
+   async def __request(self, req):
+      parts = urlsplit(req.full_url)
+      key = (parts.scheme, parts.netloc)
+      method = req.get_method()
+      headers = {'Host': parts.netloc, 'Connection': 'keep-alive'}
+      headers.update((name.title(), value) for name, value in req.header_items())
+      if req.data is not None:
+         headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+         headers['Content-Length'] = str(len(req.data))
+      if self.route:
+         headers['X-Forwarded-Proto'] = parts.scheme
+      message = '{} {} HTTP/1.1\r\n'.format(method, req.selector) + \
+         ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.items()) + '\r\n'
+      message = message.encode('latin-1') + (req.data or b'')
+      while True:
+         conn = self.idle[key].pop() if self.idle[key] else None
+         reused = conn is not None
+         try:
+            if not reused:
+               conn = await asyncio.wait_for(self.__connect(parts), self.timeout)
+            reader, writer = conn
+            writer.write(message)
+            await writer.drain()
+            status, reason, resp_headers, payload, keep_alive = \
+               await asyncio.wait_for(self.__read_response(reader, method), self.timeout)
+         except (ConnectionError, asyncio.IncompleteReadError) as err:
+            if conn:
+               conn[1].close()
+            if reused:
+               continue # The server closed the connection while it was idle
+            raise urllib.error.URLError(err)
+         except (OSError, asyncio.TimeoutError, asyncio.LimitOverrunError) as err:
+            if conn:
+               conn[1].close()
+            raise urllib.error.URLError(err)
+         break
+      if keep_alive and len(self.idle[key]) < self.max_idle:
+         self.idle[key].append(conn)
+      else:
+         writer.close()
+      return AsyncResponse(req.full_url, status, reason, resp_headers, payload)
+
+   async def __connect(self, parts):
+      if self.route:
+         return await asyncio.open_connection(*self.route)
+      if parts.scheme == 'https':
+         return await asyncio.open_connection(parts.hostname, parts.port or 443,
+            ssl=self.context, server_hostname=parts.hostname)
+      return await asyncio.open_connection(parts.hostname, parts.port or 80)
+
+   async def __read_response(self, reader, method):
+      ''' -> (status, reason, headers, payload, whether the connection can be reused) '''
+      head = await reader.readuntil(b'\r\n\r\n')
+      status_line, _, header_lines = head.partition(b'\r\n')
+      version, status, *reason = status_line.decode('latin-1').split(' ', 2)
+      status, reason = int(status), reason[0] if reason else ''
+      headers = http.client.parse_headers(io.BytesIO(header_lines))
+      keep_alive = version == 'HTTP/1.1' and headers.get('Connection', '').lower() != 'close'
+      if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+         payload = b''
+      elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+         chunks = []
+         while True:
+            size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+            if not size:
+               break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+         while await reader.readuntil(b'\r\n') != b'\r\n': # Trailers
+            pass
+         payload = b''.join(chunks)
+      elif 'Content-Length' in headers:
+         payload = await reader.readexactly(int(headers['Content-Length']))
+      else:
+         payload = await reader.read()
+         keep_alive = False
+      return status, reason, headers, payload, keep_alive
+
+class Learnit:
+   ''' The operations of learnit.Learnit and learnit2.Learnit as coroutines,
+       with at most limit requests in flight at a time on one thread. Pages
+       are parsed by the parsers of those modules, into their types. route is
+       passed on to AsyncOpener, to run against a local stand-in server.
+       Requests are logged to log, a RequestLog, if given. '''
+   def __init__(self, limit=32, route=None, log=None):
+      self.cookies = http.cookiejar.LWPCookieJar()
+      self.opener = AsyncOpener(self.cookies, limit, route, log=log)
+
+   async def __aenter__(self):
+      return self
+
+   async def __aexit__(self, *exc):
+      self.close()
+
+   def close(self):
+      self.opener.close()
+      if self.opener.log:
+         self.opener.log.close()
+
+   async def resume_session(self, path):
+      ''' Reuse the session saved to path by save_session, if it is still
+          valid. Returns the same as login, or (None, SESSION_EXPIRED). '''
+      if not load_cookies(self.cookies, path):
+         return None, learnit2.SESSION_EXPIRED
+      try:
+         data, response = await self.opener.open('https://learnit.itu.dk/my/')
+      except urllib.error.URLError:
+         return None, learnit2.SESSION_EXPIRED
+      if response.geturl() != 'https://learnit.itu.dk/my/':
+         self.cookies.clear()
+         return None, learnit2.SESSION_EXPIRED
+      return learnit2.parse_profile(data), learnit2.SUCCESS
+
+   def save_session(self, path):
+      save_cookies(self.cookies, path)
+
+   async def login(self, email, password):
+      ''' Log in to learnit. Returns ((Person, [Course]), error code) like
+          learnit2.Learnit.login '''
+      _, response = await self.opener.open('http://learnit.itu.dk/auth/saml')
+      auth_state = parse_qs(urlparse(response.geturl()).query)['AuthState'][0]
+      login_data = urlencode({
+         'RelayState':'',
+         'AuthState':auth_state,
+         'username':email,
+         'password':password,
+         'wp-submit':'Login'
+      }).encode('utf-8')
+      data, _ = await self.opener.open('https://wayf.itu.dk/module.php/core/loginuserpass.php?', data=login_data)
+      if 'Incorrect username or password' in data:
+         return None, learnit2.INVALID_PASSWORD
+      parser = learnit2.FormParser().feed(data)
+      assert parser.action == 'https://wayf.wayf.dk/module.php/saml/sp/saml2-acs.php/wayf.wayf.dk'
+      assert parser.method == 'post'
+      data, _ = await self.opener.open(parser.action, data=urlencode(parser.data).encode('utf-8'))
+      parser = learnit2.FormParser().feed(data)
+      if parser.action == 'https://wayf.wayf.dk/module.php/consent/getconsent.php':
+         return None, learnit2.WAYF_REDIRECT
+      if parser.action != 'https://learnit.itu.dk/simplesaml/module.php/saml/sp/saml2-acs.php/default-sp':
+         return None, learnit2.UNKNOWN_ERROR
+      assert parser.method == 'post'
+      data, response = await self.opener.open(parser.action, data=urlencode(parser.data).encode('utf-8'))
+      assert response.geturl() == 'https://learnit.itu.dk/my/'
+      return learnit2.parse_profile(data), learnit2.SUCCESS
+
+   # The tables of learnit2
+
+   async def get_assignment_table(self, cid):
+      data, _ = await self.opener.open(learnit2.ITU+'/course/view.php?id='+cid)
+      return learnit2.parse_assignment_table(data)
+
+   async def get_group_table(self, cid):
+      data, _ = await self.opener.open(learnit2.ITU+'/group/overview.php?id='+cid)
+      return learnit2.parse_group_table(data)
+
+   async def get_person_table(self, cid, role, perpage=learnit2.PERSON_PAGE_SIZE):
+      ''' Like learnit2.Learnit's, with the pages after the first fetched at
+          the same time '''
+      url = lambda page: learnit2.person_table_url.format(perpage, page, role, cid)
+      data, _ = await self.opener.open(url(0))
+      persons = learnit2.parse_person_table(data)
+      count = learnit2.parse_participant_count(data)
+      if count is None:
+         page = 1
+         while len(persons) == page * perpage:
+            data, _ = await self.opener.open(url(page))
+            persons += learnit2.parse_person_table(data)
+            page += 1
+         return persons
+      pages = await asyncio.gather(*(self.opener.open(url(page)) for page in range(1, -(-count // perpage))))
+      for data, _ in pages:
+         persons += learnit2.parse_person_table(data)
+      return persons
+
+   async def get_log(self, cid, since=None, perpage=learnit2.LOG_PAGE_SIZE):
+      ''' -> [event] like learnit2.Learnit.get_log, newest first. The pages
+          are fetched LOG_WINDOW at a time. '''
+      events = []
+      reader = learnit2.LogPageReader(perpage, since)
+      for first in itertools.count(0, LOG_WINDOW):
+         pages = await asyncio.gather(*(self.opener.open(learnit2.log_page_url.format(perpage, page, cid))
+            for page in range(first, first + LOG_WINDOW)))
+         for data, _ in pages:
+            events += reader.events(data)
+            if reader.done:
+               return events
+
+   async def get_tables(self, cid):
+      tables, _ = await self.sync_tables(cid)
+      return tables
+
+   async def sync_tables(self, cid, tables=None, since=None):
+      ''' Like learnit2.Learnit.sync_tables, with every table and the log
+          fetched at the same time '''
+      if tables is not None and since is not None:
+         log = await self.get_log(cid, since=since, perpage=learnit2.LOG_SYNC_PAGE_SIZE)
+         unresolved = []
+         newest = learnit2.merge_log(tables, log, since, unresolved)
+         if not unresolved:
+            return tables, newest
+      asss, gros, pers, studs, log = await asyncio.gather(
+         self.get_assignment_table(cid),
+         self.get_group_table(cid),
+         self.get_person_table(cid, learnit2.ROLE_ALL),
+         self.get_person_table(cid, learnit2.ROLE_STUDENT),
+         self.get_log(cid))
+      tables = learnit2.join_tables(asss, gros, pers, studs, [])
+      return tables, learnit2.merge_log(tables, log)
+
+   # The grading of learnit
+
+   async def list_assignments(self, cid):
+      data, _ = await self.opener.open(learnit.course_view + cid)
+      return learnit.parse_assignments(data)
+
+   async def list_submissions(self, assign_id):
+      ''' Returns a dictionary of group_id -> learnit.Row '''
+      data, _ = await self.opener.open(learnit.assign_view.format(assign_id, 'grading', '0'))
+      return learnit.parse_submissions(data)
+
+   async def show_submission(self, assign_id, row):
+      data, _ = await self.opener.open(learnit.save_grade.format(assign_id, row))
+      sub, com_json = learnit.parse_submission(data)
+      if com_json is not None:
+         data, _ = await self.opener.open(learnit.page_comment_ajax,
+            data=learnit.comments_data(sub.form.data['sesskey'], com_json))
+         sub = sub._replace(comments=json.loads(data)['list'])
+      return sub
+
+   async def show_submissions(self, assign_id, rows=None):
+      ''' -> [(row, learnit.Submission)] of the given row numbers, or of
+          every row of the assignment, all fetched at the same time '''
+      if rows is None:
+         rows = [row.row for row in (await self.list_submissions(assign_id)).values()]
+      subs = await asyncio.gather(*(self.show_submission(assign_id, row) for row in rows))
+      return list(zip(rows, subs))
+
+   async def download_attachments(self, context_id, filenames):
+      ''' -> [learnit.Attachment] of the files, with zip files extracted '''
+      payloads = await asyncio.gather(*(self.opener.open(learnit.sub_file.format(context_id) + filename,
+         binary=True) for filename in filenames))
+      attachments = []
+      for filename, (data, _) in zip(filenames, payloads):
+         name = learnit.clean_name(filename)
+         if not name.endswith('.zip'):
+            attachments.append(learnit.Attachment(name, data))
+            continue
+         with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            for zname in zf.namelist():
+               if not zname.endswith('/'):
+                  attachments.append(learnit.Attachment(learnit.clean_name(zname), zf.read(zname)))
+      return attachments
+
+   async def save_grade(self, assign_id, row, form, grade, feedback, grade_to_code):
+      data, _ = await self.opener.open(form.action,
+         data=learnit.grade_data(assign_id, row, form, grade, feedback, grade_to_code))
+      if 'The grade changes were saved' in data:
+         return learnit.SUCCESS
+      return learnit.UNKNOWN_ERROR
+
+   async def get_course_log(self, cid):
+      ''' -> learnit.CourseLog of the gradings in every assignment '''
+      data, _ = await self.opener.open(learnit.log_csv_url(cid, ''))
+      return learnit.CourseLog(learnit.parse_log(data))
@@ -1,18 +1,18 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import re, tempfile, subprocess, os, json, textwrap
+import re, tempfile, subprocess, os, json, textwrap, shutil, concurrent.futures, functools
 import itertools, operator, unicodedata
-import learnit
+import learnit, learnit_http
 from itertools import starmap
-from multiprocessing.pool import ThreadPool
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 
 regsafe = lambda s: re.sub(r'([\-\[\]\/\{\}\(\)\*\+\?\.\\\^\$\|])', r'\\\1', s)
 
 open_cmd = "open"
 edit_cmd = "vim"
 passwd_file = '.password'
+session_file = '.session'
 accepted_suffices = ['.pdf', '.java', '.zip']
 separator_line = '-' * 50
 
@@ -24,6 +24,7 @@ class Dialog:
       self.cmds = []
       self.add_command('help', self.__help, 'help', 'Show this message')
       self.add_command('exit|quit|done', self.__exit, 'exit', 'Exit the program')
+      self.add_command('stats(?: (.+))?$', self.__stats, 'stats [file]', 'Show request and parse statistics, or save them as JSON')
 
    def add_command(self, regex, fun, help_cmd, help_text):
       self.help.append((help_cmd, help_text))
@@ -38,6 +39,13 @@ class Dialog:
    def __exit(self):
       return True
 
+   def __stats(self, path):
+      if path:
+         learnit_http.stats.save(path)
+         print('Saved statistics to', path)
+      else:
+         print(learnit_http.stats.format())
+
    def run(self):
       while True:
          cmd = input(self.prefix).strip()
@@ -67,28 +75,101 @@ def show_sub(sub):
          nohtml = re.sub(r'<.*?>', '', comment['content'])
          print('   {}'.format(nohtml))
 
-def grade_dialog(client, cid, aid, row):
-   sub = client.show_submission(aid, row.row)
+class Prefetcher:
+   ''' Fetches the grading forms and attachments of the groups to grade
+       next in the background, for up to depth groups besides the one being
+       graded, and the grading log of the course. The fetches run on the
+       client's scheduler as PREFETCH work, and are moved ahead as
+       INTERACTIVE work once they are waited for. The attachments of each
+       row are spooled into their own directory under spool_dir. '''
+   def __init__(self, client, cid, aid, depth=0):
+      self.client = client
+      self.cid = cid
+      self.aid = aid
+      self.depth = depth
+      self.spool_dir = tempfile.mkdtemp(prefix='learnit-')
+      self.fetches = OrderedDict() # row -> Future of (Submission, [SpooledAttachment])
+      self.log = None # Future of CourseLog
+      self.fetch_log = functools.partial(client.get_course_log, cid) # What self.log runs
+      self.closed = False
+
+   def __fetch(self, row):
+      sub = self.client.show_submission(self.aid, row)
+      directory = os.path.join(self.spool_dir, row)
+      return sub, list(self.client.spool_attachments(sub.context_id, sub.files, directory))
+
+   def prefetch(self, rows):
+      ''' Start fetching the first depth of rows, and drop the fetches for
+          other rows that are done or not started '''
+      wanted = rows[:self.depth]
+      for row in wanted:
+         if row not in self.fetches:
+            self.fetches[row] = self.client.scheduler.submit(self.__fetch, row,
+               priority=learnit_http.PREFETCH)
+      if self.log is None and wanted:
+         self.log = self.client.scheduler.submit(self.fetch_log, priority=learnit_http.PREFETCH)
+      for row, fetch in list(self.fetches.items()):
+         if row not in wanted and (fetch.cancel() or fetch.done()):
+            self.forget(row)
+
+   def get(self, row, upcoming=()):
+      ''' -> (Submission, [SpooledAttachment], CourseLog) for row, and
+          start prefetching the upcoming rows that will be graded after it '''
+      fetch = self.client.scheduler.urgent(self.fetches.pop(row, None), self.__fetch, row)
+      self.log = self.client.scheduler.urgent(self.log, self.fetch_log)
+      self.prefetch([r for r in upcoming if r != row])
+      sub, attachments = fetch.result()
+      self.fetches[row] = fetch
+      return sub, attachments, self.log.result()
+
+   def forget(self, row):
+      ''' Drop what was fetched for row, or stop fetching it '''
+      fetch = self.fetches.pop(row, None)
+      if fetch is not None and not fetch.cancel():
+         concurrent.futures.wait([fetch])
+      shutil.rmtree(os.path.join(self.spool_dir, row), ignore_errors=True)
+
+   def saved(self, row):
+      ''' Drop what was fetched for row, and fetch the gradings of the
+          assignment again for the log, which are stale once a grade has been
+          saved '''
+      self.forget(row)
+      if self.log is not None:
+         self.fetch_log = functools.partial(self.__update_log, self.log)
+         self.log = self.client.scheduler.submit(self.fetch_log, priority=learnit_http.PREFETCH)
+
+   def __update_log(self, log):
+      ''' Future of CourseLog -> the CourseLog, with the gradings of the
+          assignment fetched again '''
+      log = self.client.scheduler.urgent(log, self.client.get_course_log, self.cid).result()
+      return self.client.update_course_log(log, self.cid, self.aid)
+
+   def close(self):
+      ''' Stop the fetches and remove the spooled attachments '''
+      if not self.closed:
+         self.closed = True
+         for row in list(self.fetches):
+            self.forget(row)
+         if self.log is not None:
+            self.log.cancel()
+         shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+def grade_dialog(client, aid, row, sub, attachments, log):
+   ''' Grade a submission, fetched with its attachments and the grading
+       log. Returns the grade if one was saved. '''
    show_sub(sub)
    # Graders
-   log = client.get_log(cid, aid)
-   graders = [(ga.time, ga.grader) for ga in log if ga.studid in row.studids]
-   for time, grader in graders:
-      print (time, grader)
+   for ga in log.grade_actions(aid, row.studids):
+      print (ga.time, ga.grader)
    # Show files
-   attachments = list(client.download_attachments(sub.context_id, sub.files))
    print('Files:', ', '.join(name for name, _ in attachments))
    feedback = input('Show files? [y/N]: ').lower()
-   fs = []
    if feedback == 'y':
-      for name, data in attachments:
+      for name, path in attachments:
          if not any(name.endswith(suf) for suf in accepted_suffices):
             print ('Ignoring file: ', name)
             continue
-         with tempfile.NamedTemporaryFile(suffix=name, delete=False) as f:
-            f.write(data)
-            subprocess.call([open_cmd, f.name])
-            fs.append(f)
+         subprocess.call([open_cmd, path])
    # Grade
    f = tempfile.NamedTemporaryFile(delete=False)
    edit_message = 'Please enter a feedback message the submission. Lines starting '+\
@@ -100,6 +181,7 @@ def grade_dialog(client, cid, aid, row):
    subprocess.call([edit_cmd, f.name])
    with open(f.name) as f:
       feedback = ''.join(line for line in f if not re.match('\s*#', line))
+   saved = None
    if feedback.strip():
       grade = ''
       abbrv = {'a':learnit.APPROVED, 'n':learnit.NOT_APPROVED, 'o':learnit.NO_GRADE}
@@ -108,32 +190,103 @@ def grade_dialog(client, cid, aid, row):
       er = client.save_grade(aid, row.row, sub.form, abbrv[grade], feedback.strip(), sub.grade_to_code)
       if er == learnit.SUCCESS:
          print('Changes saved')
+         saved = abbrv[grade]
       else: print('Error')
    else: print('Grading aborted')
-   # Clean up
-   for f in fs:
-      os.unlink(f.name)
    print(separator_line)
+   return saved
+
+
+class CourseSnapshot:
+   ''' The assignments, submission tables and log of a course, fetched once
+       and shared by the commands of MainDialog. Assignments marked stale,
+       after a grade is saved or on update, are fetched again the next time
+       the tables are asked for. '''
+   def __init__(self, client, cid):
+      self.client = client
+      self.cid = cid
+      self.aids = None # Sorted assignment ids
+      self.subs = {} # aid -> dictionary of group_id -> Row
+      self.log = None # CourseLog
+      self.stale = set()
+      self.stale_log = set() # Assignments whose gradings in log are stale
+
+   def submissions(self):
+      ''' -> [(aid, dictionary of group_id -> Row)] for every assignment of
+          the course, in order of id '''
+      if self.aids is None:
+         print('Loading assignments...')
+         self.aids = sorted(self.client.list_assignments(self.cid), key=int)
+      missing = [aid for aid in self.aids if aid not in self.subs or aid in self.stale]
+      if missing:
+         print('Loading {} tables...'.format(len(missing)))
+         self.subs.update(zip(missing, self.client.scheduler.map(self.client.list_submissions, missing)))
+      self.stale.clear()
+      return [(aid, self.subs[aid]) for aid in self.aids]
 
+   def course_log(self):
+      if self.log is None:
+         print('Loading log...')
+         self.log = self.client.get_course_log(self.cid)
+         self.stale_log.clear()
+      for aid in sorted(self.stale_log):
+         self.log = self.client.update_course_log(self.log, self.cid, aid)
+      self.stale_log.clear()
+      return self.log
+
+   def saved(self, aid):
+      ''' A grade was saved in assignment aid, so its table and its gradings
+          in the log are stale. Returns whether aid is in this course. '''
+      if aid not in self.subs:
+         return False
+      self.client.forget_assignment(aid)
+      self.stale.add(aid)
+      self.stale_log.add(aid)
+      return True
+
+   def update(self):
+      ''' Fetch everything again the next time it is asked for '''
+      for aid in self.subs:
+         self.client.forget_assignment(aid)
+      self.client.forget_course(self.cid)
+      self.aids = None
+      self.stale.update(self.subs)
+      self.log = None
+      self.stale_log.clear()
 
 class AssignmentDialog(Dialog):
-   def __init__(self, client, cid, aid):
+   def __init__(self, client, cid, aid, snapshot=None):
       Dialog.__init__(self, aid+'> ')
       self.add_command('([a-zA-Z]{1,2})$', self.grade_cmd, '[group name]', 'Open the grader for a particular group')
+      self.add_command('show all$', self.show_all_cmd, 'show all', 'Show current grade and feedback for every group')
       self.add_command('show ([a-zA-Z]{1,2})', self.show_grade_cmd, 'show [group name]', 'Show current grade and feedback for group')
       self.add_command('list$', self.list_cmd, 'list', 'List what groups are available for grading')
       self.add_command('list emails?$', self.list_email_cmd, 'list email', 'List itu email-addresses of groups')
       self.add_command('update$', self.update_cmd, 'update', 'Update table of submissions')
       self.add_command('find (.+)', self.find_group_cmd, 'find [name]', 'Search for groups with a certain member')
+      self.add_command('prefetch (\d+)$', self.prefetch_cmd, 'prefetch [n]', 'Fetch the next n groups to grade in the background, 0 to stop')
       self.client = client
       self.cid = cid
       self.aid = aid
+      self.depth = 0
+      self.prefetcher = None
+      self.snapshot = snapshot
 
    def run(self):
       print('Loading table...')
-      self.subs = client.list_submissions(self.aid)
+      self.subs = self.client.list_submissions(self.aid)
       print('Found {} groups.'.format(len(self.subs)))
-      Dialog.run(self)
+      self.prefetcher = Prefetcher(self.client, self.cid, self.aid, self.depth)
+      self.prefetcher.prefetch(self.grading_order())
+      try:
+         return Dialog.run(self)
+      finally:
+         self.prefetcher.close()
+
+   def grading_order(self):
+      ''' The rows of the groups that can be graded, in the order of list '''
+      return [row.row for _, _, _, _, row in sorted((row.substat, row.grade, len(group), group, row)
+         for group, row in self.subs.items() if row.substat == learnit.HAS_SUBMIT)]
 
    def grade_cmd(self, group):
       group = group.upper()
@@ -142,13 +295,27 @@ class AssignmentDialog(Dialog):
          return
       row = self.subs[group]
       if row.substat == learnit.HAS_SUBMIT:
-         grade_dialog(self.client, self.cid, self.aid, row)
+         order = self.grading_order()
+         upcoming = order[order.index(row.row) + 1:]
+         sub, attachments, log = self.prefetcher.get(row.row, upcoming)
+         grade = grade_dialog(self.client, self.aid, row, sub, attachments, log)
+         if grade is not None:
+            self.prefetcher.saved(row.row)
+            self.subs[group] = row._replace(grade=grade)
+            if self.snapshot:
+               self.snapshot.saved(self.aid)
       else:
          print("Can't grade groups with no submissions.")
 
    def show_grade_cmd(self, group):
       row = self.subs[group.upper()]
-      show_sub(client.show_submission(self.aid, row.row))
+      show_sub(self.client.show_submission(self.aid, row.row))
+
+   def show_all_cmd(self):
+      groups = {row.row: group for group, row in self.subs.items()}
+      for row, sub in self.client.show_submissions(self.aid, list(groups)):
+         print('Group', groups[row])
+         show_sub(sub)
 
    def list_cmd(self):
       groups = sorted((row.substat, row.grade, len(group), group)
@@ -162,13 +329,17 @@ class AssignmentDialog(Dialog):
          print(group, '; '.join(starmap('{} <{}>'.format, sorted(zip(row.names, row.emails)))))
 
    def update_cmd(self):
-      print('Deleting files named *.cached...')
-      for f in os.listdir('.'):
-         if os.path.isfile(f) and f.endswith('.cached'):
-            os.unlink(f)
+      self.client.forget_assignment(self.aid)
+      if self.snapshot:
+         self.snapshot.saved(self.aid)
+      self.prefetcher.close()
       self.run()
       return True
 
+   def prefetch_cmd(self, depth):
+      self.depth = self.prefetcher.depth = int(depth)
+      self.prefetcher.prefetch(self.grading_order())
+
    def find_group_cmd(self, name):
       normal = lambda s: ''.join(c for c in unicodedata.normalize('NFD', s)
             if unicodedata.category(c) != 'Mn').lower().strip()
@@ -186,17 +357,23 @@ class MainDialog(Dialog):
       self.add_command('table\s*(\d+)$', self.table_cmd, 'table [course id]', 'Print assignment status table for course')
       self.add_command('results?\s*(\d+)$', self.result_cmd, 'result [course id]', 'Number of assignments per group')
       self.add_command('tograde?\s*(\d+)$', self.tograde_cmd, 'tograde [course id]', 'List what tasks are currently ungraded')
+      self.add_command('bulk grade (\S+)(?: (\S+))?$', self.bulk_grade_cmd, 'bulk grade [file] [report]', 'Save the grades in a csv or jsonl file of assignment, group, grade, feedback')
+      self.add_command('update(?:\s*(\d+))?$', self.update_cmd, 'update [course id]', 'Fetch the tables of a course, or of every course, again')
       self.client = client
       self.data = data
       self.courses = []
+      self.snapshots = {} # cid -> CourseSnapshot
    
    def run(self):
       print("Hello {}!".format(self.client.get_logininfo(self.data)))
-      courses = client.list_my_courses(self.data)
-      assignments = ThreadPool().map(self.client.list_assignments, courses.keys())
+      self.load_courses(self.client.list_my_courses(self.data))
+      Dialog.run(self)
+
+   def load_courses(self, courses):
+      ''' Fetch the assignments of courses, a dictionary of cid -> name '''
+      assignments = self.client.scheduler.map(self.client.list_assignments, courses.keys())
       self.courses = [(cid, cname, list(ass.items()))
          for (cid, cname), ass in zip(courses.items(), assignments)]
-      Dialog.run(self)
 
    def list_assignments_cmd(self):
       for cid, cname, assignments in sorted(self.courses):
@@ -205,14 +382,29 @@ class MainDialog(Dialog):
             print(" "*3 + "{}: {}".format(aid, aname))
 
    def grade_cmd(self, aid):
-      cid = next(cid for cid,_,assignments in self.courses
-         if aid in (aid_ for aid_,_ in assignments))
-      AssignmentDialog(self.client, cid, aid).run()
+      cid = next((cid for cid,_,assignments in self.courses
+         if aid in (aid_ for aid_,_ in assignments)), None)
+      if cid is None:
+         print('Unknown assignment', aid)
+         return
+      AssignmentDialog(self.client, cid, aid, self.snapshot(cid)).run()
+
+   def snapshot(self, courseid):
+      if courseid not in self.snapshots:
+         self.snapshots[courseid] = CourseSnapshot(self.client, courseid)
+      return self.snapshots[courseid]
+
+   def update_cmd(self, courseid):
+      for cid, _, _ in self.courses:
+         if courseid in (None, cid):
+            self.client.forget_course(cid)
+      for cid, snapshot in self.snapshots.items():
+         if courseid in (None, cid):
+            snapshot.update()
+      self.load_courses({cid: cname for cid, cname, _ in self.courses})
 
    def result_cmd(self, courseid):
-      print('Loading tables...')
-      aids = sorted(self.client.list_assignments(courseid), key=int)
-      subss = ThreadPool().map(client.list_submissions, aids)
+      subss = [subs for _, subs in self.snapshot(courseid).submissions()]
       ids = set(groupid for subs in subss for groupid in subs.keys())
       result = defaultdict(list)
       for groupid in ids:
@@ -230,10 +422,7 @@ class MainDialog(Dialog):
          print()
 
    def tograde_cmd(self, courseid):
-      print('Loading tables...')
-      aids = sorted(self.client.list_assignments(courseid), key=int)
-      subss = ThreadPool().map(client.list_submissions, aids)
-      for aid, subs in zip(aids, subss):
+      for aid, subs in self.snapshot(courseid).submissions():
          groupids = [groupid for groupid, sub in subs.items() if sub.substat == learnit.HAS_SUBMIT and sub.grade == learnit.NO_GRADE]
          if groupids:
             print('Assignment:', aid)
@@ -241,19 +430,41 @@ class MainDialog(Dialog):
                print('Group', groupid)
             print()
 
+   def bulk_grade_cmd(self, path, report_path):
+      try:
+         records = learnit.read_grades(path)
+      except (OSError, ValueError, KeyError) as err:
+         print('Could not read {}: {}'.format(path, err))
+         return
+      report_path = report_path or os.path.splitext(path)[0] + '.report.csv'
+      print('Saving {} grades...'.format(len(records)))
+      results = []
+      try:
+         for result in self.client.save_grades(records):
+            results.append(result)
+            if result.status == 'saved':
+               for snapshot in self.snapshots.values():
+                  snapshot.saved(result.record.assignment)
+            if result.status in ('failed', 'skipped'):
+               print('Line {}: {} {}: {}'.format(result.record.line, result.record.assignment,
+                  result.record.group, result.message))
+      finally:
+         # The grades saved before an error or interrupt are still reported
+         learnit.write_grade_report(report_path, results)
+         counts = Counter(result.status for result in results)
+         print(', '.join('{} {}'.format(n, status) for status, n in sorted(counts.items())))
+         print('Report written to', report_path)
+
    def table_cmd(self, courseid):
-      print('Loading tables...')
-      aids = sorted(self.client.list_assignments(courseid), key=int)
-      subss = ThreadPool().map(client.list_submissions, aids)
-      logs = ThreadPool().starmap(client.get_log, ((courseid,aid) for aid in aids))
+      snapshot = self.snapshot(courseid)
+      aids, subss = zip(*snapshot.submissions())
+      log = snapshot.course_log()
       cols = [[group for _, group in sorted((len(g),g) for g in subss[0].keys())]]
-      for log, subs in zip(logs, subss):
+      for aid, subs in zip(aids, subss):
          groups = sorted((len(group), group, row) for group, row in subs.items())
-         log = list(log)
          def grader(studids):
-            graders = [(ga.time, ga.grader) for ga in log if ga.studid in studids]
-            _, grader = sorted(graders, reverse=True)[0] if graders else (0, 'Uknown')
-            return grader.split()[-1]
+            latest = log.latest(aid, studids)
+            return latest.grader.split()[-1] if latest else 'Uknown'
          cols.append([grader(row.studids) for _, _, row in groups])
          def label(substat, grade):
             if substat == learnit.NO_SUBMIT: return '-'
@@ -285,11 +496,17 @@ def login_dialog(client):
 
 
 if __name__ == '__main__':
-   client = learnit.Learnit()
-   if os.path.exists(passwd_file):
-      with open(passwd_file) as f:
-         passwd = json.loads(f.read())
-      data, er = client.login(passwd['username'], passwd['password'])
-   else:
-      data = login_dialog(client)
-   MainDialog(client, data).run()
+   client = learnit.Learnit(log=learnit_http.RequestLog())
+   data, er = client.resume_session(session_file)
+   if er != learnit.SUCCESS:
+      if os.path.exists(passwd_file):
+         with open(passwd_file) as f:
+            passwd = json.loads(f.read())
+         data, er = client.login(passwd['username'], passwd['password'])
+      else:
+         data = login_dialog(client)
+      client.save_session(session_file)
+   try:
+      MainDialog(client, data).run()
+   finally:
+      client.close()
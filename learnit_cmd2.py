@@ -3,21 +3,28 @@
 
 import re, tempfile, subprocess, os, json, textwrap
 import itertools, operator, unicodedata
-import learnit2
+import learnit2, learnit_store, learnit_http
 import datetime
 from itertools import starmap
-from multiprocessing.pool import ThreadPool
 from collections import defaultdict
-import pickle
 
 regsafe = lambda s: re.sub(r'([\-\[\]\/\{\}\(\)\*\+\?\.\\\^\$\|])', r'\\\1', s)
 
 open_cmd = "open"
 edit_cmd = "vim"
 passwd_file = '.password'
+session_file = '.session'
+store_file = '.{}.sqlite'
 accepted_suffices = ['.pdf', '.java', '.zip']
 separator_line = '-' * 50
 
+def grade_tags(counts, skip=None):
+   ''' {grade: number of submissions} -> '(2 Pending, 1 Not approved)' '''
+   tags = ['{} {}'.format(counts[grade], learnit2.grade_to_name[grade])
+      for grade in (learnit2.APPROVED, learnit2.NO_GRADE, learnit2.NOT_APPROVED, learnit2.NO_SUBMISSION)
+      if grade != skip and counts.get(grade)]
+   return '' if not tags else '({})'.format(', '.join(tags))
+
 class Dialog:
 
    def __init__(self, prefix):
@@ -26,6 +33,7 @@ class Dialog:
       self.cmds = []
       self.add_command('help', self.__help, 'help', 'Show this message')
       self.add_command('exit|quit|done', self.__exit, 'exit', 'Exit the program')
+      self.add_command('stats(?: (.+))?$', self.__stats, 'stats [file]', 'Show request and parse statistics, or save them as JSON')
 
    def add_command(self, regex, fun, help_cmd, help_text):
       self.help.append((help_cmd, help_text))
@@ -40,6 +48,13 @@ class Dialog:
    def __exit(self):
       return True
 
+   def __stats(self, path):
+      if path:
+         learnit_http.stats.save(path)
+         print('Saved statistics to', path)
+      else:
+         print(learnit_http.stats.format())
+
    def run(self):
       while True:
          cmd = input(self.prefix).strip()
@@ -60,78 +75,72 @@ class MainDialog(Dialog):
       self.add_command('list assignments|la$', self.list_assignments_cmd, 'list assignments', 'List available assignments from courses')
       self.add_command('results?$', self.result_cmd, 'result', 'Number of assignments per group')
       self.add_command('status (.+)$', self.status_cmd, 'status [group]', 'What\'s going on for that gorup')
-      self.add_command('update$', self.update_cmd, 'update', 'Reloads cached tables')
+      self.add_command('update( all)?$', self.update_cmd, 'update [all]', 'Fetches new log entries, or reloads all stored tables')
       self.cid = cid
       self.client = client
+      self.lazy = None # LazyTables loading into an empty store
 
    def run(self):
-      self.tables = self.__get_tables()
+      self.store = learnit_store.CourseStore(store_file.format(self.cid))
+      if self.store.is_empty():
+         self.lazy = self.client.lazy_tables(self.cid).load(learnit_http.BACKGROUND)
       Dialog.run(self)
 
-   def __get_tables(self):
+   def __store_lazy_tables(self):
+      ''' Wait for the tables loading in the background, and store them '''
+      if self.lazy is None:
+         return
+      if not self.lazy.done('tables'):
+         print('Loading tables...')
+      self.store.save(*self.lazy.get('tables'))
+      self.lazy = None
+
+   def update_cmd(self, full):
+      if self.lazy is not None:
+         # The tables still loading are as new as an update would make them
+         self.__store_lazy_tables()
+         return
+      newest = self.store.newest()
+      if not full and newest is not None:
+         print('Fetching log entries since {}...'.format(newest))
+         unresolved = []
+         self.store.add_actions(self.client.get_log(self.cid, since=newest,
+            perpage=learnit2.LOG_SYNC_PAGE_SIZE), newest, unresolved)
+         if not unresolved:
+            return
+         print('The log has entries of new assignments, groups or persons.')
       print('Loading tables...')
-      cache_name = '.{}.cached'.format(self.cid)
-      if os.path.exists(cache_name):
-         with open(cache_name, 'rb') as f:
-            tables = pickle.load(f)
-      else:
-         tables = self.client.get_tables(self.cid)
-         with open(cache_name, 'wb') as f:
-            pickle.dump(tables, f)
-      return tables
-
-   def update_cmd(self):
-      print('Deleting files named *.cached...')
-      for f in os.listdir('.'):
-         if os.path.isfile(f) and f.endswith('.cached'):
-            os.unlink(f)
-      self.tables = self.__get_tables()
+      self.client.forget_course(self.cid)
+      self.store.save(*self.client.sync_tables(self.cid))
 
    def list_assignments_cmd(self):
-      for (aid, title) in sorted(self.tables.assignments):
-         print("{}: {}".format(aid, title))
+      if self.lazy is not None:
+         for (aid, title) in sorted(self.lazy.get('assignments')):
+            print("{}: {}".format(aid, title))
+         return
+      for (aid, title, counts) in sorted(self.store.assignment_results()):
+         print("{}: {} {}".format(aid, title, grade_tags(counts)))
 
    def status_cmd(self, group_str):
-      groups = [group for group in self.tables.groups
-            if group.name.lower() == group_str.lower()]
-      if not groups:
+      self.__store_lazy_tables()
+      status = self.store.group_status(group_str)
+      if status is None:
          print('No such group')
          return
-      group = groups[0]
-      for submission in group.submissions:
-         aid, title, _ = submission.assignment
-         grade = self.__get_submission_grade(submission)
+      for aid, title, grade in status:
          print(aid, title, '({})'.format(learnit2.grade_to_name[grade]).lower())
 
-   def __get_submission_grade(self, submission):
-      if not submission.submit_actions:
-         return learnit2.NO_SUBMISSION
-      actions = submission.grade_actions + submission.submit_actions
-      default_action = learnit2.GradeAction(datetime.datetime(1,1,1), learnit2.NO_GRADE, None, None)
-      last = max(actions + [default_action])
-      if actions and type(last) == learnit2.GradeAction:
-         return last.grade
-      if actions and type(last) == learnit2.SubmitAction:
-         return learnit2.NO_GRADE
-
    def result_cmd(self):
+      self.__store_lazy_tables()
       result = defaultdict(list)
-      for group in self.tables.groups:
-         grades = list(map(self.__get_submission_grade, group.submissions))
-         acc = grades.count(learnit2.APPROVED)
-         result[acc].append((group, grades))
+      for name, emails, counts in self.store.results():
+         result[counts.get(learnit2.APPROVED, 0)].append((name, emails, counts))
       for acc, groups in sorted(result.items()):
          print('{} Approves:'.format(acc))
-         for group, grades in groups:
-            tags = []
-            for grade in (learnit2.NO_GRADE, learnit2.NOT_APPROVED, learnit2.NO_SUBMISSION):
-               if grade in grades:
-                  tags.append('{} {}'.format(grades.count(grade), learnit2.grade_to_name[grade]))
-            tagstring = '' if not tags else '({})'.format(', '.join(tags))
-            print(group.name+':\t', '; '.join(s.person.email for s in group.students), tagstring)
+         for name, emails, counts in groups:
+            print(name+':\t', '; '.join(emails), grade_tags(counts, learnit2.APPROVED))
          print()
 
-
 def login_dialog(client):
    er = learnit2.INVALID_PASSWORD
    while er != learnit2.SUCCESS:
@@ -145,12 +154,18 @@ def login_dialog(client):
 
 
 if __name__ == '__main__':
-   client = learnit2.Learnit()
-   if os.path.exists(passwd_file):
-      with open(passwd_file) as f:
-         passwd = json.loads(f.read())
-      data, er = client.login(passwd['username'], passwd['password'])
-   else:
-      data = login_dialog(client)
+   client = learnit2.Learnit(log=learnit_http.RequestLog())
+   data, er = client.resume_session(session_file)
+   if er != learnit2.SUCCESS:
+      if os.path.exists(passwd_file):
+         with open(passwd_file) as f:
+            passwd = json.loads(f.read())
+         data, er = client.login(passwd['username'], passwd['password'])
+      else:
+         data = login_dialog(client)
+      client.save_session(session_file)
    print('Hello', data[0].name)
-   MainDialog(client, '3003023').run()
+   try:
+      MainDialog(client, '3003023').run()
+   finally:
+      client.close()
@@ -0,0 +1,760 @@
+import urllib.request, urllib.error
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+import os, re, time, pickle, hashlib, threading, logging, logging.handlers
+import queue, random, weakref, ssl, http.client, http.cookiejar, json, contextlib, functools
+import itertools, concurrent.futures, datetime
+import dateutil.parser
+from collections import defaultdict, Counter, deque
+
+# Seconds a fetched page stays fresh, by the first matching url pattern.
+# Pages matching no pattern, like the login flow and saving grades, are never cached.
+# Neither is the grading form, as it holds the session's sesskey and the current grade.
+default_ttls = [
+   (r'/pluginfile\.php/', 7 * 24 * 3600),
+   (r'/mod/assign/view\.php\?.*action=grading\b', 15 * 60),
+   (r'/comment/comment_ajax\.php', 15 * 60),
+   (r'/course/view\.php', 3600),
+   (r'/group/overview\.php', 3600),
+   (r'/user/index\.php', 3600),
+   (r'/report/log/index\.php', 5 * 60),
+]
+default_cache_dir = os.path.join(
+   os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'learnit')
+
+class CachedResponse:
+   ''' Stands in for the http response of a page served from the cache '''
+   def __init__(self, url, headers, payload):
+      self.url = url
+      self.headers = headers
+      self.payload = payload
+      self.status = 200
+   def geturl(self):
+      return self.url
+   def getheaders(self):
+      return self.headers
+   def getheader(self, name, default=None):
+      return next((v for k, v in self.headers if k.lower() == name.lower()), default)
+   def read(self):
+      return self.payload
+
+class ResponseCache:
+   ''' A disk cache of responses keyed by url and post data. Entries expire
+       after the ttl of their url, and are revalidated with the server using
+       their ETag or Last-Modified header when it sent one. When the cache
+       grows beyond max_bytes the least recently used entries are removed.
+       An entry file holds the pickled url it was asked for, followed by the
+       pickled entry, so the url can be read without the payload. '''
+   def __init__(self, path=default_cache_dir, ttls=default_ttls, max_bytes=100 * 2**20):
+      self.path = path
+      self.ttls = [(re.compile(regex), ttl) for regex, ttl in ttls]
+      self.max_bytes = max_bytes
+      self.lock = threading.Lock()
+      os.makedirs(path, mode=0o700, exist_ok=True)
+      self.entries = {} # key -> (size, last use, url or None until read)
+      for name in os.listdir(path):
+         if name.endswith('.entry'):
+            stat = os.stat(os.path.join(path, name))
+            self.entries[name[:-len('.entry')]] = (stat.st_size, stat.st_mtime, None)
+      self.size = sum(size for size, _, _ in self.entries.values())
+
+   def ttl(self, url):
+      return next((ttl for regex, ttl in self.ttls if regex.search(url)), 0)
+
+   def key(self, url, data):
+      return hashlib.sha1(url.encode('utf-8') + b'\0' + (data or b'')).hexdigest()
+
+   def __file(self, key):
+      return os.path.join(self.path, key + '.entry')
+
+   def get(self, url, data=None):
+      ''' -> (entry, fresh) where entry is a dict with the url, time, headers
+          and payload of the response, or (None, False) if there is none '''
+      key = self.key(url, data)
+      with self.lock:
+         if key not in self.entries:
+            return None, False
+         self.entries[key] = (self.entries[key][0], time.time(), url)
+      try:
+         with open(self.__file(key), 'rb') as f:
+            if pickle.load(f) != url:
+               raise pickle.UnpicklingError('Not an entry of ' + url)
+            entry = pickle.load(f)
+         os.utime(self.__file(key))
+      except (OSError, EOFError, pickle.UnpicklingError):
+         self.__remove(key)
+         return None, False
+      return entry, time.time() - entry['time'] < self.ttl(url)
+
+   def put(self, url, data, response_url, headers, payload):
+      key = self.key(url, data)
+      entry = {'url': response_url, 'time': time.time(), 'headers': headers, 'payload': payload}
+      tmp_name = self.__file(key) + '.{}.tmp'.format(threading.get_ident())
+      with open(tmp_name, 'wb') as f:
+         pickle.dump(url, f, pickle.HIGHEST_PROTOCOL)
+         pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp_name, self.__file(key))
+      with self.lock:
+         self.size -= self.entries.get(key, (0, 0, None))[0]
+         self.entries[key] = (os.path.getsize(self.__file(key)), time.time(), url)
+         self.size += self.entries[key][0]
+         victims = []
+         for old_key, _ in sorted(self.entries.items(), key=lambda kv: kv[1][1]):
+            if self.size <= self.max_bytes or old_key == key:
+               break
+            victims.append(old_key)
+            self.size -= self.entries.pop(old_key)[0]
+      for old_key in victims:
+         self.__unlink(old_key)
+
+   def touch(self, url, data=None):
+      ''' Mark an entry as fresh again, after the server said it is unchanged '''
+      entry, _ = self.get(url, data)
+      if entry is not None:
+         self.put(url, data, entry['url'], entry['headers'], entry['payload'])
+      return entry
+
+   def invalidate(self, regex):
+      ''' Remove the entries whose url matches regex '''
+      regex = re.compile(regex)
+      for key in list(self.entries):
+         url = self.__url(key)
+         if not url or regex.search(url):
+            self.__remove(key)
+
+   def __url(self, key):
+      ''' The url of an entry, read from the head of its file if it was
+          cached before this ResponseCache was made, or '' if unreadable '''
+      with self.lock:
+         size, used, url = self.entries.get(key, (0, 0, ''))
+      if url is not None:
+         return url
+      try:
+         with open(self.__file(key), 'rb') as f:
+            url = pickle.load(f)
+      except (OSError, EOFError, pickle.UnpicklingError):
+         url = ''
+      if not isinstance(url, str):
+         url = ''
+      with self.lock:
+         if key in self.entries:
+            self.entries[key] = self.entries[key][:2] + (url,)
+      return url
+
+   def clear(self):
+      for key in list(self.entries):
+         self.__remove(key)
+
+   def __remove(self, key):
+      with self.lock:
+         if key in self.entries:
+            self.size -= self.entries.pop(key)[0]
+      self.__unlink(key)
+
+   def __unlink(self, key):
+      try:
+         os.unlink(self.__file(key))
+      except FileNotFoundError:
+         pass
+
+class RequestLog:
+   ''' Logs the requests of a LoggingOpener. The records are put on a queue
+       and written to handler by a background thread, so requests never wait
+       on file io. Every request is logged with its url, status, size and
+       duration. Response payloads are only logged for a random sample_rate
+       share of the requests and for failed requests, and cut at payload_limit
+       characters. Leave out the RequestLog of an opener to log nothing. '''
+   def __init__(self, handler=None, sample_rate=0, payload_limit=4096):
+      self.sample_rate = sample_rate
+      self.payload_limit = payload_limit
+      # A logger of its own, not the global 'weblogger', so that two logs
+      # never write each other's records.
+      self.logger = logging.Logger('weblogger', logging.DEBUG)
+      records = queue.SimpleQueue()
+      self.logger.addHandler(logging.handlers.QueueHandler(records))
+      handler = handler or logging.FileHandler('log', delay=True)
+      handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+      listener = logging.handlers.QueueListener(records, handler)
+      listener.start()
+      # Stops the listener on close, at exit or when the log is collected,
+      # whichever comes first, without keeping the log alive until exit.
+      self.__finalizer = weakref.finalize(self, RequestLog.__stop, listener, handler)
+
+   @staticmethod
+   def __stop(listener, handler):
+      listener.stop()
+      handler.close()
+
+   def close(self):
+      ''' Write out the queued records and stop the background thread '''
+      self.__finalizer()
+
+   def sampled(self):
+      return self.sample_rate and random.random() < self.sample_rate
+
+   def request(self, url, data, source, status, seconds, size, payload=None):
+      ''' Log a request. Only the field names of post data are logged, as it
+          may hold passwords. '''
+      fields = ' fields=' + ','.join(parse_qs(data.decode('utf-8'), keep_blank_values=True)) if data else ''
+      self.logger.info('%s %s %s%s status=%s bytes=%d ms=%.1f', 'POST' if data else 'GET',
+         url, source, fields, status, size, seconds * 1000)
+      if payload is not None:
+         if isinstance(payload, bytes):
+            payload = payload[:self.payload_limit].decode('utf-8', 'replace')
+         self.logger.debug('Response payload: %s', payload[:self.payload_limit])
+
+class ConnectionPool:
+   ''' Idle persistent connections by (scheme, host). A connection is only
+       used by one request at a time, and goes back to the pool when its
+       response has been read. '''
+   def __init__(self, max_idle=16):
+      self.max_idle = max_idle
+      self.lock = threading.Lock()
+      self.idle = defaultdict(list) # (scheme, host) -> [HTTPConnection]
+
+   def get(self, key):
+      with self.lock:
+         return self.idle[key].pop() if self.idle[key] else None
+
+   def put(self, key, conn):
+      with self.lock:
+         if len(self.idle[key]) < self.max_idle:
+            self.idle[key].append(conn)
+            return
+      conn.close()
+
+   def close(self):
+      with self.lock:
+         conns = [conn for conns in self.idle.values() for conn in conns]
+         self.idle.clear()
+      for conn in conns:
+         conn.close()
+
+class PooledResponse:
+   ''' The response of a request on a pooled connection, with the interface
+       urllib handlers and LoggingOpener use. The connection is handed back
+       to the pool once the body has been read to the end. '''
+   def __init__(self, resp, url, release):
+      self.resp = resp
+      self.url = url
+      self.release = release
+      self.code = self.status = resp.status
+      self.msg = self.reason = resp.reason
+      self.headers = resp.headers
+   def info(self):
+      return self.headers
+   def geturl(self):
+      return self.url
+   def getcode(self):
+      return self.code
+   def getheaders(self):
+      return self.resp.getheaders()
+   def getheader(self, name, default=None):
+      return self.resp.getheader(name, default)
+   def read(self, amt=None):
+      data = self.resp.read(amt)
+      if self.resp.isclosed() and self.release:
+         self.release(True)
+         self.release = None
+      return data
+   def close(self):
+      if self.release:
+         self.release(False)
+         self.release = None
+      self.resp.close()
+   def __enter__(self):
+      return self
+   def __exit__(self, *exc):
+      self.close()
+
+class KeepAliveMixin:
+   def keepalive_open(self, req, scheme, connection_class, **kwargs):
+      if not req.host:
+         raise urllib.error.URLError('no host given')
+      key = (scheme, req.host)
+      headers = dict(req.unredirected_hdrs)
+      headers.update((k, v) for k, v in req.headers.items() if k not in headers)
+      headers['Connection'] = 'keep-alive'
+      headers = {name.title(): val for name, val in headers.items()}
+      while True:
+         conn = self.pool.get(key)
+         reused = conn is not None
+         if not reused:
+            conn = connection_class(req.host, timeout=req.timeout, **kwargs)
+         try:
+            conn.request(req.get_method(), req.selector, req.data, headers,
+               encode_chunked=req.has_header('Transfer-encoding'))
+            resp = conn.getresponse()
+         except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as err:
+            conn.close()
+            if reused:
+               continue # The server closed the connection while it was idle
+            raise urllib.error.URLError(err)
+         except OSError as err:
+            conn.close()
+            raise urllib.error.URLError(err)
+         break
+      def release(complete):
+         if complete and not resp.will_close:
+            self.pool.put(key, conn)
+         else:
+            conn.close()
+      return PooledResponse(resp, req.get_full_url(), release)
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urllib.request.HTTPHandler):
+   ''' Drop in for urllib.request.HTTPHandler that reuses connections '''
+   def __init__(self, pool):
+      urllib.request.HTTPHandler.__init__(self)
+      self.pool = pool
+   def http_open(self, req):
+      return self.keepalive_open(req, 'http', http.client.HTTPConnection)
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urllib.request.HTTPSHandler):
+   ''' Drop in for urllib.request.HTTPSHandler that reuses connections '''
+   def __init__(self, pool, context=None):
+      urllib.request.HTTPSHandler.__init__(self, context=context)
+      self.pool = pool
+      self.context = context or ssl.create_default_context()
+   def https_open(self, req):
+      return self.keepalive_open(req, 'https', http.client.HTTPSConnection, context=self.context)
+
+class RateLimiter:
+   ''' Spaces out the calls to wait, across threads, so at most rate of them
+       return per second. A rate of None never waits. '''
+   def __init__(self, rate=None):
+      self.interval = 1 / rate if rate else 0
+      self.lock = threading.Lock()
+      self.next = 0
+
+   def wait(self):
+      if not self.interval:
+         return
+      with self.lock:
+         now = time.monotonic()
+         start = max(now, self.next)
+         self.next = start + self.interval
+      time.sleep(start - now)
+
+# Priority classes of Scheduler, most urgent first
+INTERACTIVE, PREFETCH, BACKGROUND = range(3)
+SHUTDOWN_TIMEOUT = 5 # seconds Scheduler.shutdown waits on running calls
+
+class Scheduler:
+   ''' The worker threads of a client, shared by everything it does in the
+       background. Calls are queued by priority class and run in the order
+       they were submitted within a class, so what the user is waiting on
+       runs ahead of prefetching and bulk jobs. Calls made without a
+       priority from a call on a worker get the priority of that call, so
+       the requests of prefetching and bulk jobs stay behind the user's.
+       Calls that have not started can be cancelled through their Future. The threads are started as
+       needed and stopped by shutdown. They are daemon threads, so work still
+       running never holds up exit. '''
+   def __init__(self, workers=8):
+      self.workers = workers
+      self.queue = queue.PriorityQueue()
+      self.order = itertools.count()
+      self.lock = threading.Lock()
+      self.threads = []
+      self.local = threading.local()
+      self.closed = False
+
+   def priority(self, priority=None):
+      ''' priority, or if it is None the priority of the call running on this
+          thread, which is INTERACTIVE off the workers '''
+      if priority is not None:
+         return priority
+      return getattr(self.local, 'priority', INTERACTIVE)
+
+   def submit(self, fun, *args, priority=None):
+      ''' Queue fun(*args) and return a concurrent.futures.Future of it '''
+      future = concurrent.futures.Future()
+      priority = self.priority(priority)
+      with self.lock:
+         if self.closed:
+            raise RuntimeError('Scheduler has been shut down')
+         self.queue.put((priority, next(self.order), future, fun, args))
+         if len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.__work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+      return future
+
+   def urgent(self, future, fun, *args):
+      ''' future, or fun(*args) submitted again as INTERACTIVE work if future
+          is None or had not started yet. On a worker fun is run right away
+          instead, as no other worker may be free to run it. '''
+      if future is not None and not future.cancel():
+         return future
+      if not getattr(self.local, 'worker', False):
+         return self.submit(fun, *args, priority=INTERACTIVE)
+      future = concurrent.futures.Future()
+      future.set_running_or_notify_cancel()
+      try:
+         future.set_result(fun(*args))
+      except BaseException as err:
+         future.set_exception(err)
+      return future
+
+   def map(self, fun, iterable, priority=None):
+      ''' -> [fun(item) for item in iterable], computed by the workers '''
+      return list(self.imap(fun, iterable, priority))
+
+   def imap(self, fun, iterable, priority=None, limit=None):
+      ''' Yield fun(item) for each item, in order, with up to limit of them
+          queued or running at a time '''
+      return self.__imap(fun, iterable, priority, limit, ordered=True)
+
+   def imap_unordered(self, fun, iterable, priority=None, limit=None):
+      ''' Like imap, but yields the results in the order they complete '''
+      return self.__imap(fun, iterable, priority, limit, ordered=False)
+
+   def __imap(self, fun, iterable, priority, limit, ordered):
+      items = iter(iterable)
+      priority = self.priority(priority)
+      if getattr(self.local, 'worker', False):
+         # Waiting on the queue from a worker could leave every worker
+         # waiting on calls that no worker is free to run, so a worker runs
+         # the calls no other worker has started itself, in order
+         pending = deque()
+         try:
+            for item in itertools.islice(items, limit):
+               pending.append((self.submit(fun, item, priority=priority), item))
+            while pending:
+               future, item = pending.popleft()
+               result = self.urgent(future, fun, item).result()
+               for item in itertools.islice(items, 1):
+                  pending.append((self.submit(fun, item, priority=priority), item))
+               yield result
+         finally:
+            for future, _ in pending:
+               future.cancel()
+         return
+      pending = deque() if ordered else set()
+      add = pending.append if ordered else pending.add
+      try:
+         for item in itertools.islice(items, limit):
+            add(self.submit(fun, item, priority=priority))
+         while pending:
+            if ordered:
+               future = pending.popleft()
+            else:
+               done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+               future = done.pop()
+               pending.remove(future)
+            result = future.result()
+            for item in itertools.islice(items, 1):
+               add(self.submit(fun, item, priority=priority))
+            yield result
+      finally:
+         for future in pending:
+            future.cancel()
+
+   def check(self):
+      ''' Raise CancelledError once shutdown has been called. Long calls,
+          like paged downloads, check between pages, so that shutdown does
+          not wait on them. '''
+      if self.closed:
+         raise concurrent.futures.CancelledError()
+
+   def shutdown(self, cancel=True, timeout=SHUTDOWN_TIMEOUT):
+      ''' Stop the workers once the running calls are done. Calls still in
+          the queue are cancelled, or run first if cancel is False. Waits at
+          most timeout seconds for the running calls, or for as long as they
+          take if timeout is None. '''
+      with self.lock:
+         if self.closed:
+            return
+         self.closed = True
+         threads = list(self.threads)
+      if cancel:
+         while True:
+            try:
+               _, _, future, _, _ = self.queue.get_nowait()
+            except queue.Empty:
+               break
+            future.cancel()
+      for _ in threads:
+         self.queue.put((BACKGROUND + 1, next(self.order), None, None, None))
+      deadline = None if timeout is None else time.monotonic() + timeout
+      for thread in threads:
+         if thread is not threading.current_thread():
+            thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+
+   def __work(self):
+      self.local.worker = True
+      while True:
+         priority, _, future, fun, args = self.queue.get()
+         if future is None:
+            return
+         if not future.set_running_or_notify_cancel():
+            continue
+         self.local.priority = priority
+         try:
+            future.set_result(fun(*args))
+         except BaseException as err:
+            future.set_exception(err)
+
+def save_cookies(jar, path):
+   ''' Write an LWPCookieJar, session cookies included, to a file only the
+       owner can read, as it is as good as a password while the session lasts. '''
+   fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+   os.chmod(path, 0o600)
+   with os.fdopen(fd, 'w') as f:
+      f.write('#LWP-Cookies-2.0\n')
+      f.write(jar.as_lwp_str(ignore_discard=True, ignore_expires=True))
+
+def load_cookies(jar, path):
+   ''' Load cookies saved by save_cookies into jar. Returns False if there are none. '''
+   try:
+      jar.load(path, ignore_discard=True, ignore_expires=True)
+   except (OSError, http.cookiejar.LoadError):
+      return False
+   return True
+
+def endpoint(url):
+   ''' The host and path a url asks for, and its action if it has one:
+       https://learnit.itu.dk/mod/assign/view.php?id=1&action=grade ->
+       learnit.itu.dk/mod/assign/view.php?action=grade. Files all count as
+       learnit.itu.dk/pluginfile.php. '''
+   parts = urlsplit(url)
+   path = re.sub(r'^/pluginfile\.php/.*', '/pluginfile.php', parts.path)
+   action = re.search(r'(?:^|&)action=(\w+)', parts.query)
+   return parts.netloc + path + ('?action=' + action.group(1) if action else '')
+
+def percentile(samples, p):
+   ''' Nearest rank percentile of sorted samples '''
+   return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] if samples else 0
+
+class EndpointStats:
+   def __init__(self):
+      self.count = 0
+      self.errors = 0
+      self.bytes = 0
+      self.seconds = 0
+      self.sources = Counter()
+      self.latencies = [] # A uniform sample of at most Stats.max_samples
+
+class Stats:
+   ''' Counts the requests of LoggingOpeners by endpoint, with their bytes
+       and latency percentiles, and the time spent in named parse and join
+       steps. The numbers are kept for the whole process in the stats below,
+       so the commands can show them and save them as JSON to compare runs. '''
+   def __init__(self, max_samples=10000):
+      self.max_samples = max_samples
+      self.lock = threading.Lock()
+      self.reset()
+
+   def reset(self):
+      with self.lock:
+         self.endpoints = defaultdict(EndpointStats)
+         self.timings = defaultdict(lambda: [0, 0, 0]) # name -> [count, seconds, max seconds]
+
+   def request(self, url, source, status, seconds, size):
+      with self.lock:
+         stat = self.endpoints[endpoint(url)]
+         stat.count += 1
+         stat.errors += not (isinstance(status, int) and status < 400)
+         stat.bytes += size
+         stat.seconds += seconds
+         stat.sources[source] += 1
+         if len(stat.latencies) < self.max_samples:
+            stat.latencies.append(seconds)
+         else:
+            i = random.randrange(stat.count)
+            if i < self.max_samples:
+               stat.latencies[i] = seconds
+
+   def timing(self, name, seconds, count=1):
+      with self.lock:
+         timing = self.timings[name]
+         timing[0] += count
+         timing[1] += seconds
+         timing[2] = max(timing[2], seconds)
+
+   @contextlib.contextmanager
+   def timed(self, name):
+      start = time.perf_counter()
+      try:
+         yield
+      finally:
+         self.timing(name, time.perf_counter() - start)
+
+   def as_dict(self):
+      with self.lock:
+         endpoints = {name: {'count': stat.count, 'errors': stat.errors, 'bytes': stat.bytes,
+               'seconds': stat.seconds, 'sources': dict(stat.sources),
+               'p50': percentile(sorted(stat.latencies), 50), 'p90': percentile(sorted(stat.latencies), 90),
+               'p99': percentile(sorted(stat.latencies), 99), 'max': max(stat.latencies, default=0)}
+            for name, stat in self.endpoints.items()}
+         timings = {name: {'count': count, 'seconds': seconds, 'max': longest}
+            for name, (count, seconds, longest) in self.timings.items()}
+      return {'requests': endpoints, 'timings': timings}
+
+   def save(self, path):
+      with open(path, 'w') as f:
+         json.dump(self.as_dict(), f, indent=1, sort_keys=True)
+
+   def format(self):
+      report = self.as_dict()
+      lines = ['{:<52} {:>6} {:>9} {:>8} {:>8} {:>8}  {}'.format(
+         'Requests', 'count', 'KB', 'p50 ms', 'p90 ms', 'p99 ms', 'sources')]
+      for name, stat in sorted(report['requests'].items(), key=lambda kv: -kv[1]['seconds']):
+         lines.append('{:<52} {:>6} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f}  {}'.format(name[:52], stat['count'],
+            stat['bytes'] / 1024, stat['p50'] * 1000, stat['p90'] * 1000, stat['p99'] * 1000,
+            ', '.join('{} {}'.format(n, source) for source, n in sorted(stat['sources'].items()))))
+      lines.append('{:<52} {:>6} {:>9} {:>8} {:>8}'.format('Parsing and joining', 'count', 'total s', 'mean ms', 'max ms'))
+      for name, timing in sorted(report['timings'].items(), key=lambda kv: -kv[1]['seconds']):
+         lines.append('{:<52} {:>6} {:>9.3f} {:>8.3f} {:>8.1f}'.format(name, timing['count'],
+            timing['seconds'], timing['seconds'] / timing['count'] * 1000, timing['max'] * 1000))
+      return '\n'.join(lines)
+
+stats = Stats()
+
+def timed(name):
+   ''' Decorator that adds the time spent in a function to stats under name '''
+   def decorator(fun):
+      @functools.wraps(fun)
+      def timed_fun(*args, **kwargs):
+         with stats.timed(name):
+            return fun(*args, **kwargs)
+      return timed_fun
+   return decorator
+
+class TimedIterator:
+   ''' Wraps an iterator and adds up how long it takes to produce the items,
+       so a consumer can leave that time out of its own '''
+   def __init__(self, iterable):
+      self.iterator = iter(iterable)
+      self.seconds = 0
+   def __iter__(self):
+      return self
+   def __next__(self):
+      start = time.perf_counter()
+      try:
+         return next(self.iterator)
+      finally:
+         self.seconds += time.perf_counter() - start
+
+# The formats of the times learnit shows: 'Thursday, 23 April 2015, 3:21 PM'
+# in logs and 'Thursday, 23 April 2015, 15:21' as last access
+time_formats = [
+   re.compile(r'\w+, (\d{1,2}) (\w+) (\d{4}), (\d{1,2}):(\d\d) ([AP]M)$'),
+   re.compile(r'\w+, (\d{1,2}) (\w+) (\d{4}), (\d{1,2}):(\d\d)()$'),
+]
+month_numbers = {name: i for i, name in enumerate(['January', 'February', 'March', 'April',
+   'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December'], 1)}
+
+@timed('parse dates')
+def parse_times(texts):
+   ''' Parse times from learnit pages into naive datetimes, like
+       dateutil.parser.parse, which is only used for times in none of
+       time_formats. The times of a page share a format, so the format that
+       matched last is tried first, and a log has a few rows to the minute,
+       so a time repeating the one before is not parsed again. '''
+   times = []
+   formats = list(time_formats)
+   last_text, last = None, None
+   for text in texts:
+      if text != last_text:
+         last_text = text
+         for i, regex in enumerate(formats):
+            match = regex.match(text)
+            month = match and month_numbers.get(match.group(2))
+            if month:
+               day, _, year, hour, minute, half = match.groups()
+               hour = int(hour) % 12 + (12 if half == 'PM' else 0) if half else int(hour)
+               last = datetime.datetime(int(year), month, int(day), hour, int(minute))
+               if i:
+                  formats.insert(0, formats.pop(i))
+               break
+         else:
+            last = dateutil.parser.parse(text)
+      times.append(last)
+   return times
+
+def parse_time(text):
+   return parse_times([text])[0]
+
+REQUEST_TIMEOUT = 60 # seconds without a response before a request fails
+
+class LoggingOpener:
+   def __init__(self, opener, cache=None, log=None, stats=stats, timeout=REQUEST_TIMEOUT):
+      self.opener = opener
+      self.cache = cache
+      self.log = log
+      self.stats = stats
+      self.timeout = timeout
+   def open(self, url, data=None, binary=False, refresh=False):
+      ''' Fetch url and return (payload, response). Cacheable pages are served
+          from the cache while fresh, unless refresh is set. '''
+      start = time.perf_counter()
+      try:
+         if self.cache and self.cache.ttl(url):
+            resp, source = self.__open_cached(url, data, refresh)
+         else:
+            resp, source = self.opener.open(urllib.request.Request(url, data), timeout=self.timeout), 'network'
+         payload = resp.read()
+      except Exception as err:
+         self.__log_error(url, data, err, start)
+         raise
+      seconds = time.perf_counter() - start
+      if self.stats:
+         self.stats.request(url, source, resp.status, seconds, len(payload))
+      if self.log:
+         self.log.request(url, data, source, resp.status, seconds,
+            len(payload), payload if self.log.sampled() else None)
+      if not binary:
+         payload = payload.decode('utf-8')
+      return payload, resp
+   def download(self, url, path, chunk_size=2**16):
+      ''' Stream the body of url into the file at path, chunk by chunk, and
+          return the response. The file only appears once it is complete. '''
+      start = time.perf_counter()
+      size = 0
+      try:
+         resp = self.opener.open(urllib.request.Request(url), timeout=self.timeout)
+         with open(path + '.part', 'wb') as f:
+            for chunk in iter(lambda: resp.read(chunk_size), b''):
+               f.write(chunk)
+               size += len(chunk)
+         os.replace(path + '.part', path)
+      except Exception as err:
+         self.__log_error(url, None, err, start)
+         raise
+      seconds = time.perf_counter() - start
+      if self.stats:
+         self.stats.request(url, 'network', resp.status, seconds, size)
+      if self.log:
+         self.log.request(url, None, 'network', resp.status, seconds, size)
+      return resp
+   def __log_error(self, url, data, err, start):
+      if self.stats:
+         self.stats.request(url, 'network', getattr(err, 'code', repr(err)), time.perf_counter() - start, 0)
+      if not self.log:
+         return
+      if isinstance(err, urllib.error.HTTPError):
+         self.log.request(url, data, 'network', err.code, time.perf_counter() - start, 0, err.read())
+      else:
+         self.log.request(url, data, 'network', repr(err), time.perf_counter() - start, 0)
+   def __open_cached(self, url, data, refresh):
+      ''' -> (response, where it came from) '''
+      entry, fresh = self.cache.get(url, data)
+      if entry is not None and fresh and not refresh:
+         return CachedResponse(entry['url'], entry['headers'], entry['payload']), 'cache'
+      validators = {}
+      if entry is not None:
+         headers = CachedResponse(entry['url'], entry['headers'], None)
+         if headers.getheader('ETag'):
+            validators['If-None-Match'] = headers.getheader('ETag')
+         if headers.getheader('Last-Modified'):
+            validators['If-Modified-Since'] = headers.getheader('Last-Modified')
+      try:
+         resp = self.opener.open(urllib.request.Request(url, data, validators), timeout=self.timeout)
+      except urllib.error.HTTPError as err:
+         if err.code != 304 or entry is None:
+            raise
+         self.cache.touch(url, data)
+         return CachedResponse(entry['url'], entry['headers'], entry['payload']), 'revalidated'
+      payload = resp.read()
+      self.cache.put(url, data, resp.geturl(), resp.getheaders(), payload)
+      return CachedResponse(resp.geturl(), resp.getheaders(), payload), 'network'
@@ -0,0 +1,331 @@
+import random, datetime, string, json, unicodedata
+from array import array
+from urllib.parse import urlsplit, parse_qs
+import learnit2
+
+first_names = ['Anders', 'Anne', 'Bo', 'Camilla', 'Christian', 'Emil', 'Freja', 'Frederik',
+   'Ida', 'Jens', 'Julie', 'Kasper', 'Lærke', 'Mads', 'Maria', 'Mikkel', 'Nanna', 'Niels',
+   'Oliver', 'Rasmus', 'Sara', 'Signe', 'Søren', 'Thomas', 'Victor', 'Åse']
+last_names = ['Andersen', 'Christensen', 'Dybdahl', 'Hansen', 'Jensen', 'Jørgensen', 'Larsen',
+   'Madsen', 'Mortensen', 'Nielsen', 'Olsen', 'Pedersen', 'Petersen', 'Poulsen', 'Rasmussen',
+   'Sørensen', 'Thomsen', 'Østergaard']
+
+VIEW, SUBMIT, GRADE = range(3)
+grade_names = {learnit2.NO_GRADE: 'No grade', learnit2.APPROVED: 'Approved', learnit2.NOT_APPROVED: 'Not approved'}
+grade_codes = {learnit2.NO_GRADE: '-1', learnit2.APPROVED: '1', learnit2.NOT_APPROVED: '2'}
+log_header = ['Course', 'Time', 'IP address', 'User full name', 'Action', 'Information']
+
+ITU = 'https://learnit.itu.dk'
+WAYF_LOGIN = 'https://wayf.itu.dk/module.php/core/loginuserpass.php'
+WAYF_ACS = 'https://wayf.wayf.dk/module.php/saml/sp/saml2-acs.php/wayf.wayf.dk'
+LEARNIT_ACS = ITU + '/simplesaml/module.php/saml/sp/saml2-acs.php/default-sp'
+
+def group_name(i):
+   ''' 0 -> A, 25 -> Z, 26 -> AA, ... like the learnit group names '''
+   name = ''
+   i += 1
+   while i:
+      i, r = divmod(i - 1, 26)
+      name = string.ascii_uppercase[r] + name
+   return name
+
+def show_time(time):
+   return time.strftime('%A, %d %B %Y, %I:%M %p')
+
+def html_page(title, body):
+   return ('<!DOCTYPE html>\n<html><head><title>{}</title></head>\n<body id="page">'
+      '<div class="usermenu"><a href="{}/user/profile.php?id=100000"><em><i class="fa fa-user"></i>'
+      'Thomas Dybdahl Ahle</em></a></div>\n{}\n</body></html>').format(title, ITU, body)
+
+class MockCourse:
+   ''' A made up course at a given scale, and the learnit and login pages
+       for it as respond(method, url, post field names) gives them to a
+       learnit_replay.StandInServer. The log is kept in arrays, so a million
+       rows only take a few megabytes, and pages are made when asked for.
+       Posted values are not seen by respond, so every login succeeds and
+       saved grades do not change the course. '''
+   def __init__(self, n_students=150, n_assignments=10, n_log=10000, group_size=3,
+         n_teachers=10, cid='3003023', seed=0):
+      rand = random.Random(seed)
+      self.cid = cid
+      self.start = datetime.datetime(2015, 1, 26)
+      self.n_teachers = n_teachers
+      # Persons, teachers first. Students are sorted by pid, like the grading table.
+      self.pids = [str(100000 + i) for i in range(n_teachers)] + [str(200000 + i) for i in range(n_students)]
+      self.names = ['{} {}'.format(rand.choice(first_names), rand.choice(last_names)) for _ in self.pids]
+      ascii = lambda s: unicodedata.normalize('NFD', s).encode('ascii', 'ignore').decode().lower()
+      self.emails = ['{}{}{}@itu.dk'.format(ascii(name)[:2], ascii(name.split()[-1])[:2], i)
+         for i, name in enumerate(self.names)]
+      self.last_access = [self.start + datetime.timedelta(minutes=rand.randrange(10**5))
+         if rand.random() < .95 else 0 for _ in self.pids]
+      self.assignments = [(str(40000 + 7 * i), 'Assignment {}: {}'.format(i + 1, rand.choice(last_names)))
+         for i in range(n_assignments)]
+      # A few students never join a group and end up in the default group
+      grouped = n_students - max(1, n_students // 50)
+      self.groups = [(group_name(i), list(range(n_teachers + j, n_teachers + min(j + group_size, grouped))))
+         for i, j in enumerate(range(0, grouped, group_size))]
+      self.group_of = ['Default group'] * len(self.pids) # person -> group name
+      for name, members in self.groups:
+         for person in members:
+            self.group_of[person] = name
+      # The log, newest first. Views are only shown without modaction=-view.
+      self.n_log = n_log
+      self.kinds, self.actors, self.targets = array('b'), array('i'), array('i')
+      self.log_assignments, self.grades = array('i'), array('b')
+      self.changes = array('i') # Indexes of the events that are not views
+      self.by_assignment = [array('i') for _ in self.assignments]
+      students = range(n_teachers, len(self.pids))
+      for i in range(n_log):
+         r = rand.random()
+         kind = VIEW if r < .3 else SUBMIT if r < .65 else GRADE
+         assignment = rand.randrange(n_assignments)
+         self.kinds.append(kind)
+         self.log_assignments.append(assignment)
+         self.actors.append(rand.randrange(n_teachers) if kind == GRADE else rand.choice(students))
+         self.targets.append(rand.choice(students) if kind == GRADE else 0)
+         self.grades.append(rand.choice(list(grade_names)) if kind == GRADE else 0)
+         if kind != VIEW:
+            self.changes.append(i)
+            self.by_assignment[assignment].append(i)
+      # The state of each (group, assignment) follows from its newest events
+      self.submitted, self.graded = set(), {}
+      for i in self.changes:
+         assignment = self.log_assignments[i]
+         if self.kinds[i] == SUBMIT:
+            self.submitted.add((self.group_of[self.actors[i]], assignment))
+         else:
+            self.graded.setdefault((self.group_of[self.targets[i]], assignment), self.grades[i])
+
+   def time(self, i):
+      ''' The time of log event i, a few events to the minute '''
+      return self.start + datetime.timedelta(minutes=(self.n_log - i) // 3)
+
+   def raw_tables(self):
+      ''' (asss, gros, pers, studs, log) as the learnit2.Learnit table methods
+          and get_log should parse them from the pages of this course '''
+      pers = [(pid, None, name, email, last_access) for pid, name, email, last_access
+         in zip(self.pids, self.names, self.emails, self.last_access)]
+      gros = [(name, [self.pids[person] for person in members]) for name, members in self.groups]
+      log = []
+      for i in self.changes:
+         aid = self.assignments[self.log_assignments[i]][0]
+         if self.kinds[i] == GRADE:
+            log.append((learnit2.LOG_GRADE, (self.time(i), self.pids[self.actors[i]], aid,
+               self.pids[self.targets[i]], self.grades[i])))
+         else:
+            log.append((learnit2.LOG_SUBMIT, (self.time(i), self.pids[self.actors[i]], aid)))
+      return list(self.assignments), gros, pers, pers[self.n_teachers:], log
+
+   def respond(self, method, url, fields):
+      ''' -> (status, reason, headers, payload), or None for unknown pages '''
+      parts = urlsplit(url)
+      query = {k: v[0] for k, v in parse_qs(parts.query).items()}
+      page = parts.netloc + parts.path
+      if page == 'learnit.itu.dk/auth/saml':
+         return self.redirect(WAYF_LOGIN + '?AuthState=_mock_state')
+      if page == 'wayf.itu.dk/module.php/core/loginuserpass.php':
+         if method == 'GET':
+            return self.html(self.login_form())
+         return self.html(self.saml_form(WAYF_ACS))
+      if url == WAYF_ACS:
+         return self.html(self.saml_form(LEARNIT_ACS))
+      if url == LEARNIT_ACS:
+         return self.redirect(ITU + '/my/')
+      if page == 'learnit.itu.dk/my/':
+         return self.html(self.dashboard())
+      if query.get('id') == self.cid:
+         if page == 'learnit.itu.dk/course/view.php':
+            return self.html(self.course_view())
+         if page == 'learnit.itu.dk/group/overview.php':
+            return self.html(self.group_overview())
+         if page == 'learnit.itu.dk/user/index.php':
+            return self.html(self.user_index(int(query.get('roleid', 0)),
+               int(query.get('perpage', 20)), int(query.get('page', 0))))
+         if page == 'learnit.itu.dk/report/log/index.php':
+            if query.get('logformat') == 'downloadascsv':
+               aid = query.get('modid')
+               if aid is None: # The whole course
+                  return self.csv(self.log_csv(self.changes))
+               assignment = next((i for i, (aid_, _) in enumerate(self.assignments) if aid_ == aid), None)
+               return self.csv(self.log_csv(self.by_assignment[assignment] if assignment is not None else ()))
+            return self.html(self.log_page(query.get('modaction') == '-view',
+               int(query.get('perpage', 100)), int(query.get('page', 0))))
+      if page == 'learnit.itu.dk/mod/assign/view.php':
+         if method == 'POST':
+            return self.html(html_page('Grading', '<div class="notifysuccess">The grade changes were saved</div>'))
+         assignment = next((i for i, (aid, _) in enumerate(self.assignments) if aid == query.get('id')), None)
+         if assignment is not None and query.get('action') == 'grading':
+            return self.html(self.grading_page(assignment))
+         if assignment is not None and query.get('action') == 'grade':
+            return self.html(self.grading_form(assignment, int(query.get('rownum', 0))))
+      if page == 'learnit.itu.dk/comment/comment_ajax.php':
+         return 200, 'OK', [('Content-Type', 'application/json')], json.dumps({'list': []}).encode('utf-8')
+      if parts.path.startswith('/pluginfile.php/'):
+         return 200, 'OK', [('Content-Type', 'application/octet-stream')], b'%PDF-1.4\n' + b'0' * 10000
+      return None
+
+   def html(self, body):
+      return 200, 'OK', [('Content-Type', 'text/html; charset=utf-8')], body.encode('utf-8')
+
+   def csv(self, body):
+      return 200, 'OK', [('Content-Type', 'text/tab-separated-values; charset=utf-8')], body.encode('utf-8')
+
+   def redirect(self, location):
+      return 303, 'See Other', [('Location', location)], b''
+
+   def login_form(self):
+      return html_page('Log in', '<form action="?" method="post"><input type="hidden" name="AuthState" '
+         'value="_mock_state" /><input type="text" name="username" value="" />'
+         '<input type="password" name="password" value="" /></form>')
+
+   def saml_form(self, action):
+      return html_page('Post data', '<form method="post" action="{}"><input type="hidden" name="SAMLResponse" '
+         'value="PHNhbWxwOlJlc3BvbnNlPg==" /><input type="hidden" name="RelayState" value="" />'
+         '<input type="submit" value="Submit" /></form>'.format(action))
+
+   def dashboard(self):
+      return html_page('Dashboard', '<ul><li>\n<a title="Algorithms and Data Structures" '
+         'href="{0}/course/view.php?id={1}">Algorithms and Data Structures</a></li></ul>'.format(ITU, self.cid))
+
+   def course_view(self):
+      return html_page('Course', '<ul class="section">' + ''.join(
+         '<li class="activity assign modtype_assign " id="module-{0}"><div><a href="{1}/mod/assign/view.php?id={0}">'
+         '<span class="instancename">{2}<span class="accesshide "> Assignment</span></span></a></div></li>\n'.format(
+            aid, ITU, title) for aid, title in self.assignments) + '</ul>')
+
+   def group_overview(self):
+      rows = ['<tr><th class="header c0">Group</th><th class="header c1">Members</th></tr>']
+      for i, (name, members) in enumerate(self.groups):
+         rows.append('<tr class="r{}"><td class="cell c0">{}</td><td class="cell c1">{}</td></tr>\n'.format(
+            i % 2, name, ', '.join('<a href="{}/user/view.php?id={}&amp;course={}">{}</a>'.format(
+               ITU, self.pids[person], self.cid, self.names[person]) for person in members)))
+      return html_page('Groups overview', '<table class="generaltable groupsoverview">' + ''.join(rows) + '</table>')
+
+   def user_index(self, role, perpage, page):
+      if role == learnit2.ROLE_STUDENT:
+         persons = range(self.n_teachers, len(self.pids))
+      elif role == learnit2.ROLE_TEACHER:
+         persons = range(self.n_teachers)
+      else:
+         persons = range(len(self.pids))
+      boxes = []
+      for person in persons[page * perpage:(page + 1) * perpage]:
+         last_access = self.last_access[person]
+         boxes.append('<table class="userinfobox"><tr><td class="left side">'
+            '<a href="{0}/user/view.php?id={1}&amp;course={2}"><img src="{0}/theme/image.php/clean/core/1/u/f1" '
+            'alt="Picture of {3}" class="userpicture" width="100" height="100" /></a></td>'
+            '<td class="content"><div class="username">{3}</div><div class="info">'
+            '<span class="fieldname">Email address:</span> <a href="mailto:{4}">{4}</a><br />'
+            'Last access: {5}<br /></div></td></tr></table>\n'.format(ITU, self.pids[person], self.cid,
+               self.names[person], self.emails[person],
+               last_access.strftime('%A, %d %B %Y, %H:%M') if last_access else 'Never'))
+      return html_page('Participants', '<div class="userlist">{} participants{}</div>'.format(
+         len(persons), ''.join(boxes)))
+
+   def log_page(self, changes_only, perpage, page):
+      events = self.changes if changes_only else range(self.n_log)
+      rows = []
+      for n, i in enumerate(events[page * perpage:(page + 1) * perpage]):
+         actor = self.actors[i]
+         aid = self.assignments[self.log_assignments[i]][0]
+         if self.kinds[i] == VIEW:
+            action, info = 'assign view', 'View own submission status page.'
+         elif self.kinds[i] == SUBMIT:
+            action, info = 'assign submit', 'Submission status: Submitted for grading.'
+         else:
+            target = self.targets[i]
+            action, info = 'assign grade submission', 'Grade student: (id={}, fullname={}). {}.'.format(
+               self.pids[target], self.names[target], grade_names[self.grades[i]])
+         rows.append('<tr class="r{}"><td class="cell c0">{}</td>'
+            '<td class="cell c1"><a href="{}/user/view.php?id={}&amp;course={}">{}</a></td>'
+            '<td class="cell c2">130.226.142.{}</td>'
+            '<td class="cell c3"><a href="{}/mod/assign/view.php?id={}" title="Assignment">{}</a></td>'
+            '<td class="cell c4">{}</td></tr>\n'.format(n % 2, show_time(self.time(i)), ITU, self.pids[actor],
+               self.cid, self.names[actor], actor % 256, ITU, aid, action, info))
+      return html_page('Logs', '<table class="logtable generalbox boxaligncenter">'
+         '<tr><th class="header c0">Time</th><th class="header c1">User full name</th>'
+         '<th class="header c2">IP address</th><th class="header c3">Action</th>'
+         '<th class="header c4">Information</th></tr>\n' + ''.join(rows) + '</table>')
+
+   def log_csv(self, events):
+      lines = ['Saved at: {}'.format(show_time(self.start)), '\t'.join(log_header)]
+      for i in events:
+         aid = self.assignments[self.log_assignments[i]][0]
+         if self.kinds[i] == SUBMIT:
+            action, info = 'assign submit (view.php?id={})'.format(aid), 'Submission status: Submitted for grading.'
+         else:
+            target = self.targets[i]
+            action = 'assign grade submission (view.php?id={})'.format(aid)
+            info = 'Grade student: (id={}, fullname={}). {}.'.format(
+               self.pids[target], self.names[target], grade_names[self.grades[i]])
+         lines.append('\t'.join(['ADS', show_time(self.time(i)), '130.226.142.1',
+            self.names[self.actors[i]], action, info]))
+      return '\n'.join(lines) + '\n'
+
+   def grading_page(self, assignment):
+      rows = []
+      for row, person in enumerate(range(self.n_teachers, len(self.pids))):
+         pid, name, group = self.pids[person], self.names[person], self.group_of[person]
+         grade = self.graded.get((group, assignment))
+         status = 'Submitted for grading' if (group, assignment) in self.submitted else 'No submission'
+         options = ''.join('<option value="{}"{}>{}</option>'.format(
+            grade_codes[code], ' selected="selected"' if code == grade else '', grade_names[code])
+            for code in grade_names)
+         cells = [
+            '<input type="checkbox" name="selectedusers" value="{0}" id="selectuser_{0}" class="selection" />'
+               '<label for="selectuser_{0}" class="accesshide">Select {1}</label>'.format(pid, name),
+            '<a href="{0}/user/view.php?id={1}&amp;course={2}"><img src="{0}/theme/image.php/clean/core/1/u/f2" '
+               'alt="Picture of {3}" title="Picture of {3}" class="userpicture defaultuserpic" width="35" height="35" />'
+               '</a>'.format(ITU, pid, self.cid, name),
+            '<a href="{}/user/view.php?id={}&amp;course={}">{}</a>'.format(ITU, pid, self.cid, name),
+            self.emails[person],
+            '<div class="groupname">Group {}</div>'.format(group) if group != 'Default group' else '',
+            '<select name="quickgrade_{}" class="quickgrade">{}</select>'.format(pid, options),
+            status,
+            show_time(self.start),
+            '<div class="fileuploadsubmission"><a href="{}/pluginfile.php/{}/assignsubmission_file/submission_files/'
+               '{}/report.pdf?forcedownload=1">report.pdf</a></div>'.format(ITU, 500000 + assignment, row)
+               if status != 'No submission' else '',
+            '<div class="no-overflow">Feedback for {} goes here</div>'.format(name) if grade is not None else '',
+         ]
+         rows.append('<tr class="r{} unselectedrow" id="mod_assign_grading_r{}">'.format(row % 2, row)
+            + ''.join('<td class="cell c{0}" id="mod_assign_grading_r{1}_c{0}">{2}</td>'.format(j, row, cell)
+               for j, cell in enumerate(cells)) + '</tr>\n')
+      return html_page('Grading', '<div>Group submission status</div>'
+         '<table class="flexible generaltable generalbox">' + ''.join(rows) + '</table>')
+
+   def grading_form(self, assignment, row):
+      aid = self.assignments[assignment][0]
+      person = self.n_teachers + row
+      group = self.group_of[person]
+      form = ('<form autocomplete="off" action="{}/mod/assign/view.php" method="post" accept-charset="utf-8" '
+         'id="mform1" class="gradeform mform">'.format(ITU) + ''.join(
+            '<input name="{}" type="hidden" value="{}" />'.format(name, value) for name, value in [
+               ('id', aid), ('rownum', row), ('useridlistid', '5535d2d39d9c1'), ('attemptnumber', '-1'),
+               ('ajax', '0'), ('action', 'submitgrade'), ('sesskey', 'mocksesskey'),
+               ('_qf__mod_assign_grade_form_{}'.format(row), '1')]))
+      if (group, assignment) not in self.submitted:
+         return html_page('Grade', form + '<div class="submissionstatustable">'
+            'Nothing has been submitted for this assignment</div></form>')
+      grade = self.graded.get((group, assignment), learnit2.NO_GRADE)
+      context_id = 500000 + assignment
+      comment = json.dumps({'client_id': '5535d2d3a1b2c', 'commentarea': 'submission_comments',
+         'itemid': 100000 + row, 'courseid': self.cid, 'contextid': context_id, 'component': 'assignsubmission_comments'})
+      options = ''.join('<option value="{}"{}>{}</option>'.format(
+         grade_codes[code], ' selected="selected"' if code == grade else '', grade_names[code])
+         for code in grade_names)
+      return html_page('Grade', '<table class="generaltable">'
+         '<tr><td class="cell c0">Submission status</td><td class="cell c1 submissionstatussubmitted">'
+         'Submitted for grading</td></tr>'
+         '<tr><td class="cell c0">Grading status</td><td class="cell c1">Graded</td></tr>'
+         '<tr><td class="cell c0">Last modified</td><td class="cell c1">{0}</td></tr>'
+         '<tr><td class="cell c0">File submissions</td><td class="cell c1"><a href="{1}/pluginfile.php/{2}/'
+         'assignsubmission_file/submission_files/{3}/report.pdf?forcedownload=1">report.pdf</a></td></tr>'
+         '<tr><td class="cell c0">Submission comments</td><td class="cell c1">'
+         '<a class="comment-link" href="#"><span>Comments (0)</span></a></td></tr></table>'
+         '<script>M.core_comment.init(Y, {4});</script>'
+         '<div class="grade">Grade: <a href="{1}/grade/report/grader/index.php?id={5}">{6}</a></div>'
+         '{7}<select name="grade" id="id_grade">{8}</select>'
+         '<textarea id="id_assignfeedbackcomments_editor" name="assignfeedbackcomments_editor[text]" rows="15" cols="80">'
+         'Feedback for {9}</textarea></form>'.format(show_time(self.start), ITU, context_id, row, comment,
+            self.cid, grade_names[grade], form, options, self.names[person]))
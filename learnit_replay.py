@@ -0,0 +1,207 @@
+import urllib.request, http.server, http.client
+import os, io, json, time, hashlib, threading
+from urllib.parse import parse_qs
+from collections import defaultdict
+from learnit_http import ConnectionPool, KeepAliveMixin, KeepAliveHTTPHandler, KeepAliveHTTPSHandler
+
+# Headers that only describe one connection, or would carry the session along
+skipped_headers = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'set-cookie'}
+
+def post_fields(data):
+   ''' The field names of url encoded post data, which is all that is
+       recorded of it, as it may hold passwords '''
+   if not data:
+      return []
+   return sorted(parse_qs(data.decode('utf-8'), keep_blank_values=True))
+
+class ReplayedResponse:
+   ''' A response made from a recorded or generated payload, with the
+       interface urllib handlers and LoggingOpener use '''
+   def __init__(self, url, status, reason, headers, payload):
+      self.url = url
+      self.code = self.status = status
+      self.msg = self.reason = reason
+      self.headers = http.client.HTTPMessage()
+      for name, value in headers:
+         self.headers[name] = value
+      self.body = io.BytesIO(payload)
+   def info(self):
+      return self.headers
+   def geturl(self):
+      return self.url
+   def getcode(self):
+      return self.code
+   def getheaders(self):
+      return self.headers.items()
+   def getheader(self, name, default=None):
+      return self.headers.get(name, default)
+   def read(self, amt=None):
+      return self.body.read(amt)
+   def close(self):
+      pass
+   def __enter__(self):
+      return self
+   def __exit__(self, *exc):
+      self.close()
+
+class Fixtures:
+   ''' Recorded responses in a directory: an index.json of the requests in
+       the order they were made, and the payloads in files named by their
+       sha1. Responses are kept as they came, so recordings of a real course
+       hold names and emails and should stay private. '''
+   def __init__(self, path):
+      self.path = path
+      self.lock = threading.Lock()
+      self.entries = []
+      os.makedirs(path, mode=0o700, exist_ok=True)
+      try:
+         with open(os.path.join(path, 'index.json')) as f:
+            self.entries = json.load(f)
+      except FileNotFoundError:
+         pass
+      self.rewind()
+
+   def key(self, method, url, fields):
+      return method, url.split('#')[0], tuple(fields)
+
+   def add(self, method, url, fields, status, reason, headers, payload):
+      name = hashlib.sha1(payload).hexdigest()
+      body_path = os.path.join(self.path, name)
+      if not os.path.exists(body_path):
+         with open(body_path + '.tmp', 'wb') as f:
+            f.write(payload)
+         os.replace(body_path + '.tmp', body_path)
+      headers = [(k, v) for k, v in headers if k.lower() not in skipped_headers]
+      with self.lock:
+         self.entries.append({'method': method, 'url': url, 'fields': list(fields),
+            'status': status, 'reason': reason, 'headers': headers, 'body': name})
+
+   def save(self):
+      with self.lock:
+         with open(os.path.join(self.path, 'index.json.tmp'), 'w') as f:
+            json.dump(self.entries, f, indent=1)
+         os.replace(os.path.join(self.path, 'index.json.tmp'), os.path.join(self.path, 'index.json'))
+         self.rewind()
+
+   def rewind(self):
+      ''' Start replaying every request from its first recorded response '''
+      self.recorded = defaultdict(list)
+      for entry in self.entries:
+         self.recorded[self.key(entry['method'], entry['url'], entry['fields'])].append(entry)
+      self.replayed = defaultdict(int)
+
+   def respond(self, method, url, fields):
+      ''' -> (status, reason, headers, payload) of the next recorded response
+          to the request, or None if it was never made. A request made more
+          often than recorded gets the last response again. '''
+      key = self.key(method, url, fields)
+      with self.lock:
+         entries = self.recorded.get(key)
+         if not entries:
+            return None
+         entry = entries[min(self.replayed[key], len(entries) - 1)]
+         self.replayed[key] += 1
+      with open(os.path.join(self.path, entry['body']), 'rb') as f:
+         payload = f.read()
+      return entry['status'], entry['reason'], entry['headers'], payload
+
+class RecordingHandler(urllib.request.BaseHandler):
+   ''' Records every response an opener gets into fixtures, redirects and
+       error pages included '''
+   handler_order = 900 # After the cookie processor, before redirects and errors are handled
+
+   def __init__(self, fixtures):
+      self.fixtures = fixtures
+
+   def http_response(self, req, resp):
+      payload = resp.read()
+      resp.close()
+      self.fixtures.add(req.get_method(), req.get_full_url(), post_fields(req.data),
+         resp.status, resp.reason, resp.getheaders(), payload)
+      return ReplayedResponse(resp.geturl(), resp.status, resp.reason, resp.getheaders(), payload)
+
+   https_response = http_response
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+   protocol_version = 'HTTP/1.1'
+   disable_nagle_algorithm = True
+
+   def do_GET(self):
+      body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+      url = '{}://{}{}'.format(self.headers.get('X-Forwarded-Proto', 'https'),
+         self.headers['Host'], self.path)
+      if self.server.latency:
+         time.sleep(self.server.latency)
+      response = self.server.respond(self.command, url, post_fields(body))
+      if response is None:
+         with self.server.lock:
+            self.server.misses.append((self.command, url))
+         response = 404, 'Not Found', [('Content-Type', 'text/plain')], b'Not recorded'
+      status, reason, headers, payload = response
+      self.send_response(status, reason)
+      for name, value in headers:
+         if name.lower() not in skipped_headers:
+            self.send_header(name, value)
+      self.send_header('Content-Length', str(len(payload)))
+      self.end_headers()
+      if self.command != 'HEAD':
+         self.wfile.write(payload)
+
+   do_POST = do_HEAD = do_GET
+
+   def log_message(self, *args):
+      pass
+
+class StandInServer(http.server.ThreadingHTTPServer):
+   ''' A local http server standing in for learnit and the login servers.
+       Requests are answered by respond(method, url, post field names), like
+       Fixtures.respond, after latency seconds to stand in for the network.
+       Requests it has no answer to get a 404 and are listed in misses. '''
+   daemon_threads = True
+
+   def __init__(self, respond, latency=0):
+      http.server.ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+      self.respond = respond
+      self.latency = latency
+      self.lock = threading.Lock()
+      self.misses = []
+
+   def start(self):
+      threading.Thread(target=self.serve_forever, daemon=True).start()
+      return self
+
+   def stop(self):
+      self.shutdown()
+      self.server_close()
+
+class LocalRouteHandler(KeepAliveMixin, urllib.request.HTTPHandler, urllib.request.HTTPSHandler):
+   ''' Sends the http and https requests for every host over plain http to
+       the local server at address, on pooled connections. The host and
+       scheme asked for go along in the Host and X-Forwarded-Proto headers. '''
+   def __init__(self, address, pool=None):
+      urllib.request.HTTPSHandler.__init__(self)
+      self.address = address
+      self.pool = pool or ConnectionPool()
+
+   def http_open(self, req):
+      return self.__route(req, 'http')
+
+   def https_open(self, req):
+      return self.__route(req, 'https')
+
+   def __route(self, req, scheme):
+      req.add_unredirected_header('X-Forwarded-Proto', scheme)
+      return self.keepalive_open(req, scheme, self.__connect)
+
+   def __connect(self, host, timeout=None):
+      return http.client.HTTPConnection(*self.address, timeout=timeout)
+
+def recording_handlers(fixtures, pool=None):
+   ''' Handlers for a Learnit client that fetch from the network as usual and
+       record what they get into fixtures '''
+   pool = pool or ConnectionPool()
+   return [KeepAliveHTTPHandler(pool), KeepAliveHTTPSHandler(pool), RecordingHandler(fixtures)]
+
+def replay_handlers(server):
+   ''' Handlers for a Learnit client that sends every request to server '''
+   return [LocalRouteHandler(server.server_address)]
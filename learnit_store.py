@@ -0,0 +1,341 @@
+import sqlite3, datetime
+from collections import Counter, defaultdict
+import learnit2
+
+SCHEMA_VERSION = 2
+
+schema = '''
+create table meta (key text primary key, value text);
+create table grades (grade integer primary key);
+create table persons (pos integer primary key, pid text, name text, email text, icon text, last_access);
+create table groups (pos integer primary key, name text);
+create table assignments (pos integer primary key, aid text, title text);
+create table students (pos integer primary key, person integer, grp integer);
+create table teachers (pos integer primary key, person integer);
+create table submissions (pos integer primary key, row integer, grp integer, assignment integer);
+create table grade_actions (id integer primary key, time text, grade integer,
+   teacher integer, teacher_seq integer, submission integer, submission_seq integer);
+create table submit_actions (id integer primary key, time text,
+   student integer, student_seq integer, submission integer, submission_seq integer);
+create index persons_pid on persons (pid);
+create index groups_name on groups (name collate nocase);
+create index assignments_aid on assignments (aid);
+create index students_grp on students (grp);
+create index submissions_grp on submissions (grp, assignment);
+create index submissions_assignment on submissions (assignment);
+create index grade_actions_submission on grade_actions (submission, time);
+create index grade_actions_teacher on grade_actions (teacher, teacher_seq);
+create index submit_actions_submission on submit_actions (submission, time);
+create index submit_actions_student on submit_actions (student, student_seq);
+-- The state of each submission is kept up to date as its actions are
+-- inserted: the latest submit, the latest grade, and the grade shown, which
+-- follows from them as in submission_grade. The number of submissions with
+-- each grade is kept per group and per assignment as the grades change.
+create table submission_states (submission integer primary key, grp integer, assignment integer,
+   last_submit text, last_grade_time text, last_grade integer, grade integer);
+create index submission_states_grp on submission_states (grp, submission);
+create table group_grades (grp integer, grade integer, count integer, primary key (grp, grade));
+create table assignment_grades (assignment integer, grade integer, count integer, primary key (assignment, grade));
+create trigger group_grades_init after insert on groups begin
+   insert into group_grades select new.pos, grade, 0 from grades;
+end;
+create trigger assignment_grades_init after insert on assignments begin
+   insert into assignment_grades select new.pos, grade, 0 from grades;
+end;
+create trigger submission_state_init after insert on submissions begin
+   insert into submission_states values (new.pos, new.grp, new.assignment, null, null, null, {NO_SUBMISSION});
+end;
+create trigger submission_state_count after insert on submission_states begin
+   update group_grades set count = count + 1 where grp = new.grp and grade = new.grade;
+   update assignment_grades set count = count + 1 where assignment = new.assignment and grade = new.grade;
+end;
+create trigger submission_state_submit after insert on submit_actions begin
+   update submission_states set last_submit = new.time
+   where submission = new.submission and (last_submit is null or last_submit < new.time);
+end;
+create trigger submission_state_grade after insert on grade_actions begin
+   update submission_states set last_grade_time = new.time, last_grade = new.grade
+   where submission = new.submission and (last_grade_time is null or last_grade_time < new.time
+      or (last_grade_time = new.time and last_grade < new.grade));
+end;
+create trigger submission_state_update after update of last_submit, last_grade_time, last_grade
+      on submission_states begin
+   update submission_states set grade = case
+         when new.last_submit is null then {NO_SUBMISSION}
+         when new.last_grade_time >= new.last_submit then new.last_grade
+         else {NO_GRADE} end
+   where submission = new.submission;
+end;
+create trigger submission_state_move after update of grade on submission_states
+      when old.grade != new.grade begin
+   update group_grades set count = count - 1 where grp = old.grp and grade = old.grade;
+   update group_grades set count = count + 1 where grp = new.grp and grade = new.grade;
+   update assignment_grades set count = count - 1 where assignment = old.assignment and grade = old.grade;
+   update assignment_grades set count = count + 1 where assignment = new.assignment and grade = new.grade;
+end;
+'''.format(NO_GRADE=learnit2.NO_GRADE, NO_SUBMISSION=learnit2.NO_SUBMISSION)
+
+def to_time(value):
+   ''' Inverse of the iso format times are stored in. Other values, like the 0
+       used for a last access of 'Never', are stored as they are. '''
+   if isinstance(value, str):
+      return datetime.datetime.fromisoformat(value)
+   return value
+
+def from_time(value):
+   if isinstance(value, datetime.datetime):
+      return value.isoformat()
+   return value
+
+def submission_grade(last_submit, last_grade_time, last_grade):
+   ''' The grade shown for a submission, given its latest submit and grade.
+       The store keeps it in submission_states.grade. '''
+   if last_submit is None:
+      return learnit2.NO_SUBMISSION
+   if last_grade_time is not None and last_grade_time >= last_submit:
+      return last_grade
+   return learnit2.NO_GRADE
+
+class CourseStore:
+   ''' A versioned sqlite copy of the Tables of a course, which commands can
+       query without loading the whole course. The store only caches what is
+       on learnit, so a store from another schema version is just emptied. '''
+   def __init__(self, path):
+      self.db = sqlite3.connect(path)
+      version, = self.db.execute('pragma user_version').fetchone()
+      if version != SCHEMA_VERSION:
+         self.clear()
+
+   def clear(self):
+      with self.db:
+         for kind, name in self.db.execute(
+               "select type, name from sqlite_master where type in ('table', 'view')").fetchall():
+            self.db.execute('drop {} if exists {}'.format(kind, name))
+         self.db.executescript(schema)
+         self.db.executemany('insert into grades values (?)', ((grade,) for grade in learnit2.grade_to_name))
+         self.db.execute('pragma user_version = {}'.format(SCHEMA_VERSION))
+
+   def close(self):
+      self.db.close()
+
+   def is_empty(self):
+      return self.db.execute("select 1 from meta where key = 'synced'").fetchone() is None
+
+   def newest(self):
+      ''' The time of the newest log entry the store has been synced with '''
+      row = self.db.execute("select value from meta where key = 'newest'").fetchone()
+      return to_time(row[0]) if row else None
+
+   def save(self, tables, newest):
+      ''' Replace the content of the store with tables, synced up to newest '''
+      pos = lambda items: {id(item): i for i, item in enumerate(items)}
+      persons = {}
+      for person in [s.person for s in tables.students] + [t.person for t in tables.teachers]:
+         persons.setdefault(person, len(persons))
+      groups = pos(tables.groups)
+      assignments = pos(tables.assignments)
+      students = pos(tables.students)
+      teachers = pos(tables.teachers)
+      submissions = pos(tables.submissions)
+      teacher_seqs = {id(ga): (teachers[id(t)], i)
+         for t in tables.teachers for i, ga in enumerate(t.grade_actions)}
+      student_seqs = {id(sa): (students[id(s)], i)
+         for s in tables.students for i, sa in enumerate(s.submit_actions)}
+      with self.db:
+         for table in ('meta', 'persons', 'groups', 'assignments', 'students', 'teachers',
+               'submissions', 'grade_actions', 'submit_actions',
+               'submission_states', 'group_grades', 'assignment_grades'):
+            self.db.execute('delete from ' + table)
+         self.db.executemany('insert into persons values (?, ?, ?, ?, ?, ?)',
+            ((i, p.id, p.name, p.email, p.icon, from_time(p.last_access)) for p, i in persons.items()))
+         self.db.executemany('insert into groups values (?, ?)',
+            ((i, g.name) for i, g in enumerate(tables.groups)))
+         self.db.executemany('insert into assignments values (?, ?, ?)',
+            ((i, a.id, a.title) for i, a in enumerate(tables.assignments)))
+         self.db.executemany('insert into students values (?, ?, ?)',
+            ((i, persons[s.person], groups[id(s.group)]) for i, s in enumerate(tables.students)))
+         self.db.executemany('insert into teachers values (?, ?)',
+            ((i, persons[t.person]) for i, t in enumerate(tables.teachers)))
+         self.db.executemany('insert into submissions values (?, ?, ?, ?)',
+            ((i, s.row, groups[id(s.group)], assignments[id(s.assignment)])
+               for i, s in enumerate(tables.submissions)))
+         self.db.executemany('insert into grade_actions values (null, ?, ?, ?, ?, ?, ?)',
+            ((from_time(ga.time), ga.grade) + teacher_seqs[id(ga)] + (i, j)
+               for i, s in enumerate(tables.submissions)
+               for j, ga in enumerate(s.grade_actions)))
+         self.db.executemany('insert into submit_actions values (null, ?, ?, ?, ?, ?)',
+            ((from_time(sa.time),) + student_seqs[id(sa)] + (i, j)
+               for i, s in enumerate(tables.submissions)
+               for j, sa in enumerate(s.submit_actions)))
+         self.db.executemany('insert into meta values (?, ?)',
+            [('synced', from_time(datetime.datetime.now())), ('newest', from_time(newest))])
+
+   def load(self, group_names=None):
+      ''' Load the stored Tables. Given group names, only those groups with
+          their students, submissions and actions are loaded, along with all
+          assignments and teachers. '''
+      if group_names is None:
+         grp_filter, args = '', ()
+      else:
+         args = tuple(pos for pos, name in self.db.execute('select pos, name from groups')
+            if name in group_names)
+         grp_filter = 'where grp in ({})'.format(', '.join('?' * len(args)))
+      sub_filter = grp_filter and 'where submission in (select pos from submissions {})'.format(grp_filter)
+      q = lambda sql, args=(): self.db.execute(sql, args).fetchall()
+      persons = {pos: learnit2.Person(pid, name, email, icon, to_time(last_access))
+         for pos, pid, name, email, icon, last_access in q('select * from persons')}
+      groups = {pos: learnit2.Group(name, [], [])
+         for pos, name in q('select pos, name from groups {} order by pos'.format(
+            grp_filter.replace('grp', 'pos', 1)), args)}
+      assignments = {pos: learnit2.Assignment(aid, title, [])
+         for pos, aid, title in q('select * from assignments order by pos')}
+      teachers = {pos: learnit2.Teacher(persons[person], [])
+         for pos, person in q('select * from teachers order by pos')}
+      students = {pos: learnit2.Student(persons[person], groups[grp], [])
+         for pos, person, grp in q('select * from students {} order by pos'.format(grp_filter), args)}
+      submissions = {pos: learnit2.Submission(row, groups[grp], assignments[assignment], [], [])
+         for pos, row, grp, assignment in q('select * from submissions {} order by pos'.format(grp_filter), args)}
+      for student in students.values():
+         student.group.students.append(student)
+      for submission in submissions.values():
+         submission.assignment.submissions.append(submission)
+         submission.group.submissions.append(submission)
+      grade_actions = {}
+      for id_, time, grade, teacher, submission in q('select id, time, grade, teacher, submission '
+            'from grade_actions {} order by submission, submission_seq'.format(sub_filter), args):
+         grade_actions[id_] = learnit2.GradeAction(to_time(time), grade, teachers[teacher], submissions[submission])
+         submissions[submission].grade_actions.append(grade_actions[id_])
+      for id_, teacher in q('select id, teacher from grade_actions {} order by teacher, teacher_seq'.format(sub_filter), args):
+         teachers[teacher].grade_actions.append(grade_actions[id_])
+      submit_actions = {}
+      for id_, time, student, submission in q('select id, time, student, submission '
+            'from submit_actions {} order by submission, submission_seq'.format(sub_filter), args):
+         submit_actions[id_] = learnit2.SubmitAction(to_time(time), students[student], submissions[submission])
+         submissions[submission].submit_actions.append(submit_actions[id_])
+      for id_, student in q('select id, student from submit_actions {} order by student, student_seq'.format(sub_filter), args):
+         students[student].submit_actions.append(submit_actions[id_])
+      return learnit2.Tables(*(list(table.values())
+         for table in (groups, assignments, teachers, students, submissions)))
+
+   def add_actions(self, log, since, unresolved=None):
+      ''' Insert the actions of an iterable of log events, newest first, as
+          learnit2.merge_log attaches them to the stored tables, and mark the
+          store synced up to the newest of them. Only the new rows are
+          written, and the triggers update the states they change. Events
+          newer than since that match nothing in the store are appended to
+          the list unresolved, if given. Returns the time of the newest
+          event seen. '''
+      q = lambda sql, args=(): self.db.execute(sql, args).fetchall()
+      teachers = defaultdict(list) # pid -> [teacher]
+      for pos, pid in q('select t.pos, p.pid from teachers t join persons p on p.pos = t.person order by t.pos'):
+         teachers[pid].append(pos)
+      students = defaultdict(list) # pid -> [(student, group name)]
+      for pos, pid, name in q('''select s.pos, p.pid, g.name from students s
+            join persons p on p.pos = s.person join groups g on g.pos = s.grp order by s.pos'''):
+         students[pid].append((pos, name))
+      submissions = defaultdict(list) # (aid, group name) -> [submission]
+      for pos, aid, name in q('''select s.pos, a.aid, g.name from submissions s
+            join assignments a on a.pos = s.assignment join groups g on g.pos = s.grp order by s.pos'''):
+         submissions[aid, name].append(pos)
+      # The actions of the minute of since that the store already has
+      known = Counter()
+      if since is not None:
+         known.update(q('select time, grade, teacher, submission from grade_actions where time = ?',
+            (from_time(since),)))
+         known.update(q('select time, student, submission from submit_actions where time = ?',
+            (from_time(since),)))
+      grade_actions, submit_actions = [], []
+      newest = since
+      for kind, row in log:
+         time = row[0]
+         if since is not None and time < since:
+            continue
+         if newest is None or time > newest:
+            newest = time
+         new = unresolved is not None and (since is None or time > since)
+         if kind == learnit2.LOG_GRADE:
+            time, pid0, aid, pid1, grade = row
+            matches = sorted((submission, j)
+               for j, (_, group) in enumerate(students.get(pid1, ()))
+               for submission in submissions.get((aid, group), ()))
+            if new and not (matches and teachers.get(pid0)):
+               unresolved.append((kind, row))
+            for teacher in teachers.get(pid0, ()):
+               for submission, _ in matches:
+                  action = (from_time(time), grade, teacher, submission)
+                  if known[action]:
+                     known[action] -= 1
+                  else:
+                     grade_actions.append(action)
+         if kind == learnit2.LOG_SUBMIT:
+            time, pid0, aid = row
+            if new and not any(submissions.get((aid, group))
+                  for _, group in students.get(pid0, ())):
+               unresolved.append((kind, row))
+            for student, group in students.get(pid0, ()):
+               for submission in submissions.get((aid, group), ()):
+                  action = (from_time(time), student, submission)
+                  if known[action]:
+                     known[action] -= 1
+                  else:
+                     submit_actions.append(action)
+      # The new actions go before the older ones of each list, so they are
+      # numbered down from the lowest sequence number the list has
+      def sequence(table, column, actions, key):
+         counts = Counter(action[key] for action in actions)
+         seqs = {}
+         for pos, count in counts.items():
+            first, = self.db.execute('select min({0}_seq) from {1} where {0} = ?'.format(column, table),
+               (pos,)).fetchone()
+            seqs[pos] = (first or 0) - count
+         numbers = []
+         for action in actions:
+            numbers.append(seqs[action[key]])
+            seqs[action[key]] += 1
+         return numbers
+      with self.db:
+         self.db.executemany('insert into grade_actions values (null, ?, ?, ?, ?, ?, ?)',
+            ((t, grade, teacher, teacher_seq, submission, submission_seq)
+               for (t, grade, teacher, submission), teacher_seq, submission_seq in zip(grade_actions,
+                  sequence('grade_actions', 'teacher', grade_actions, 2),
+                  sequence('grade_actions', 'submission', grade_actions, 3))))
+         self.db.executemany('insert into submit_actions values (null, ?, ?, ?, ?, ?)',
+            ((t, student, student_seq, submission, submission_seq)
+               for (t, student, submission), student_seq, submission_seq in zip(submit_actions,
+                  sequence('submit_actions', 'student', submit_actions, 1),
+                  sequence('submit_actions', 'submission', submit_actions, 2))))
+         self.db.executemany('insert or replace into meta values (?, ?)',
+            [('synced', from_time(datetime.datetime.now())), ('newest', from_time(newest))])
+      return newest
+
+   def group_status(self, group_name):
+      ''' group name -> [(aid, title, grade)], or None if there is no such group '''
+      group = self.db.execute('select pos from groups where name = ? collate nocase order by pos',
+         (group_name,)).fetchone()
+      if group is None:
+         return None
+      return self.db.execute('''
+         select a.aid, a.title, s.grade
+         from submission_states s join assignments a on a.pos = s.assignment
+         where s.grp = ? order by s.submission''', group).fetchall()
+
+   def results(self):
+      ''' -> [(group name, [email], {grade: number of submissions})] '''
+      emails = {}
+      for grp, email in self.db.execute('''
+            select s.grp, p.email from students s join persons p on p.pos = s.person
+            order by s.pos'''):
+         emails.setdefault(grp, []).append(email)
+      counts = {}
+      for grp, grade, count in self.db.execute('select grp, grade, count from group_grades where count > 0'):
+         counts.setdefault(grp, {})[grade] = count
+      return [(name, emails.get(grp, []), counts.get(grp, {}))
+         for grp, name in self.db.execute('select pos, name from groups order by pos')]
+
+   def assignment_results(self):
+      ''' -> [(aid, title, {grade: number of submissions})] '''
+      counts = {}
+      for pos, grade, count in self.db.execute('select assignment, grade, count from assignment_grades where count > 0'):
+         counts.setdefault(pos, {})[grade] = count
+      return [(aid, title, counts.get(pos, {}))
+         for pos, aid, title in self.db.execute('select pos, aid, title from assignments order by pos')]
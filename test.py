@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
-import unittest, json, learnit
+import unittest, json, learnit, tempfile, os
 
 with open('.password') as f:
    password = json.loads(f.read())
+session_file = '.session'
 
 
 class TestErrors(unittest.TestCase):
@@ -18,9 +19,20 @@ class TestSuccess(unittest.TestCase):
 
    def setUp(self):
       self.client = learnit.Learnit()
-      self.data_my, er = self.client.login(password['username'], password['password'])
+      self.data_my, er = self.client.resume_session(session_file)
+      if er != learnit.SUCCESS:
+         self.data_my, er = self.client.login(password['username'], password['password'])
+         self.client.save_session(session_file)
       self.assertEqual(er, learnit.SUCCESS)
 
+   def test_session(self):
+      client = learnit.Learnit()
+      data_my, er = client.resume_session(session_file)
+      self.assertEqual(er, learnit.SUCCESS)
+      self.assertEqual(client.get_logininfo(data_my), self.client.get_logininfo(self.data_my))
+      _, er = learnit.Learnit().resume_session('.no-such-session')
+      self.assertEqual(er, learnit.SESSION_EXPIRED)
+
    def test_info(self):
       name = self.client.get_logininfo(self.data_my)
       self.assertTrue(name.istitle())
@@ -51,6 +63,16 @@ class TestSuccess(unittest.TestCase):
       self.assertEqual(type(sub), learnit.Submission)
       self.assertEqual(type(sub.comments), list)
 
+   def test_submissions(self):
+      aid, rows = next((aid, subs)
+         for cid in self.client.list_my_courses(self.data_my).keys()
+         for aid in self.client.list_assignments(cid).keys()
+         for subs in [self.client.list_submissions(aid)] if subs)
+      fetched = dict(self.client.show_submissions(aid, workers=4, rate=10))
+      self.assertEqual(set(fetched), set(row.row for row in rows.values()))
+      for sub in fetched.values():
+         self.assertEqual(type(sub), learnit.Submission)
+
    def test_downloads(self):
       attachment = next(att
          for cid in self.client.list_my_courses(self.data_my).keys()
@@ -60,6 +82,17 @@ class TestSuccess(unittest.TestCase):
          for att in self.client.download_attachments(sub.context_id, sub.files))
       self.assertEqual(type(attachment), learnit.Attachment)
 
+   def test_spooled_downloads(self):
+      with tempfile.TemporaryDirectory() as spool_dir:
+         attachment = next(att
+            for cid in self.client.list_my_courses(self.data_my).keys()
+            for aid in self.client.list_assignments(cid).keys()
+            for row in self.client.list_submissions(aid).values()
+            for sub in [self.client.show_submission(aid, row.row)]
+            for att in self.client.spool_attachments(sub.context_id, sub.files, spool_dir))
+         self.assertEqual(type(attachment), learnit.SpooledAttachment)
+         self.assertTrue(os.path.isfile(attachment.path))
+
    def test_save(self):
       aid, row = next((aid, row.row)
          for cid in self.client.list_my_courses(self.data_my).keys()
@@ -5,6 +5,7 @@ import unittest, json, learnit2
 
 with open('.password') as f:
    password = json.loads(f.read())
+session_file = '.session'
 
 
 class TestErrors(unittest.TestCase):
@@ -18,7 +19,10 @@ class TestSuccess(unittest.TestCase):
 
    def setUp(self):
       self.client = learnit2.Learnit()
-      res, err = self.client.login(password['username'], password['password'])
+      res, err = self.client.resume_session(session_file)
+      if err != learnit2.SUCCESS:
+         res, err = self.client.login(password['username'], password['password'])
+         self.client.save_session(session_file)
       self.assertEqual(err, learnit2.SUCCESS)
       self.person, self.courses = res
 
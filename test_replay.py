@@ -0,0 +1,682 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import unittest, tempfile, os, io, contextlib, urllib.request, urllib.error, logging, zipfile
+from urllib.parse import urlsplit
+import learnit, learnit2, learnit_replay, learnit_mock, learnit_http, learnit_cmd, learnit_async
+import learnit_cmd2, learnit_store
+import json, asyncio, threading, time, datetime, concurrent.futures
+import dateutil.parser
+from collections import Counter
+
+
+class TestReplay(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.TemporaryDirectory()
+      self.hits = 0
+      self.origin = learnit_replay.StandInServer(self.respond).start()
+      self.base = 'http://127.0.0.1:{}'.format(self.origin.server_port)
+
+   def tearDown(self):
+      self.origin.stop()
+      self.tmp.cleanup()
+
+   def respond(self, method, url, fields):
+      path = urlsplit(url).path
+      if path == '/login':
+         return 303, 'See Other', [('Location', self.base + '/my/'), ('Set-Cookie', 's=1')], b''
+      if path == '/my/':
+         self.hits += 1
+         return 200, 'OK', [('Content-Type', 'text/html')], 'hits {}'.format(self.hits).encode()
+      return None
+
+   def visit(self, opener):
+      resp = opener.open(self.base + '/login', b'username=me&password=secret')
+      pages = [(resp.geturl(), resp.read())]
+      for _ in range(2):
+         resp = opener.open(self.base + '/my/')
+         pages.append((resp.geturl(), resp.read()))
+      return pages
+
+   def test_record_replay(self):
+      fixtures = learnit_replay.Fixtures(self.tmp.name)
+      recorded = self.visit(urllib.request.build_opener(*learnit_replay.recording_handlers(fixtures)))
+      fixtures.save()
+      self.assertEqual([page for _, page in recorded], [b'hits 1', b'hits 2', b'hits 3'])
+      for name in os.listdir(self.tmp.name):
+         with open(os.path.join(self.tmp.name, name), 'rb') as f:
+            self.assertNotIn(b'secret', f.read())
+
+      fixtures = learnit_replay.Fixtures(self.tmp.name)
+      server = learnit_replay.StandInServer(fixtures.respond).start()
+      try:
+         opener = urllib.request.build_opener(*learnit_replay.replay_handlers(server))
+         self.assertEqual(self.visit(opener), recorded)
+         self.assertEqual(opener.open(self.base + '/my/').read(), b'hits 3')
+         with self.assertRaises(urllib.error.HTTPError):
+            opener.open(self.base + '/other')
+         self.assertEqual(server.misses, [('GET', self.base + '/other')])
+      finally:
+         server.stop()
+      self.assertEqual(self.hits, 3)
+
+class ValidatingOpener:
+   ''' Stands in for a urllib opener, with a page that answers 304 Not
+       Modified to requests that have its ETag '''
+   def __init__(self):
+      self.requests = []
+
+   def open(self, req, timeout=None):
+      self.requests.append(req)
+      if req.get_header('If-none-match') == '"v1"':
+         raise urllib.error.HTTPError(req.full_url, 304, 'Not Modified', {}, None)
+      return learnit_http.CachedResponse(req.full_url, [('ETag', '"v1"')], b'page')
+
+class TestResponseCache(unittest.TestCase):
+
+   def setUp(self):
+      self.tmp = tempfile.TemporaryDirectory()
+
+   def tearDown(self):
+      self.tmp.cleanup()
+
+   def test_ttls(self):
+      cache = learnit_http.ResponseCache(self.tmp.name)
+      self.assertEqual(cache.ttl(learnit.save_grade.format(1, 2)), 0)
+      self.assertGreater(cache.ttl(learnit.assign_view.format(1, 'grading', '0')), 0)
+
+   def test_expiry(self):
+      cache = learnit_http.ResponseCache(self.tmp.name, ttls=[(r'/page', 0.05)])
+      cache.put('http://a/page', None, 'http://a/page', [], b'page')
+      entry, fresh = cache.get('http://a/page')
+      self.assertEqual((entry['payload'], fresh), (b'page', True))
+      time.sleep(0.1)
+      entry, fresh = cache.get('http://a/page')
+      self.assertEqual((entry['payload'], fresh), (b'page', False))
+      self.assertEqual(cache.get('http://a/other'), (None, False))
+
+   def test_eviction(self):
+      cache = learnit_http.ResponseCache(self.tmp.name, ttls=[(r'/', 60)])
+      cache.put('http://a/1', None, 'http://a/1', [], b'x' * 1000)
+      cache.max_bytes = cache.size * 2 + 100
+      time.sleep(0.01)
+      cache.put('http://a/2', None, 'http://a/2', [], b'x' * 1000)
+      time.sleep(0.01)
+      cache.get('http://a/1')
+      time.sleep(0.01)
+      cache.put('http://a/3', None, 'http://a/3', [], b'x' * 1000)
+      self.assertEqual([cache.get('http://a/{}'.format(i))[0] is not None for i in range(1, 4)], [True, False, True])
+      self.assertLessEqual(cache.size, cache.max_bytes)
+      self.assertEqual(learnit_http.ResponseCache(self.tmp.name).size, cache.size)
+
+   def test_invalidate(self):
+      cache = learnit_http.ResponseCache(self.tmp.name, ttls=[(r'/', 60)])
+      for i in range(1, 4):
+         cache.put('http://a/view.php?id={}'.format(i), None, 'http://a/login', [], b'x' * 1000)
+      cache.invalidate(r'[?&]id=1$')
+      reopened = learnit_http.ResponseCache(self.tmp.name, ttls=[(r'/', 60)])
+      reopened.invalidate(r'[?&]id=2$')
+      self.assertEqual([reopened.get('http://a/view.php?id={}'.format(i))[0] is not None for i in range(1, 4)], [False, False, True])
+      self.assertEqual(len(reopened.entries), 1)
+
+   def test_revalidation(self):
+      opener = ValidatingOpener()
+      cache = learnit_http.ResponseCache(self.tmp.name, ttls=[(r'/page', 0.05)])
+      logging_opener = learnit_http.LoggingOpener(opener, cache, stats=None)
+      self.assertEqual(logging_opener.open('http://a/page')[0], 'page')
+      self.assertEqual(logging_opener.open('http://a/page')[0], 'page')
+      self.assertEqual(len(opener.requests), 1)
+      time.sleep(0.1)
+      self.assertEqual(logging_opener.open('http://a/page')[0], 'page')
+      self.assertEqual(len(opener.requests), 2)
+      self.assertEqual(opener.requests[1].get_header('If-none-match'), '"v1"')
+      # The 304 made the entry fresh again
+      self.assertTrue(cache.get('http://a/page')[1])
+
+class TestRequestLog(unittest.TestCase):
+
+   def test_separate_logs(self):
+      streams = [io.StringIO(), io.StringIO()]
+      logs = [learnit_http.RequestLog(logging.StreamHandler(stream)) for stream in streams]
+      logs[0].request('http://a/one', None, 'network', 200, 0.01, 3)
+      logs[1].request('http://a/two', b'user=x&password=y', 'network', 200, 0.01, 3)
+      for log in logs:
+         log.close()
+         log.close()
+      self.assertEqual(len(streams[0].getvalue().splitlines()), 1)
+      self.assertIn('GET http://a/one', streams[0].getvalue())
+      self.assertEqual(len(streams[1].getvalue().splitlines()), 1)
+      self.assertIn('fields=user,password', streams[1].getvalue())
+      self.assertNotIn('password=y', streams[1].getvalue())
+
+class TestScheduler(unittest.TestCase):
+
+   def test_priority(self):
+      scheduler = learnit_http.Scheduler(1)
+      started, release = threading.Event(), threading.Event()
+      def block():
+         started.set()
+         release.wait()
+      order = []
+      scheduler.submit(block)
+      started.wait()
+      background = scheduler.submit(order.append, 'background', priority=learnit_http.BACKGROUND)
+      prefetch = scheduler.submit(order.append, 'prefetch', priority=learnit_http.PREFETCH)
+      cancelled = scheduler.submit(order.append, 'cancelled', priority=learnit_http.PREFETCH)
+      interactive = scheduler.submit(order.append, 'interactive')
+      self.assertTrue(cancelled.cancel())
+      release.set()
+      background.result()
+      self.assertEqual(order, ['interactive', 'prefetch', 'background'])
+      nested = scheduler.submit(lambda: scheduler.map(lambda x: x * 2, range(3))).result()
+      self.assertEqual(nested, [0, 2, 4])
+      self.assertEqual(sorted(scheduler.imap_unordered(abs, range(-5, 5), limit=2)), sorted(map(abs, range(-5, 5))))
+      # The calls a BACKGROUND call makes stay behind newer INTERACTIVE calls
+      order.clear()
+      submitted, queued = threading.Event(), threading.Event()
+      def bulk():
+         for i in range(2):
+            scheduler.submit(order.append, 'bulk {}'.format(i))
+         queued.set()
+         submitted.wait()
+      scheduler.submit(bulk, priority=learnit_http.BACKGROUND)
+      queued.wait()
+      interactive = scheduler.submit(order.append, 'interactive')
+      submitted.set()
+      scheduler.submit(lambda: None, priority=learnit_http.BACKGROUND).result()
+      self.assertEqual(order, ['interactive', 'bulk 0', 'bulk 1'])
+      threads = list(scheduler.threads)
+      scheduler.shutdown()
+      self.assertFalse(any(thread.is_alive() for thread in threads))
+      with self.assertRaises(RuntimeError):
+         scheduler.submit(abs, 1)
+
+class TestGradeFile(unittest.TestCase):
+
+   def test_byte_order_mark(self):
+      with tempfile.TemporaryDirectory() as tmp:
+         path = os.path.join(tmp, 'grades.csv')
+         with open(path, 'w', newline='', encoding='utf-8-sig') as f:
+            f.write('assignment,group,grade,feedback\r\n40000,AB,Approved,Très bien\r\n')
+         self.assertEqual(learnit.read_grades(path),
+            [learnit.GradeRecord(2, '40000', 'AB', 'Approved', 'Très bien')])
+
+class TestMockCourse(unittest.TestCase):
+
+   def setUp(self):
+      self.course = learnit_mock.MockCourse(60, 4, 2000)
+      self.server = learnit_replay.StandInServer(self.course.respond).start()
+      self.clients = []
+
+   def tearDown(self):
+      for client in self.clients:
+         client.close()
+      self.server.stop()
+
+   def client(self, module, server=None):
+      ''' A client of module for server, closed by tearDown '''
+      client = module.Learnit(learnit_replay.replay_handlers(server or self.server), cache=False)
+      self.clients.append(client)
+      return client
+
+   def test_tables(self):
+      client = self.client(learnit2)
+      (person, courses), er = client.login('username', 'password')
+      self.assertEqual(er, learnit2.SUCCESS)
+      self.assertEqual([course.id for course in courses], [self.course.cid])
+      tables = client.get_tables(self.course.cid)
+      expected = learnit2.join_tables(*self.course.raw_tables())
+      self.assertEqual([g.name for g in tables.groups], [g.name for g in expected.groups])
+      self.assertEqual([s.person for s in tables.students], [s.person for s in expected.students])
+      self.assertEqual([[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in tables.submissions],
+         [[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in expected.submissions])
+      self.assertEqual([[(a.time, a.student.person) for a in s.submit_actions] for s in tables.submissions],
+         [[(a.time, a.student.person) for a in s.submit_actions] for s in expected.submissions])
+      self.assertEqual(self.server.misses, [])
+
+   def test_person_pages(self):
+      course = learnit_mock.MockCourse(learnit2.PERSON_PAGE_SIZE + 100, 2, 500)
+      server = learnit_replay.StandInServer(course.respond).start()
+      try:
+         client = self.client(learnit2, server)
+         learnit_http.stats.reset()
+         tables = client.get_tables(course.cid)
+         expected = learnit2.join_tables(*course.raw_tables())
+         self.assertEqual([s.person for s in tables.students], [s.person for s in expected.students])
+         self.assertEqual([t.person for t in tables.teachers], [t.person for t in expected.teachers])
+         self.assertEqual(learnit_http.stats.as_dict()['requests']['learnit.itu.dk/user/index.php']['count'], 4)
+         client.close()
+         async def students():
+            async with learnit_async.Learnit(route=server.server_address) as client:
+               return await client.get_person_table(course.cid, learnit2.ROLE_STUDENT)
+         self.assertEqual(len(asyncio.run(students())), len(expected.students))
+      finally:
+         server.stop()
+
+   def test_lazy_tables(self):
+      client = self.client(learnit2)
+      dialog = learnit_cmd2.MainDialog(client, self.course.cid)
+      dialog.lazy = client.lazy_tables(self.course.cid)
+      learnit_http.stats.reset()
+      with contextlib.redirect_stdout(io.StringIO()) as out:
+         dialog.list_assignments_cmd()
+      self.assertEqual(len(out.getvalue().splitlines()), len(self.course.assignments))
+      self.assertEqual(list(learnit_http.stats.as_dict()['requests']), ['learnit.itu.dk/course/view.php'])
+      dialog.lazy.load(learnit_http.BACKGROUND)
+      with tempfile.TemporaryDirectory() as tmp:
+         dialog.store = learnit_store.CourseStore(os.path.join(tmp, 'course.sqlite'))
+         with contextlib.redirect_stdout(io.StringIO()):
+            dialog.result_cmd()
+         self.assertIsNone(dialog.lazy)
+         requests = learnit_http.stats.as_dict()['requests']
+         self.assertEqual(requests['learnit.itu.dk/course/view.php']['count'], 1)
+         tables = learnit2.join_tables(*self.course.raw_tables())
+         self.assertEqual(dialog.store.group_status(tables.groups[0].name),
+            [(s.assignment.id, s.assignment.title, learnit_store.submission_grade(
+               max((sa.time for sa in s.submit_actions), default=None),
+               max((ga.time for ga in s.grade_actions), default=None),
+               s.grade_actions[0].grade if s.grade_actions else None))
+            for s in tables.groups[0].submissions])
+         dialog.store.close()
+      self.assertEqual(self.server.misses, [])
+
+   def test_close(self):
+      started, release = threading.Event(), threading.Event()
+      pages = []
+      def respond(method, url, fields):
+         if '/report/log/' in url:
+            pages.append(url)
+            started.set()
+            release.wait()
+         return self.course.respond(method, url, fields)
+      server = learnit_replay.StandInServer(respond).start()
+      try:
+         client = self.client(learnit2, server)
+         lazy = client.lazy_tables(self.course.cid).load(learnit_http.BACKGROUND)
+         started.wait()
+         closing = threading.Thread(target=client.close)
+         start = time.monotonic()
+         closing.start()
+         while not client.scheduler.closed:
+            time.sleep(0.01)
+         release.set()
+         closing.join()
+         # The log has more pages, but close stopped the load after the one it was on
+         self.assertLess(time.monotonic() - start, learnit_http.SHUTDOWN_TIMEOUT)
+         self.assertEqual(len(pages), 1)
+         self.assertIsInstance(lazy.futures['tables'].exception(), concurrent.futures.CancelledError)
+      finally:
+         server.stop()
+
+   def test_store_states(self):
+      tables = learnit2.join_tables(*self.course.raw_tables())
+      def grade(s):
+         return learnit_store.submission_grade(
+            max((sa.time for sa in s.submit_actions), default=None),
+            max((ga.time for ga in s.grade_actions), default=None),
+            max(((ga.time, ga.grade) for ga in s.grade_actions), default=(None, None))[1])
+      def expected(submissions):
+         return dict(Counter(grade(s) for s in submissions))
+      with tempfile.TemporaryDirectory() as tmp:
+         store = learnit_store.CourseStore(os.path.join(tmp, 'course.sqlite'))
+         for _ in range(2):
+            store.save(tables, None)
+            self.assertEqual([counts for _, _, counts in store.results()],
+               [expected(g.submissions) for g in tables.groups])
+            self.assertEqual([counts for _, _, counts in store.assignment_results()],
+               [expected(a.submissions) for a in tables.assignments])
+            for group in tables.groups:
+               self.assertEqual([grade for _, _, grade in store.group_status(group.name)],
+                  [grade(s) for s in group.submissions])
+            # A new grade moves its submission between the aggregates
+            submission = next(s for s in tables.submissions if s.submit_actions)
+            teacher = tables.teachers[0]
+            action = learnit2.GradeAction(submission.submit_actions[0].time + datetime.timedelta(days=1),
+               learnit2.NOT_APPROVED if grade(submission) == learnit2.APPROVED else learnit2.APPROVED,
+               teacher, submission)
+            submission.grade_actions.insert(0, action)
+            teacher.grade_actions.insert(0, action)
+         store.close()
+
+   def test_store_actions(self):
+      asss, gros, pers, studs, log = self.course.raw_tables()
+      # Cut the log inside a minute with several events, so the minute is
+      # partly stored and then fetched again in full
+      cut = next(i for i in range(len(log) // 2, len(log)) if log[i][1][0] == log[i - 1][1][0])
+      since = log[cut][1][0]
+      rest = [event for event in log if event[1][0] >= since]
+      self.assertGreater(len(rest), cut)
+      def content(store):
+         return (store.results(), store.assignment_results(),
+            [[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in store.load().submissions],
+            [[(a.time, a.student.person) for a in s.submit_actions] for s in store.load().submissions],
+            [[a.time for a in t.grade_actions] for t in store.load().teachers],
+            [[a.time for a in s.submit_actions] for s in store.load().students])
+      with tempfile.TemporaryDirectory() as tmp:
+         full = learnit_store.CourseStore(os.path.join(tmp, 'full.sqlite'))
+         full.save(learnit2.join_tables(asss, gros, pers, studs, log), log[0][1][0])
+         store = learnit_store.CourseStore(os.path.join(tmp, 'course.sqlite'))
+         store.save(learnit2.join_tables(asss, gros, pers, studs, log[cut:]), since)
+         self.assertNotEqual(content(store), content(full))
+         self.assertEqual(store.add_actions(rest, since), log[0][1][0])
+         self.assertEqual(store.newest(), full.newest())
+         self.assertEqual(content(store), content(full))
+         # The newest minute is fetched again by the next update, but not added twice
+         store.add_actions([event for event in log if event[1][0] == store.newest()], store.newest())
+         self.assertEqual(content(store), content(full))
+         full.close()
+         store.close()
+
+   def test_log_shifted_pages(self):
+      expected = list(self.client(learnit2).get_log(self.course.cid, perpage=100))
+      self.assertGreater(len(expected), 300)
+      def respond(method, url, fields):
+         response = self.course.respond(method, url, fields)
+         if '/report/log/' in url and '&page=0&' in url:
+            # Actions logged after page 0 is fetched push its last rows onto page 1
+            self.course.changes[:0] = self.course.changes[:30]
+         return response
+      server = learnit_replay.StandInServer(respond).start()
+      self.addCleanup(server.stop)
+      self.assertEqual(list(self.client(learnit2, server).get_log(self.course.cid, perpage=100)), expected)
+
+   def test_merge_since(self):
+      asss, gros, pers, studs, log = self.course.raw_tables()
+      expected = learnit2.join_tables(asss, gros, pers, studs, log)
+      # Cut the log inside a minute with several events, which the merge
+      # fetches again in full
+      cut = next(i for i in range(len(log) // 2, len(log)) if log[i][1][0] == log[i - 1][1][0])
+      since = log[cut][1][0]
+      rest = [event for event in log if event[1][0] >= since]
+      self.assertGreater(len(rest), cut)
+      tables = learnit2.join_tables(asss, gros, pers, studs, log[cut:])
+      unresolved = []
+      self.assertEqual(learnit2.merge_log(tables, rest, since, unresolved), log[0][1][0])
+      self.assertEqual(unresolved, [])
+      self.assertEqual([[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in tables.submissions],
+         [[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in expected.submissions])
+      self.assertEqual([[(a.time, a.student.person) for a in s.submit_actions] for s in tables.submissions],
+         [[(a.time, a.student.person) for a in s.submit_actions] for s in expected.submissions])
+      self.assertEqual([[a.time for a in t.grade_actions] for t in tables.teachers],
+         [[a.time for a in t.grade_actions] for t in expected.teachers])
+
+   def test_unresolved(self):
+      asss, gros, pers, studs, log = self.course.raw_tables()
+      since = log[len(log) // 2][1][0]
+      # A student that joined after the last full sync
+      pid = next(event[1][1] for event in log if event[0] == learnit2.LOG_SUBMIT and event[1][0] > since)
+      old_pers = [person for person in pers if person[0] != pid]
+      old_studs = [person for person in studs if person[0] != pid]
+      old = [event for event in log if event[1][0] <= since]
+      # Its submits, and the grades of them
+      new = [event for event in log if event[1][0] > since
+         and pid == event[1][1 if event[0] == learnit2.LOG_SUBMIT else 3]]
+      unresolved = []
+      learnit2.merge_log(learnit2.join_tables(asss, gros, old_pers, old_studs, old), log, since, unresolved)
+      self.assertEqual(unresolved, new)
+      with tempfile.TemporaryDirectory() as tmp:
+         store = learnit_store.CourseStore(os.path.join(tmp, 'course.sqlite'))
+         store.save(learnit2.join_tables(asss, gros, old_pers, old_studs, old), since)
+         unresolved = []
+         store.add_actions(log, since, unresolved)
+         self.assertEqual(unresolved, new)
+         store.close()
+      # sync_tables fetches the tables again, with the new student
+      client = self.client(learnit2)
+      tables = learnit2.join_tables(asss, gros, old_pers, old_studs, old)
+      tables, newest = client.sync_tables(self.course.cid, tables, since)
+      self.assertIn(pid, [student.person.id for student in tables.students])
+      self.assertEqual(newest, log[0][1][0])
+
+   def test_save_grades(self):
+      client = self.client(learnit)
+      aid = min(client.list_assignments(self.course.cid))
+      rows = client.list_submissions(aid)
+      group, row = next((group, row) for group, row in rows.items() if row.substat == learnit.HAS_SUBMIT)
+      current = learnit.grade_to_name[row.grade]
+      other = 'Approved' if row.grade != learnit.APPROVED else 'Not approved'
+      with tempfile.TemporaryDirectory() as tmp:
+         path = os.path.join(tmp, 'grades.csv')
+         with open(path, 'w') as f:
+            f.write('assignment,group,grade,feedback\n{0},{1},{2},\n{0},{1},{3},\n{0},{1},{3},\n'
+               '{0},ZZZ,Great,\n'.format(aid, group.lower(), other, current))
+         records = learnit.read_grades(path)
+         results = {result.record.line: result for result in client.save_grades(records[:4])}
+         self.assertEqual({line: result.status for line, result in results.items()},
+            {2: 'skipped', 3: 'skipped', 4: 'unchanged', 5: 'failed'})
+         results = list(client.save_grades(records[:1] + records[3:4]))
+         self.assertEqual(sorted(result.status for result in results), ['failed', 'saved'])
+         learnit.write_grade_report(os.path.join(tmp, 'report.csv'), results)
+         with open(os.path.join(tmp, 'report.csv')) as f:
+            self.assertEqual(f.readline().strip(), 'line,assignment,group,grade,status,attempts,message')
+         # An unexpected error fails its record, not the whole batch
+         def show_submission(assign_id, row):
+            raise KeyError('grade code')
+         client.show_submission = show_submission
+         results = list(client.save_grades(records[:1] + records[3:4]))
+         self.assertEqual(sorted((result.status, result.message) for result in results),
+            [('failed', "KeyError: 'grade code'"), ('failed', "Unknown grade 'Great'")])
+
+   def test_prefetch(self):
+      client = self.client(learnit)
+      aid = min(client.list_assignments(self.course.cid))
+      dialog = learnit_cmd.AssignmentDialog(client, self.course.cid, aid)
+      dialog.subs = client.list_submissions(aid)
+      order = dialog.grading_order()
+      prefetcher = learnit_cmd.Prefetcher(client, self.course.cid, aid, depth=2)
+      try:
+         prefetcher.prefetch(order)
+         self.assertEqual(list(prefetcher.fetches), order[:2])
+         sub, attachments, log = prefetcher.get(order[0], order[1:])
+         self.assertEqual(sub.sub_status, learnit.HAS_SUBMIT)
+         self.assertTrue(all(os.path.isfile(path) for _, path in attachments))
+         self.assertEqual(list(prefetcher.fetches), order[1:3] + order[:1])
+         learnit_http.stats.reset()
+         prefetcher.saved(order[0])
+         self.assertFalse(any(os.path.exists(path) for _, path in attachments))
+         # Only the gradings of the assignment are fetched again for the log
+         _, _, updated = prefetcher.get(order[1], order[2:])
+         self.assertEqual(learnit_http.stats.as_dict()['requests']['learnit.itu.dk/report/log/index.php']['count'], 1)
+         self.assertEqual(updated.grade_actions(aid), list(client.get_log(self.course.cid, aid)))
+         other = max(client.list_assignments(self.course.cid))
+         self.assertIs(updated.grade_actions(other), log.grade_actions(other))
+      finally:
+         prefetcher.close()
+      self.assertFalse(os.path.exists(prefetcher.spool_dir))
+
+   def test_spool(self):
+      def zipped(files):
+         data = io.BytesIO()
+         with zipfile.ZipFile(data, 'w') as zf:
+            for name, text in files.items():
+               zf.writestr(name, text)
+         return data.getvalue()
+      files = {
+         '/pluginfile.php/7/assignsubmission_file/submission_files/1/code.zip':
+            zipped({'a/Main.java': 'AAA', 'b/Main.java': 'BBB', '../evil.txt': 'E'}),
+         '/pluginfile.php/7/assignsubmission_file/submission_files/2/code.zip':
+            zipped({'a/Main.java': 'CCC'}),
+      }
+      def respond(method, url, fields):
+         payload = files.get(urlsplit(url).path)
+         return payload and (200, 'OK', [('Content-Type', 'application/zip')], payload)
+      server = learnit_replay.StandInServer(respond).start()
+      try:
+         client = self.client(learnit, server)
+         with tempfile.TemporaryDirectory() as tmp:
+            for _ in range(2):
+               # Two submissions of the assignment spooled to the same directory
+               spooled = sorted(client.spool_attachments(7, ['1/code.zip', '2/code.zip'], tmp))
+               read = lambda path: open(path).read()
+               self.assertEqual(sorted((name, read(path)) for name, path in spooled),
+                  [('a/Main.java', 'AAA'), ('a/Main.java', 'CCC'), ('b/Main.java', 'BBB'), ('evil.txt', 'E')])
+               self.assertTrue(all(os.path.realpath(path).startswith(os.path.realpath(tmp)) for _, path in spooled))
+      finally:
+         server.stop()
+
+   def test_stats(self):
+      learnit_http.stats.reset()
+      client = self.client(learnit2)
+      client.get_tables(self.course.cid)
+      report = json.loads(json.dumps(learnit_http.stats.as_dict()))
+      log = report['requests']['learnit.itu.dk/report/log/index.php']
+      self.assertEqual(log['count'], 3)
+      self.assertTrue(0 < log['p50'] <= log['p99'] <= log['max'])
+      for name in ('parse log rows', 'parse dates', 'parse user index', 'join tables', 'merge log'):
+         self.assertIn(name, report['timings'])
+
+   def test_course_log(self):
+      client = self.client(learnit)
+      aids = sorted(client.list_assignments(self.course.cid))
+      learnit_http.stats.reset()
+      log = client.get_course_log(self.course.cid)
+      for aid in aids:
+         self.assertEqual(log.grade_actions(aid), list(client.get_log(self.course.cid, aid)))
+      row = next(row for row in client.list_submissions(aids[0]).values() if log.latest(aids[0], row.studids))
+      actions = [ga for ga in log.grade_actions(aids[0]) if ga.studid in row.studids]
+      self.assertEqual(log.grade_actions(aids[0], row.studids), actions)
+      self.assertEqual(log.latest(aids[0], row.studids), actions[0])
+      learnit_http.stats.reset()
+      with contextlib.redirect_stdout(io.StringIO()):
+         learnit_cmd.MainDialog(client, '').table_cmd(self.course.cid)
+      requests = learnit_http.stats.as_dict()['requests']
+      self.assertEqual(requests['learnit.itu.dk/report/log/index.php']['count'], 1)
+
+   def test_update_courses(self):
+      tmp = tempfile.TemporaryDirectory()
+      self.addCleanup(tmp.cleanup)
+      client = learnit.Learnit(learnit_replay.replay_handlers(self.server), cache=learnit_http.ResponseCache(tmp.name))
+      self.clients.append(client)
+      dialog = learnit_cmd.MainDialog(client, '')
+      cid = self.course.cid
+      dialog.load_courses({cid: 'Course'})
+      self.course.assignments.append(('49999', 'Assignment 5: New'))
+      out = io.StringIO()
+      with contextlib.redirect_stdout(out):
+         dialog.grade_cmd('49999')
+         dialog.update_cmd(None)
+         dialog.list_assignments_cmd()
+      self.assertIn('Unknown assignment 49999', out.getvalue())
+      self.assertIn('49999: Assignment 5: New', out.getvalue())
+
+   def test_snapshot(self):
+      client = self.client(learnit)
+      dialog = learnit_cmd.MainDialog(client, '')
+      cid = self.course.cid
+      learnit_http.stats.reset()
+      with contextlib.redirect_stdout(io.StringIO()):
+         dialog.result_cmd(cid)
+         dialog.tograde_cmd(cid)
+         dialog.table_cmd(cid)
+         dialog.table_cmd(cid)
+      requests = learnit_http.stats.as_dict()['requests']
+      self.assertEqual(requests['learnit.itu.dk/mod/assign/view.php?action=grading']['count'],
+         len(self.course.assignments))
+      self.assertEqual(requests['learnit.itu.dk/report/log/index.php']['count'], 1)
+      aid = self.course.assignments[1][0]
+      self.assertTrue(dialog.snapshot(cid).saved(aid))
+      learnit_http.stats.reset()
+      with contextlib.redirect_stdout(io.StringIO()):
+         dialog.result_cmd(cid)
+         dialog.table_cmd(cid)
+      requests = learnit_http.stats.as_dict()['requests']
+      self.assertEqual(requests['learnit.itu.dk/mod/assign/view.php?action=grading']['count'], 1)
+      self.assertEqual(requests['learnit.itu.dk/report/log/index.php']['count'], 1)
+      self.assertEqual(dialog.snapshot(cid).course_log().grade_actions(aid), list(client.get_log(cid, aid)))
+      dialog.update_cmd(None)
+      learnit_http.stats.reset()
+      with contextlib.redirect_stdout(io.StringIO()):
+         dialog.tograde_cmd(cid)
+      requests = learnit_http.stats.as_dict()['requests']
+      self.assertEqual(requests['learnit.itu.dk/mod/assign/view.php?action=grading']['count'],
+         len(self.course.assignments))
+      self.assertEqual(requests['learnit.itu.dk/course/view.php']['count'], 1)
+
+   def test_grading(self):
+      client = self.client(learnit)
+      data, er = client.login('username', 'password')
+      self.assertEqual(er, learnit.SUCCESS)
+      aid = min(client.list_assignments(self.course.cid))
+      rows = client.list_submissions(aid)
+      self.assertEqual(len(rows), len(self.course.groups) + 1)
+      row = next(row for row in rows.values() if row.substat == learnit.HAS_SUBMIT)
+      sub = client.show_submission(aid, row.row)
+      self.assertEqual((sub.sub_status, sub.grade), (learnit.HAS_SUBMIT, row.grade))
+      self.assertEqual(client.save_grade(aid, row.row, sub.form, learnit.APPROVED, '', sub.grade_to_code),
+         learnit.SUCCESS)
+      self.assertTrue(all(type(ga) == learnit.GradeAction for ga in client.get_log(self.course.cid, aid)))
+      self.assertEqual(self.server.misses, [])
+
+   def test_session(self):
+      client = self.client(learnit)
+      client.login('username', 'password')
+      with tempfile.TemporaryDirectory() as tmp:
+         path = os.path.join(tmp, '.session')
+         with open(path, 'w') as f:
+            os.chmod(path, 0o644)
+         client.save_session(path)
+         # The session is as good as the password, so only the owner may read it
+         self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+         resumed = self.client(learnit)
+         self.assertEqual(resumed.resume_session(path)[1], learnit.SUCCESS)
+
+class TestLogParsing(unittest.TestCase):
+
+   def test_parse_times(self):
+      texts = ['Monday, 26 January 2015, 11:06 AM', 'Monday, 26 January 2015, 12:06 AM',
+         'Monday, 26 January 2015, 12:30 PM', 'Monday, 26 January 2015, 23:06', '2015-01-26 11:06']
+      self.assertEqual(learnit_http.parse_times(texts), [dateutil.parser.parse(text) for text in texts])
+      course = learnit_mock.MockCourse(60, 4, 2000)
+      events = [event for _, event in learnit2.parse_log_page(course.log_page(False, 2000, 0)) if event]
+      self.assertEqual(len(events), len(course.changes))
+
+class TestAsync(unittest.TestCase):
+
+   def setUp(self):
+      self.course = learnit_mock.MockCourse(60, 4, 2000)
+      self.lock = threading.Lock()
+      self.active = self.most = 0
+      self.server = learnit_replay.StandInServer(self.respond).start()
+
+   def tearDown(self):
+      self.server.stop()
+
+   def respond(self, method, url, fields):
+      with self.lock:
+         self.active += 1
+         self.most = max(self.most, self.active)
+      try:
+         time.sleep(0.01)
+         return self.course.respond(method, url, fields)
+      finally:
+         with self.lock:
+            self.active -= 1
+
+   async def session(self):
+      async with learnit_async.Learnit(limit=8, route=self.server.server_address) as client:
+         (person, courses), er = await client.login('username', 'password')
+         self.assertEqual(er, learnit2.SUCCESS)
+         self.assertEqual([course.id for course in courses], [self.course.cid])
+         tables = await client.get_tables(self.course.cid)
+         expected = learnit2.join_tables(*self.course.raw_tables())
+         self.assertEqual([s.person for s in tables.students], [s.person for s in expected.students])
+         self.assertEqual([[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in tables.submissions],
+            [[(a.time, a.grade, a.teacher.person) for a in s.grade_actions] for s in expected.submissions])
+         aid = min(await client.list_assignments(self.course.cid))
+         subs = await client.show_submissions(aid)
+         self.assertEqual(len(subs), len(self.course.groups) + 1)
+         row, sub = next((row, sub) for row, sub in subs if sub.sub_status == learnit.HAS_SUBMIT)
+         self.assertTrue(await client.download_attachments(sub.context_id, sub.files))
+         er = await client.save_grade(aid, row, sub.form, learnit.APPROVED, 'Fine', sub.grade_to_code)
+         self.assertEqual(er, learnit.SUCCESS)
+         log = await client.get_course_log(self.course.cid)
+         self.assertTrue(log.grade_actions(aid))
+
+   def test_client(self):
+      asyncio.run(self.session())
+      self.assertEqual(self.server.misses, [])
+      self.assertTrue(1 < self.most <= 8)
+
+if __name__ == '__main__':
+   unittest.main()